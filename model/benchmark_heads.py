@@ -0,0 +1,120 @@
+import argparse, time
+import torch
+from torch.nn import functional as F
+
+from cnn_head import set_conv_backend
+from pooling import POOLS, stack_conved, get_num_valid, pool_stacked
+from questionnaire.symptom_cnn import SymptomCNN
+from questionnaire.questionnaire_model import QuestionnaireModel
+from disease.disease_model import DiseaseAfterBertModel, DiseaseModelfor2Inputs
+
+
+# ======================================
+#   CPU benchmark of the conv backends of the CNN heads (see cnn_head.py)
+#   Every head runs on random encoder outputs with both backends in eval mode and without autograd,
+#   the outputs of the two backends are compared and the mean time per batch is printed.
+#   Then pool_stacked (pooling.py) on the stacked conv output of run_convs is timed against pooling
+#   one filter size after another on the per-filter-size conv outputs, for --pool_filters filters.
+#
+#   --real_length n: the heads also get an attention mask of n real tokens per sample (--masked_pooling),
+#   so the batch is trimmed to n positions before the conv.
+#
+#   python benchmark_heads.py --batch_size 32 --max_seq_length 512 --threads 4
+# ======================================
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_seq_length", type=int, default=512)
+    parser.add_argument("--embedding_dim", type=int, default=768)
+    parser.add_argument("--num_symptoms", type=int, default=9)
+    parser.add_argument("--real_length", type=int, default=0)    # real tokens per sample, 0: no attention mask
+    parser.add_argument("--pool_filters", type=int, default=50)   # n_filters of the pooling benchmark
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=0)   # torch intra-op threads, 0: torch default
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def time_forward(forward, repeat, warmup):
+    for _ in range(warmup):
+        forward()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        forward()
+    return (time.perf_counter() - start) / repeat
+
+
+def get_heads(args):
+    # name -> (model, inputs)
+    bert_output = torch.randn(args.batch_size, args.max_seq_length, args.embedding_dim)
+    question_output = torch.randn(args.batch_size, args.num_symptoms, 5)
+    labels = torch.zeros(args.batch_size, dtype=torch.long)
+    attention_mask = None
+    if args.real_length > 0:
+        attention_mask = torch.zeros(args.batch_size, args.max_seq_length, dtype=torch.long)
+        attention_mask[:, :args.real_length] = 1
+    return {
+        'SymptomCNN': (SymptomCNN(args.embedding_dim), (bert_output, attention_mask)),
+        'QuestionnaireModel': (QuestionnaireModel(args.num_symptoms, args.embedding_dim), (bert_output, labels, attention_mask)),
+        'DiseaseAfterBertModel': (DiseaseAfterBertModel(args.embedding_dim), (bert_output, attention_mask)),
+        'DiseaseModelfor2Inputs': (DiseaseModelfor2Inputs(args.embedding_dim, num_symptom=args.num_symptoms),
+                                   (bert_output, question_output, attention_mask)),
+    }
+
+
+def pool_per_filter_size(conved, pool, k):
+    # pooling as the heads did it before pooling.py: one op (two topk for mix) per filter size
+    batch_size = conved[0].size(0)
+    if pool == 'max':
+        pooled = [F.max_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]
+    elif pool == 'k-max':
+        pooled = [conv.topk(k, dim=2)[0].view(batch_size, -1) for conv in conved]
+    elif pool == 'mix':
+        pooled = [torch.cat([conv.topk(k, dim=2)[0].view(batch_size, -1),
+                             conv.topk(k, dim=2, largest=False)[0].view(batch_size, -1)], dim=1) for conv in conved]
+    else:
+        pooled = [F.avg_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]
+    return torch.cat(pooled, dim=1)
+
+
+def benchmark_pooling(args, filter_sizes=(2, 3, 4, 5, 6), k=5):
+    seq_len = args.real_length if args.real_length > 0 else args.max_seq_length
+    conved = [torch.relu(torch.randn(args.batch_size, args.pool_filters, seq_len - fs + 1)) for fs in filter_sizes]
+    stacked = stack_conved(conved)  # as run_convs returns it
+    num_valid = get_num_valid(filter_sizes, seq_len)
+
+    print("{:<24}{:>12}{:>12}{:>10}{:>12}".format('pool', 'loop (ms)', 'stacked (ms)', 'speedup', 'max diff'))
+    for pool in POOLS:
+        expected = pool_per_filter_size(conved, pool, k)
+        pooled = pool_stacked(stacked, num_valid, pool, k)
+        loop_time = time_forward(lambda: pool_per_filter_size(conved, pool, k), args.repeat, args.warmup)
+        stacked_time = time_forward(lambda: pool_stacked(stacked, num_valid, pool, k), args.repeat, args.warmup)
+        print("{:<24}{:>12.2f}{:>12.2f}{:>9.2f}x{:>12.2e}".format(
+            pool, loop_time * 1000, stacked_time * 1000, loop_time / stacked_time, (expected - pooled).abs().max().item()))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print("*** batch_size {}, max_seq_length {}, real_length {}, embedding_dim {}, threads {}".format(
+        args.batch_size, args.max_seq_length, args.real_length, args.embedding_dim, torch.get_num_threads()))
+
+    print("{:<24}{:>12}{:>12}{:>10}{:>12}".format('head', 'conv (ms)', 'matmul (ms)', 'speedup', 'max diff'))
+    with torch.no_grad():
+        for name, (model, inputs) in get_heads(args).items():
+            model.eval()
+            times, outputs = {}, {}
+            for backend in ('conv', 'matmul'):
+                set_conv_backend(model, backend)
+                outputs[backend] = model(*inputs)[0]
+                times[backend] = time_forward(lambda: model(*inputs), args.repeat, args.warmup)
+            diff = (outputs['conv'] - outputs['matmul']).abs().max().item()
+            print("{:<24}{:>12.2f}{:>12.2f}{:>9.2f}x{:>12.2e}".format(
+                name, times['conv'] * 1000, times['matmul'] * 1000, times['conv'] / times['matmul'], diff))
+
+        benchmark_pooling(args)
@@ -1,10 +1,5 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
-
-from transformers import AutoTokenizer, AutoModel
-
-from dataset import DepressionDataset
 
 
 class BertModelforBaseline(nn.Module):
@@ -29,7 +24,41 @@ def get_batch_bert_embedding(bert_model, inputs, trainable=False):
     return output['last_hidden_state']
 
 
+def is_optimized(model, optimizer):
+    # ======================================
+    #   True if optimizer updates any parameter of model.
+    #   An encoder that is not optimized is frozen: it runs without autograd (get_batch_bert_embedding, trainable=False),
+    #   so neither its activations are kept nor its gradients computed.
+    # ======================================
+    optimized = {id(p) for group in optimizer.param_groups for p in group['params']}
+    return any(id(p) in optimized for p in model.parameters())
+
+
+def get_bert_output(bert_model, data, device, trainable=False):
+    # batches from EmbeddingDataset already carry the (fp16) encoder output
+    if 'bert_output' in data:
+        return data['bert_output'].to(device).float()
+
+    inputs = {
+        "input_ids": data['input_ids'].to(device),
+        "attention_mask": data['attention_mask'].to(device),
+        # "token_type_ids":data['token_type_ids'].to(device),
+    }
+    return get_batch_bert_embedding(bert_model, inputs, trainable=trainable)
+
+
+def get_head_mask(args, data, device):
+    # attention mask for the CNN heads with --masked_pooling (trims the batch and pools real tokens only), else None
+    if not args.masked_pooling:
+        return None
+    return data['attention_mask'].to(device)
+
+
 if __name__ == '__main__':
+    # only the demo below needs the encoder and the data
+    from torch.utils.data import DataLoader
+    from transformers import AutoTokenizer, AutoModel
+    from dataset import DepressionDataset
     from train import get_args
     args = get_args()
 
@@ -0,0 +1,241 @@
+import os, sys, json, time, shutil, hashlib, argparse, fcntl
+from contextlib import contextmanager
+
+
+# ======================================
+#   Content-addressed cache entries
+#
+#   Every cache entry (token store, embedding cache) is a directory named
+#   '{readable name}-{key}', where key is a hash of everything its content depends on
+#   (input file hash, tokenizer vocab/config, encoding parameters, ...).
+#   Changing any of them gives a new entry instead of silently loading a stale one.
+#
+#   {cache_dir}/manifest.json records every entry with its parameters and source files,
+#   entries are built under a per-entry lock and published with a rename,
+#   so many jobs can share one cache directory.
+# ======================================
+
+MANIFEST = 'manifest.json'
+CACHE_PREFIXES = ('cached_', 'embedding_')
+
+_file_hashes = {}
+
+
+def hash_file(path):
+    if os.path.isdir(path):
+        # a directory (e.g. a .cols dataset): names and contents of all its files
+        h = hashlib.sha1()
+        for root, dirs, files in sorted(os.walk(path)):
+            dirs.sort()
+            for name in sorted(files):
+                h.update(os.path.relpath(os.path.join(root, name), path).encode())
+                h.update(hash_file(os.path.join(root, name)).encode())
+        return h.hexdigest()
+
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def hash_tokenizer(tokenizer):
+    # vocab, normalization and special tokens, not just the tokenizer class
+    h = hashlib.sha1(tokenizer.__class__.__name__.encode())
+    if getattr(tokenizer, 'is_fast', False):
+        backend = json.loads(tokenizer.backend_tokenizer.to_str())
+        # truncation/padding are set by every call, not part of the tokenizer itself
+        backend.pop('truncation', None)
+        backend.pop('padding', None)
+        h.update(json.dumps(backend, sort_keys=True).encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def fingerprint_model(path):
+    # ======================================
+    #   what a model loaded from path depends on:
+    #   a local directory (e.g. an encoder snapshot, see snapshot.py) by its json files (config, tokenizer)
+    #   and the size and modification time of its weights, a hub name by the name
+    # ======================================
+    if not os.path.isdir(path):
+        return path
+    files = {}
+    for name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, name)
+        if name.endswith('.json'):
+            files[name] = hash_file(file_path)
+        elif name.endswith(('.safetensors', '.bin', '.pt')):
+            stat = os.stat(file_path)
+            files[name] = [stat.st_size, stat.st_mtime_ns]
+    return {'path': os.path.abspath(path), 'files': files}
+
+
+def get_cache_path(cache_dir, name, params):
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}-{}'.format(name, key))
+
+
+@contextmanager
+def cache_lock(path):
+    # ======================================
+    #   serializes the processes building (or removing) the same cache entry
+    #   remove_cache_entry unlinks the lock file while holding it, so a process that was waiting on it
+    #   may hold a lock on a file that no longer exists; it then locks the current lock file again,
+    #   otherwise it and a process locking a new lock file could both build the entry
+    # ======================================
+    lock_path = path + '.lock'
+    while True:
+        f = open(lock_path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                locked = os.fstat(f.fileno()).st_ino == os.stat(lock_path).st_ino
+            except FileNotFoundError:
+                locked = False
+            if locked:
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                return
+            fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+
+def publish_dir(tmp_path, path):
+    # readers that still have the old files mapped keep them until they close them
+    if os.path.exists(path):
+        old_path = path + '.old-{}'.format(os.getpid())
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(tmp_path, path)
+
+
+def read_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def update_manifest(cache_dir, update_fn):
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    with cache_lock(manifest_path):
+        manifest = read_manifest(cache_dir)
+        update_fn(manifest)
+        tmp_path = manifest_path + '.tmp-{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+
+
+def record_cache_entry(path, params, sources=()):
+    def add(manifest):
+        manifest[os.path.basename(path)] = {
+            'params': params,
+            'sources': {os.path.abspath(source): hash_file(source) for source in sources},
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    update_manifest(os.path.dirname(path), add)
+
+
+def remove_cache_entry(path):
+    with cache_lock(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        # under the lock, see cache_lock
+        os.remove(path + '.lock')
+    update_manifest(os.path.dirname(path), lambda manifest: manifest.pop(os.path.basename(path), None))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def find_garbage(cache_dir):
+    # ======================================
+    #   returns [(name, reason)] of
+    #   - half-written entries of processes that are gone
+    #   - entries that are not in the manifest (e.g. caches written before content-addressed keys)
+    #   - entries whose source files changed or disappeared
+    # ======================================
+    manifest = read_manifest(cache_dir)
+    garbage = []
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.startswith(CACHE_PREFIXES) or name.endswith('.lock'):
+            continue
+
+        for marker in ('.tmp-', '.old-'):
+            if marker in name:
+                pid = name.rsplit(marker, 1)[1]
+                if not pid.isdigit() or not _pid_alive(int(pid)):
+                    garbage.append((name, 'unfinished'))
+                break
+        else:
+            if name not in manifest:
+                garbage.append((name, 'not in manifest'))
+                continue
+            for source, source_hash in manifest[name]['sources'].items():
+                if not os.path.exists(source):
+                    garbage.append((name, 'source {} removed'.format(source)))
+                    break
+                if hash_file(source) != source_hash:
+                    garbage.append((name, 'source {} changed'.format(source)))
+                    break
+    return garbage
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--cache_dir", type=str, default="./cache")
+    parser.add_argument("command", choices=['list', 'gc', 'remove'])
+    parser.add_argument("names", nargs='*')     # entries to remove, all cache entries if empty
+    parser.add_argument("--dry_run", action="store_true")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    manifest = read_manifest(args.cache_dir)
+
+    if args.command == 'list':
+        for name in sorted(manifest):
+            print("{}\t{}\t{}".format(name, manifest[name]['created'], json.dumps(manifest[name]['params'], sort_keys=True)))
+        sys.exit(0)
+
+    if args.command == 'gc':
+        targets = find_garbage(args.cache_dir)
+    else:
+        names = args.names if len(args.names) > 0 else [name for name in os.listdir(args.cache_dir)
+                                                           if name.startswith(CACHE_PREFIXES) and not name.endswith('.lock')]
+        targets = [(name, 'removed by request') for name in names]
+
+    for name, reason in targets:
+        print("*** Removing {} ({})".format(name, reason))
+        if not args.dry_run:
+            remove_cache_entry(os.path.join(args.cache_dir, name))
+
+    if not args.dry_run:
+        # drop records of entries that no longer exist
+        update_manifest(args.cache_dir, lambda m: [m.pop(name) for name in list(m) if not os.path.exists(os.path.join(args.cache_dir, name))])
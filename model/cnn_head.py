@@ -0,0 +1,120 @@
+import torch
+from torch.nn import functional as F
+
+from pooling import stack_conved
+
+
+# ======================================
+#   Conv backends of the CNN heads
+#   - 'conv': nn.Conv2d with kernel (fs, hidden_size) on the unsqueezed (b, 1, seq_len, hidden_size) input
+#   - 'matmul': the same convolution as one matmul of the hidden states against the filters of all sizes
+#               and a sum of shifted slices per filter size (see conv_matmul).
+#               Uses the Conv2d parameters as they are, so checkpoints load for both backends.
+# ======================================
+CONV_BACKENDS = ('conv', 'matmul')
+
+
+def pad_to_min_length(hidden, min_length):
+    # ======================================
+    #   Zero-pads hidden states (batch_size, seq_len, hidden_size) along seq_len up to min_length.
+    #   With dynamically padded batches seq_len can be shorter than the largest filter
+    #   (plus k - 1 for k-max pooling) of a CNN head.
+    # ======================================
+    seq_len = hidden.size(1)
+    if seq_len >= min_length:
+        return hidden
+    return F.pad(hidden, (0, 0, 0, min_length - seq_len))
+
+
+def get_min_length(filter_sizes, pool, k):
+    # shortest input for which every filter gives at least k positions to pool over
+    if pool in ('k-max', 'mix'):
+        return max(filter_sizes) + k - 1
+    return max(filter_sizes)
+
+
+def get_min_positions(pool, k):
+    # positions every sample keeps to pool over
+    return k if pool in ('k-max', 'mix') else 1
+
+
+def trim_to_mask(hidden, attention_mask, min_length):
+    # ======================================
+    #   Trims hidden states (batch_size, seq_len, hidden_size) to the longest real sequence of the batch
+    #   and zeroes the padded positions, so the conv output of a sample doesn't depend on
+    #   how long the other samples of its batch are. attention_mask is right-padded (batch_size, seq_len).
+    #
+    #   OUTPUT
+    #   - hidden: (batch_size, max(longest sequence, min_length), hidden_size)
+    #   - lengths: real tokens per sample (batch_size)
+    # ======================================
+    lengths = attention_mask.sum(dim=1)
+    seq_len = max(int(lengths.max()), 1)
+    hidden = hidden[:, :seq_len] * attention_mask[:, :seq_len].unsqueeze(-1).to(hidden.dtype)
+    return pad_to_min_length(hidden, min_length), lengths
+
+
+def conv_matmul(hidden, weights, biases):
+    # ======================================
+    #   INPUT
+    #   - hidden: (batch_size, seq_len, hidden_size)
+    #   - weights: Conv2d weights [(n_out, 1, fs, hidden_size) * len(filter_sizes)]
+    #   - biases: [(n_out) * len(filter_sizes)]
+    #
+    #   OUTPUT
+    #   - conved: (batch_size, len(filter_sizes), n_out, seq_len - min(fs) + 1), before the activation,
+    #             0 past seq_len - fs + 1 of each filter size (the layout of pooling.pool_stacked)
+    #
+    #   For filter row j, hidden @ weight[:, 0, j, :].T gives its contribution at every position,
+    #   the conv output at position t is the sum of row j's projection at t + j over j < fs.
+    #   All rows of all filters are projected at once: (b * seq_len, hidden_size) x (hidden_size, sum(fs) * n_out)
+    #   and the shifted sums are accumulated in place into the stacked output.
+    # ======================================
+    batch_size, seq_len = hidden.size(0), hidden.size(1)
+    n_out = weights[0].size(0)
+    # (hidden_size, fs * n_out) per filter size, columns ordered by row j, then filter
+    projection = torch.cat([weight.squeeze(1).permute(2, 1, 0).reshape(weight.size(3), -1) for weight in weights], dim=1)
+    projected = torch.matmul(hidden, projection)    # (b, seq_len, sum(fs) * n_out)
+
+    num_positions = seq_len - min(weight.size(2) for weight in weights) + 1
+    conved = projected.new_zeros(batch_size, len(weights), num_positions, n_out)
+    col = 0
+    for i, (weight, bias) in enumerate(zip(weights, biases)):
+        fs = weight.size(2)
+        length = seq_len - fs + 1
+        out = conved[:, i, :length]
+        out += bias
+        for j in range(fs):
+            out += projected[:, j:j + length, col + j * n_out:col + (j + 1) * n_out]
+        col += fs * n_out
+    return conved.transpose(2, 3)   # (b, len(filter_sizes), n_out, num_positions)
+
+
+def run_convs(hidden, convs, backend='conv'):
+    # ======================================
+    #   Conv2d layers of kernel (fs, hidden_size) over hidden (batch_size, seq_len, hidden_size).
+    #   returns (batch_size, len(convs), n_filters, seq_len - min(fs) + 1) before the activation,
+    #   0 past seq_len - fs + 1 of each filter size (see pooling.py)
+    # ======================================
+    return run_conv_weights(hidden, [conv.weight for conv in convs], [conv.bias for conv in convs], backend)
+
+
+def run_conv_weights(hidden, weights, biases, backend='conv'):
+    # run_convs on Conv2d weights [(n_out, 1, fs, hidden_size)] and biases [(n_out)] per filter size,
+    # e.g. the filters of several heads concatenated along n_out
+    if backend == 'conv':
+        hidden = hidden.unsqueeze(1)    # (batch_size, 1, seq_len, hidden_size)
+        return stack_conved([F.conv2d(hidden, weight, bias).squeeze(3) for weight, bias in zip(weights, biases)])
+    elif backend == 'matmul':
+        return conv_matmul(hidden, weights, biases)
+    raise ValueError("Conv backend '{}' is not supported, use one of {}.".format(backend, CONV_BACKENDS))
+
+
+def set_conv_backend(model, backend):
+    # switches every head in model (e.g. a loaded checkpoint) to backend
+    if backend not in CONV_BACKENDS:
+        raise ValueError("Conv backend '{}' is not supported, use one of {}.".format(backend, CONV_BACKENDS))
+    for module in model.modules():
+        if hasattr(module, 'conv_backend'):
+            module.conv_backend = backend
+    return model
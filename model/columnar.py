@@ -0,0 +1,149 @@
+import os, json
+import numpy as np
+
+from cache_utils import publish_dir
+
+
+# ======================================
+#   Sharded columnar format of prepared datasets ({name}.cols directory)
+#   - meta.json: columns {name: dtype}, shards [{name, num_rows}], num_rows
+#   - shard-{i:05d}/{column}.bin: fixed width columns, (num_rows,) of the column dtype
+#   - shard-{i:05d}/{column}.bin + {column}.offsets.bin: 'str' columns,
+#     utf-8 bytes of all rows back to back and (num_rows + 1,) int64 byte offsets
+#
+#   Columns are memory-mapped and only the requested ones are opened,
+#   a row is read without touching the others.
+#   Default columns of prepared datasets: text, label, user (user number in the split), post (post/window index of the user)
+# ======================================
+
+DATASET_COLUMNS = {'text': 'str', 'label': 'int64', 'user': 'int64', 'post': 'int32'}
+SUFFIX = '.cols'
+
+
+class ColumnarWriter(object):
+    def __init__(self, path, columns=None, shard_size=100000):
+        self.path = path
+        self.tmp_path = path + '.tmp-{}'.format(os.getpid())
+        self.columns = dict(columns if columns is not None else DATASET_COLUMNS)
+        self.shard_size = shard_size
+
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.shards = []
+        self.rows = {name: [] for name in self.columns}
+        self.num_pending = 0
+
+    def append(self, row):
+        # row: {column: value}
+        for name in self.columns:
+            self.rows[name].append(row[name])
+        self.num_pending += 1
+        if self.num_pending == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        num_rows = self.num_pending
+        if num_rows == 0:
+            return
+        shard = 'shard-{:05d}'.format(len(self.shards))
+        shard_path = os.path.join(self.tmp_path, shard)
+        os.makedirs(shard_path, exist_ok=True)
+        for name, dtype in self.columns.items():
+            if dtype == 'str':
+                encoded = [value.encode('utf-8') for value in self.rows[name]]
+                offsets = np.concatenate([[0], np.cumsum([len(value) for value in encoded])]).astype(np.int64)
+                with open(os.path.join(shard_path, name + '.bin'), 'wb') as f:
+                    f.write(b''.join(encoded))
+                offsets.tofile(os.path.join(shard_path, name + '.offsets.bin'))
+            else:
+                np.asarray(self.rows[name], dtype=dtype).tofile(os.path.join(shard_path, name + '.bin'))
+        self.shards.append({'name': shard, 'num_rows': num_rows})
+        self.rows = {name: [] for name in self.columns}
+        self.num_pending = 0
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'columns': self.columns,
+                'shards': self.shards,
+                'num_rows': sum(shard['num_rows'] for shard in self.shards),
+            }, f)
+        publish_dir(self.tmp_path, self.path)
+
+
+def _map(path, dtype, size):
+    # np.memmap can't map an empty file
+    if size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(size,))
+
+
+class ColumnarReader(object):
+    def __init__(self, path, columns=None):
+        # columns: the columns to open (projection), all if None
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.columns = list(columns) if columns is not None else list(self.meta['columns'])
+        for name in self.columns:
+            assert name in self.meta['columns'], "{} has no column '{}'".format(path, name)
+
+        self.num_rows = self.meta['num_rows']
+        # first row of every shard
+        self.starts = np.cumsum([0] + [shard['num_rows'] for shard in self.meta['shards']])
+        self.shards = [self._open_shard(shard) for shard in self.meta['shards']]
+
+    def _open_shard(self, shard):
+        shard_path = os.path.join(self.path, shard['name'])
+        arrays = {}
+        for name in self.columns:
+            dtype = self.meta['columns'][name]
+            if dtype == 'str':
+                offsets = _map(os.path.join(shard_path, name + '.offsets.bin'), np.int64, shard['num_rows'] + 1)
+                data = _map(os.path.join(shard_path, name + '.bin'), np.uint8, int(offsets[-1]))
+                arrays[name] = (data, offsets)
+            else:
+                arrays[name] = _map(os.path.join(shard_path, name + '.bin'), dtype, shard['num_rows'])
+        return arrays
+
+    def __len__(self):
+        return self.num_rows
+
+    def _get_row(self, shard, local):
+        row = {}
+        for name in self.columns:
+            array = shard[name]
+            if isinstance(array, tuple):
+                data, offsets = array
+                row[name] = bytes(data[offsets[local]:offsets[local + 1]]).decode('utf-8')
+            else:
+                row[name] = array[local].item()
+        return row
+
+    def get(self, idx):
+        # one row as {column: value}
+        shard_idx = int(np.searchsorted(self.starts, idx, side='right')) - 1
+        return self._get_row(self.shards[shard_idx], idx - self.starts[shard_idx])
+
+    def read_column(self, name):
+        # the whole column: list of str or a numpy array
+        if self.meta['columns'][name] == 'str':
+            values = []
+            for shard in self.shards:
+                data, offsets = shard[name]
+                blob = bytes(data)
+                text = blob.decode('utf-8')
+                bounds = zip(offsets[:-1].tolist(), offsets[1:].tolist())
+                if len(text) == len(blob):
+                    # ascii shard: byte offsets are character offsets, slicing the decoded str is much faster
+                    values += [text[start:end] for start, end in bounds]
+                else:
+                    values += [blob[start:end].decode('utf-8') for start, end in bounds]
+            return values
+        return np.concatenate([np.asarray(shard[name]) for shard in self.shards]) if len(self.shards) > 0 \
+            else np.zeros(0, dtype=self.meta['columns'][name])
+
+    def __iter__(self):
+        for shard, meta in zip(self.shards, self.meta['shards']):
+            for local in range(meta['num_rows']):
+                yield self._get_row(shard, local)
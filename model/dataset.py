@@ -1,188 +1,532 @@
-import os, json
+import os, json, time, itertools
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, default_collate, get_worker_info
+
+from tqdm import tqdm
+
+from token_store import TokenStore, TokenStoreWriter, get_token_dtype
+from cache_utils import hash_file, hash_tokenizer, get_cache_path, cache_lock, record_cache_entry
+from folds import get_corpus_path, get_fold_index_path, read_fold_index
+from columnar import ColumnarReader
+
+
+# external test sets: mode -> (dataset, split) in args.data_path
+EXTERNAL_TEST_SETS = {
+    'rsdd_test': ('rsdd', 'test_concat_long_balanced'),
+    'eRisk2018_test': ('eRisk2018', 'total_long_balanced'),
+}
+
+_tokenize_worker = None
+
+
+def resolve_data_path(path):
+    # prepare_rsdd.py / process_questionnaire.py also write .jsonl and .cols (see columnar.py), used when there is no .json
+    if not os.path.exists(path):
+        for candidate in [path + 'l', os.path.splitext(path)[0] + '.cols']:
+            if os.path.exists(candidate):
+                return candidate
+    return path
+
+
+def _init_tokenize_worker(tokenizer, max_seq_length, dtype, in_pool=True):
+    global _tokenize_worker
+    if in_pool:
+        # every pool process tokenizes its own shard, the rust thread pool would only oversubscribe the cores
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _tokenize_worker = (tokenizer, max_seq_length, dtype)
+
+
+def _tokenize_shard(texts):
+    # ======================================
+    #   Tokenizes without padding, every example keeps its own length.
+    #   Padding (to max_seq_length, or per batch with --dynamic_padding) is done when batches are built.
+    #   returns the flat token ids of the shard and the length of every example
+    # ======================================
+    tokenizer, max_seq_length, dtype = _tokenize_worker
+    input_ids = tokenizer.batch_encode_plus(
+        texts,
+        max_length=max_seq_length,
+        padding=False,
+        truncation='longest_first',
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )['input_ids']
+    lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+    flat = np.fromiter((token for ids in input_ids for token in ids), dtype=dtype, count=int(lengths.sum()))
+    return flat, lengths
+
+
+def iter_shards(examples, shard_size):
+    # (texts, labels) of every shard_size consecutive (text, label) examples
+    examples = iter(examples)
+    while True:
+        shard = list(itertools.islice(examples, shard_size))
+        if not shard:
+            return
+        yield [text for text, _ in shard], [label for _, label in shard]
+
+
+def imap_shards(pool, shards, max_in_flight):
+    # like pool.imap(_tokenize_shard, ...) in order, but reads the next shard only when one of max_in_flight is done
+    # (pool.imap would queue every shard of the file at once)
+    in_flight = deque()
+    for texts, labels in shards:
+        in_flight.append((pool.apply_async(_tokenize_shard, (texts,)), labels))
+        if len(in_flight) >= max_in_flight:
+            result, labels = in_flight.popleft()
+            yield result.get(), labels
+    while in_flight:
+        result, labels = in_flight.popleft()
+        yield result.get(), labels
+
+
+def tokenize_to_store(path, examples, tokenizer, args):
+    # ======================================
+    #   Reads the (text, label) examples in shards of args.shard_size, tokenizes the shards in a process pool
+    #   (args.tokenize_workers, default: all cores) and appends every finished shard to the
+    #   token store in order. examples is consumed lazily (e.g. iter_json_records), so only the
+    #   shards in flight (two per worker) are held in memory, never the whole split.
+    #   Only input_ids are stored: the mask is implied by the length and
+    #   token_type_ids are never passed to the encoder.
+    # ======================================
+    dtype = get_token_dtype(len(tokenizer))
+    writer = TokenStoreWriter(path, keys=['input_ids'], pad_token_id=tokenizer.pad_token_id, dtype=dtype)
+
+    shards = iter_shards(examples, args.shard_size)
+    # no pool for a split of a single shard
+    first_shards = list(itertools.islice(shards, 2))
+    shards = itertools.chain(first_shards, shards)
+    num_workers = args.tokenize_workers if args.tokenize_workers > 0 else os.cpu_count()
+    if len(first_shards) < 2:
+        num_workers = 1
+
+    t0 = time.time()
+    pool = None
+    if num_workers > 1:
+        pool = Pool(num_workers, initializer=_init_tokenize_worker, initargs=(tokenizer, args.max_seq_length, dtype))
+        results = imap_shards(pool, shards, 2 * num_workers)
+    else:
+        _init_tokenize_worker(tokenizer, args.max_seq_length, dtype, in_pool=False)
+        results = ((_tokenize_shard(texts), labels) for texts, labels in shards)
+
+    num_data = 0
+    for (flat, lengths), labels in tqdm(results, desc='tokenize', mininterval=0.01, leave=True):
+        writer.append_arrays({'input_ids': flat}, lengths, labels)
+        num_data += len(lengths)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    writer.close()
+
+    elapsed = max(time.time() - t0, 1e-6)
+    print("*** Tokenized {} examples ({} tokens) with {} worker(s) in {:.1f}s: {:.0f} examples/s, {:.0f} tokens/s".format(
+        num_data, writer.num_tokens, max(num_workers, 1), elapsed, num_data / elapsed, writer.num_tokens / elapsed))
+
+
+class TokenizedDataset(Dataset):
+    # ======================================
+    #   Shared storage of SymptomDataset and DepressionDataset.
+    #   Tokenized examples live in a memory-mapped TokenStore (see token_store.py),
+    #   __getitem__ returns unpadded views into it and PaddingCollator builds the batch.
+    #   A dataset can cover a subset of the stored rows (select), e.g. one fold split of a corpus.
+    # ======================================
+    def init_store(self, args, cache_name, tokenizer, read_examples):
+        # ======================================
+        #   cache_name is only the readable part of the cache directory name,
+        #   the key appended to it covers the input file, the tokenizer and the encoding parameters
+        # ======================================
+        self.dynamic_padding = args.dynamic_padding
+        self.max_seq_length = args.max_seq_length
+        self.pad_token_id = tokenizer.pad_token_id
+
+        cache_params = {
+            'format': 'tokens-v1',
+            'data': hash_file(self.data_path),
+            'tokenizer': hash_tokenizer(tokenizer),
+            'max_seq_length': args.max_seq_length,
+            'truncation': 'longest_first',
+            'num_labels': args.num_labels,
+        }
+        cached_features_file = get_cache_path(
+            args.cache_dir if args.cache_dir is not None else args.data_dir,
+            cache_name,
+            cache_params,
+        ) + '.tokens'
+
+        if args.overwrite_cache or not os.path.exists(cached_features_file):
+            with cache_lock(cached_features_file):
+                # another job may have built it while we were waiting for the lock
+                if args.overwrite_cache or not os.path.exists(cached_features_file):
+                    print("*** Saving features into cached directory {}".format(cached_features_file))
+                    tokenize_to_store(cached_features_file, read_examples(), tokenizer, args)
+                    record_cache_entry(cached_features_file, cache_params, sources=[self.data_path])
+        print("*** Loading features from cached directory {}".format(cached_features_file))
+
+        self.cache_name = cache_name
+        self.cache_params = cache_params
+        self.cached_features_file = cached_features_file
+        self.store = TokenStore(cached_features_file)
+        self.indices = None
+        self.num_data = len(self.store)
+
+    def select(self, indices):
+        # dataset index i -> stored row indices[i]
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.num_data = len(self.indices)
+
+    def get_rows(self, indices):
+        return indices if self.indices is None else self.indices[indices]
+
+    def __len__(self):
+        return self.num_data
+
+    def __getitem__(self, idx):
+        idx = self.get_rows(idx)
+        item = self.store.get(idx)
+        item['labels'] = int(self.store.labels[idx])
+        return item
+
+    def __getitems__(self, indices):
+        # batched fetch used by DataLoader (torch >= 2.0), collate_fn gets the finished batch
+        indices = self.get_rows(np.asarray(indices, dtype=np.int64))
+        batch, lengths = self.store.get_batch(indices, max_length=None if self.dynamic_padding else self.max_seq_length)
+        batch = {key: torch.from_numpy(val) for key, val in batch.items()}
+        batch['labels'] = torch.from_numpy(self.store.labels[indices].astype(np.int64))
+        batch['attention_mask'] = (torch.arange(batch['input_ids'].size(1))[None, :] < torch.from_numpy(lengths)[:, None]).long()
+        return batch
 
-from transformers import AutoTokenizer
+    def get_labels(self):
+        return self.store.labels[self.get_rows(np.arange(self.num_data))].tolist()
 
-from utils import generate_examples
+    def get_lengths(self):
+        return self.store.get_lengths()[self.get_rows(np.arange(self.num_data))].tolist()
 
 
-class SymptomDataset(Dataset):
+class SymptomDataset(TokenizedDataset):
     def __init__(self, args, mode='train', tokenizer=None):
         self.args = args
         self.mode = mode
 
-        cached_features_file = os.path.join(
-            args.cache_dir if args.cache_dir is not None else args.data_dir,
-            "cached_symptom_{}_{}_{}_{}".format(
-                args.task_name,
-                mode,
-                tokenizer.__class__.__name__,
-                str(args.max_seq_length),
-            )
+        self.data_path = resolve_data_path(args.data_path.format( # ./dataset/{}/{}/{}.json
+            'symptom',
+            args.task_name,
+            mode
+        ))
+        cache_name = "cached_symptom_{}_{}_{}_{}".format(
+            args.task_name,
+            mode,
+            tokenizer.__class__.__name__,
+            str(args.max_seq_length),
         )
 
-        if os.path.exists(cached_features_file):
-            print("*** Loading features from cached file {}".format(cached_features_file))
-            self.features = torch.load(cached_features_file)
-            self.num_data = len(self.features['labels'])
-        else:
-            self.data_path = args.data_path.format( # ./dataset/{}/{}/{}.json
-                'symptom',
-                args.task_name,
-                mode
-            )
+        self.init_store(args, cache_name, tokenizer, self.read_examples)
 
-            with open(self.data_path, 'r') as file:
-                self.datas = json.load(file)
-
-            texts, labels = [], []
-            for idx, data in enumerate(self.datas):
-                texts.append(self.datas[data][0])
-                labels.append(self.datas[data][1])
-            assert (idx+1) == len(texts) == len(labels), "the numbers of texts and labels are different!"
-            self.num_data = len(texts)
-            #print(self.num_data)
-
-            examples = generate_examples(mode=self.mode, texta=texts, labels=labels)
-
-            self.label_list = [str(i) for i in range(args.num_labels)]
-            label_map = {label: i for i, label in enumerate(self.label_list)}
-            #print(label_map)
-            self.labels = [label_map[example.label] for example in examples]    # turn labels from str to int
-            self.texts = texts
-
-            self.encodings = tokenizer.batch_encode_plus(
-                [(example.text_a, example.text_b) if example.text_b else example.text_a for example in examples],
-                max_length=args.max_seq_length,
-                padding='max_length',
-                truncation='longest_first',
-                return_tensors="pt",
-            )
+    def read_examples(self):
+        # (text, label) of every example, read lazily from the file
+        self.label_list = [str(i) for i in range(self.args.num_labels)]
+        label_map = {label: i for i, label in enumerate(self.label_list)}
+        #print(label_map)
+        for text, label in iter_json_records(self.data_path):
+            yield text, label_map[str(label)]    # turn labels from str to int
 
-            self.features = self.encodings
-            self.features['labels'] = torch.tensor(self.labels)
-            print("*** Saving features into cached file {}".format(cached_features_file))
-            torch.save(self.features, cached_features_file)
 
-    def __len__(self):
-        return len(self.features['labels'])
-
-    def __getitem__(self, idx):
-        item = {key: val[idx].clone().detach() for key, val in self.features.items()}
-        return item
-
-    def get_labels(self):
-        return self.labels
-
-
-class DepressionDataset(Dataset):
+class DepressionDataset(TokenizedDataset):
     def __init__(self, args, mode='train', tokenizer=None):
         self.args=args
         self.label_list = [str(i) for i in range(args.num_labels)]
         self.mode = mode
+        self.fold_index_path = None
 
+        # train: 167,782 (15,984, 151,789) / valid: 23,968 (2,283, 21,685) / test: 47,938 (4,567, 43,371)
         if mode == 'rsdd_test':
-            cached_features_file = os.path.join(
-                args.cache_dir if args.cache_dir is not None else args.data_dir,
-                "cached_rsdd_test_{}_{}_{}".format(
-                    tokenizer.__class__.__name__,
-                    str(args.max_seq_length),
-                    args.task_name,
-                )
+            self.data_path = resolve_data_path(args.data_path.format(EXTERNAL_TEST_SETS[mode][0], args.task_name, EXTERNAL_TEST_SETS[mode][1]))
+            cache_name = "cached_rsdd_test_{}_{}_{}".format(
+                tokenizer.__class__.__name__,
+                str(args.max_seq_length),
+                args.task_name,
             )
         elif mode == 'eRisk2018_test':
-            cached_features_file = os.path.join(
-                args.cache_dir if args.cache_dir is not None else args.data_dir,
-                "cached_eRisk2018_test_{}_{}_{}".format(
-                    tokenizer.__class__.__name__,
-                    str(args.max_seq_length),
-                    args.task_name,
-                )
+            self.data_path = resolve_data_path(args.data_path.format(EXTERNAL_TEST_SETS[mode][0], args.task_name, EXTERNAL_TEST_SETS[mode][1]))
+            cache_name = "cached_eRisk2018_test_{}_{}_{}".format(
+                tokenizer.__class__.__name__,
+                str(args.max_seq_length),
+                args.task_name,
             )
-        else:
-            cached_features_file = os.path.join(
-                args.cache_dir if args.cache_dir is not None else args.data_dir,
-                "cached_{}_{}_{}_{}_{}".format(
-                    mode,
-                    tokenizer.__class__.__name__,
-                    str(args.max_seq_length),
-                    args.task_name,
-                    str(args.five_fold_num)
-                ),
+        elif os.path.exists(get_corpus_path(args)) and os.path.exists(get_fold_index_path(args)):
+            # the whole corpus is tokenized once, the fold split selects its rows (see folds.py)
+            self.data_path = get_corpus_path(args)
+            self.fold_index_path = get_fold_index_path(args)
+            cache_name = "cached_corpus_{}_{}_{}".format(
+                tokenizer.__class__.__name__,
+                str(args.max_seq_length),
+                args.task_name,
             )
-        
-        if os.path.exists(cached_features_file):
-            print("*** Loading features from cached file {}".format(cached_features_file))
-            self.features = torch.load(cached_features_file)
-            self.num_data=len(self.features['labels'])
-
         else:
-            # train: 167,782 (15,984, 151,789) / valid: 23,968 (2,283, 21,685) / test: 47,938 (4,567, 43,371)
-            if mode == 'rsdd_test':
-                self.data_path = args.data_path.format('rsdd', self.args.task_name, 'test_concat_long_balanced')
-            elif mode == 'eRisk2018_test':
-                self.data_path = args.data_path.format('eRisk2018', self.args.task_name, 'total_long_balanced')
-            else:
-                self.data_path = args.data_path.format(self.args.task_name, str(self.args.five_fold_num), self.mode)
-
-            with open(self.data_path, 'r') as fp:
-                self.datas = json.load(fp)
-
-            texts=[]
-            labels=[]
-
-            for idx, data in enumerate(self.datas):
-                texts.append(self.datas[data][0])
-                labels.append(str(self.datas[data][1]))
-            assert len(texts) == len(labels), "the numbers of texts and labels are different!"
-            self.num_data = len(texts)
-
-            examples = generate_examples(mode=self.mode, texta=texts, labels=labels)
-
-
-            output_mode = "classification"
-            num_labels = args.num_labels
-            label_map = {label: i for i, label in enumerate(self.label_list)}
-            def label_from_example(label):
-                if output_mode == "classification":
-                    return label_map[label]
-                elif output_mode == "regression":
-                    return float(label)
-                raise KeyError(output_mode)
-            self.labels = [label_from_example(example.label) for example in examples]
-            self.texts = texts
-
-
-            self.encodings = tokenizer.batch_encode_plus(
-                [(example.text_a, example.text_b) if example.text_b else example.text_a for example in examples],
-                max_length=args.max_seq_length,
-                padding='max_length',
-                truncation='longest_first',
-                return_tensors="pt",
+            self.data_path = resolve_data_path(args.data_path.format(args.task_name, str(args.five_fold_num), mode))
+            cache_name = "cached_{}_{}_{}_{}_{}".format(
+                mode,
+                tokenizer.__class__.__name__,
+                str(args.max_seq_length),
+                args.task_name,
+                str(args.five_fold_num)
             )
 
-            self.features = self.encodings
-            self.features['labels'] = torch.tensor(self.labels)
-            print("*** Saving features into cached file {}".format(cached_features_file))
-            torch.save(self.features, cached_features_file)
-
+        self.init_store(args, cache_name, tokenizer, self.read_examples)
+        if self.fold_index_path is not None:
+            self.select(read_fold_index(self.fold_index_path, args.five_fold_num, mode))
+
+    def read_examples(self):
+        # (text, label) of every example, read lazily from the file
+        output_mode = "classification"
+        label_map = {label: i for i, label in enumerate(self.label_list)}
+        def label_from_example(label):
+            if output_mode == "classification":
+                return label_map[label]
+            elif output_mode == "regression":
+                return float(label)
+            raise KeyError(output_mode)
+        for text, label in iter_json_records(self.data_path):
+            yield text, label_from_example(str(label))
+
+
+def iter_json_records(path, chunk_size=1 << 20, keep=None):
+    # ======================================
+    #   Yields the [text, label] records of a dataset file without loading the whole file.
+    #   - .cols: rows of the text and label columns
+    #   - .jsonl: one record per line
+    #   - .json: {idx: [text, label], ...}, parsed incrementally with raw_decode,
+    #            only the current chunk of the file is held in memory
+    #   keep: if given, only the records i with keep(i) are yielded. Others are not decoded in .jsonl
+    #         (the line is skipped) and not read in .cols; a .json file has to be parsed completely to find them.
+    # ======================================
+    if os.path.isdir(path):
+        reader = ColumnarReader(path, columns=['text', 'label'])
+        rows = iter(reader) if keep is None else (reader.get(i) for i in range(len(reader)) if keep(i))
+        for row in rows:
+            yield [row['text'], row['label']]
+        return
+
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as f:
+            i = 0
+            for line in f:
+                if line.strip():
+                    if keep is None or keep(i):
+                        yield json.loads(line)
+                    i += 1
+        return
+
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buf = f.read(chunk_size).lstrip()
+        assert buf.startswith('{'), "{} is not a json object".format(path)
+        pos = 1
+        eof = False
+        i = 0
+        while True:
+            # skip whitespace and the separator in front of the next key
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf, pos = f.read(chunk_size), 0
+                eof = len(buf) == 0
+            if pos >= len(buf) or buf[pos] == '}':
+                return
+
+            try:
+                key, end = decoder.raw_decode(buf, pos)
+                while buf[end] in ' \t\r\n:':
+                    end += 1
+                record, end = decoder.raw_decode(buf, end)
+            except (json.JSONDecodeError, IndexError):
+                # the record continues in the next chunk
+                more = f.read(chunk_size)
+                assert len(more) > 0, "unexpected end of {}".format(path)
+                buf, pos = buf[pos:] + more, 0
+                continue
+            if keep is None or keep(i):
+                yield record
+            i += 1
+            pos = end
+
+
+class StreamingDepressionDataset(IterableDataset):
+    # ======================================
+    #   Streams a DepressionDataset file (e.g. rsdd_test, eRisk2018_test) instead of loading it:
+    #   records are read incrementally, tokenized one batch at a time and yielded as finished batches
+    #   (same keys as PaddingCollator), so memory does not depend on the file size.
+    #   build_dataloader runs it in args.stream_workers background processes; with several workers,
+    #   worker k takes every k-th batch and the DataLoader returns them in file order.
+    #   Workers skip the records of the other workers without decoding them in .jsonl and .cols files;
+    #   in the {idx: [text, label]} .json format every worker parses the whole file, so use one worker
+    #   or convert it (prepare_rsdd.py --format jsonl / columnar) to stream with several.
+    #   Nothing is cached, the length is unknown.
+    # ======================================
+    def __init__(self, args, mode='rsdd_test', tokenizer=None):
+        self.args = args
+        self.mode = mode
+        self.tokenizer = tokenizer
+        self.batch_size = args.batch_size
+        self.max_seq_length = args.max_seq_length
+        self.dynamic_padding = args.dynamic_padding
+        self.num_workers = args.stream_workers
+        self.label_map = {str(i): i for i in range(args.num_labels)}
+
+        if mode in EXTERNAL_TEST_SETS:
+            self.data_path = resolve_data_path(args.data_path.format(EXTERNAL_TEST_SETS[mode][0], args.task_name, EXTERNAL_TEST_SETS[mode][1]))
+        else:
+            self.data_path = resolve_data_path(args.data_path.format(args.task_name, str(args.five_fold_num), mode))
+        print("*** Streaming examples from {}".format(self.data_path))
+
+    def iter_chunks(self, worker_id=0, num_workers=1):
+        # the batches of worker_id: batch i (records i * batch_size ...) goes to worker i % num_workers
+        keep = None
+        if num_workers > 1:
+            keep = lambda idx: (idx // self.batch_size) % num_workers == worker_id
+        texts, labels = [], []
+        for text, label in iter_json_records(self.data_path, keep=keep):
+            texts.append(text)
+            labels.append(self.label_map[str(label)])
+            if len(texts) == self.batch_size:
+                yield texts, labels
+                texts, labels = [], []
+        if len(texts) > 0:
+            yield texts, labels
+
+    def encode(self, texts, labels):
+        encodings = self.tokenizer(
+            texts,
+            max_length=self.max_seq_length,
+            padding='longest' if self.dynamic_padding else 'max_length',
+            truncation='longest_first',
+            return_token_type_ids=False,
+            return_tensors='pt',
+        )
+        return {
+            'input_ids': encodings['input_ids'],
+            'attention_mask': encodings['attention_mask'],
+            'labels': torch.tensor(labels),
+        }
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for texts, labels in self.iter_chunks(worker_id, num_workers):
+            yield self.encode(texts, labels)
+
+
+class PaddingCollator(object):
+    # ======================================
+    #   Builds int64 batch tensors from unpadded examples.
+    #   Pads to max_length if given, otherwise to the longest example of the batch,
+    #   and derives the attention mask from the example lengths.
+    # ======================================
+    def __init__(self, pad_token_id=0, max_length=None):
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+
+    def __call__(self, batch):
+        if isinstance(batch, dict):
+            return batch    # already batched by __getitems__
+
+        lengths = np.array([len(item['input_ids']) for item in batch])
+        seq_len = self.max_length if self.max_length is not None else int(lengths.max())
+
+        collated = {}
+        for key in batch[0].keys():
+            if key == 'labels':
+                collated[key] = torch.tensor([item[key] for item in batch])
+                continue
+            padding_value = self.pad_token_id if key == 'input_ids' else 0
+            padded = np.full((len(batch), seq_len), padding_value, dtype=np.int64)
+            for i, item in enumerate(batch):
+                padded[i, :lengths[i]] = item[key]
+            collated[key] = torch.from_numpy(padded)
+
+        collated['attention_mask'] = torch.from_numpy((np.arange(seq_len)[None, :] < lengths[:, None]).astype(np.int64))
+        return collated
+
+
+class LengthBucketBatchSampler(Sampler):
+    # ======================================
+    #   Groups examples of similar length into the same batch.
+    #   The (shuffled) indices are cut into pools of batch_size * bucket_size examples,
+    #   each pool is sorted by length and split into batches, then the batch order is shuffled.
+    # ======================================
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * bucket_size
+
+    def __iter__(self):
+        num_data = len(self.lengths)
+        order = torch.randperm(num_data).tolist() if self.shuffle else list(range(num_data))
+
+        batches = []
+        for start in range(0, num_data, self.pool_size):
+            pool = sorted(order[start:start + self.pool_size], key=lambda i: self.lengths[i])
+            batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
 
     def __len__(self):
-        return len(self.features['labels'])
-    
-
-    def __getitem__(self,idx):
-        item = {key: val[idx].clone().detach() for key, val in self.features.items()}
-        return item
-
-    def get_labels(self):
-        return self.labels
-
+        num_data = len(self.lengths)
+        num_batches = 0
+        for start in range(0, num_data, self.pool_size):
+            pool_len = min(self.pool_size, num_data - start)
+            num_batches += (pool_len + self.batch_size - 1) // self.batch_size
+        return num_batches
+
+
+def collate_batch(batch):
+    # datasets with __getitems__ hand over an already batched dict
+    if isinstance(batch, dict):
+        return batch
+    return default_collate(batch)
+
+
+def build_dataloader(dataset, batch_size, shuffle, bucketing=True):
+    if isinstance(dataset, StreamingDepressionDataset):
+        # the dataset yields finished batches, read and tokenized ahead in background workers
+        return DataLoader(
+            dataset=dataset,
+            batch_size=None,
+            num_workers=dataset.num_workers,
+            pin_memory=True,
+        )
 
+    if isinstance(dataset, TokenizedDataset):
+        collate_fn = PaddingCollator(dataset.pad_token_id, max_length=None if dataset.dynamic_padding else dataset.max_seq_length)
+    else:
+        collate_fn = collate_batch
+
+    if getattr(dataset, 'dynamic_padding', False) and bucketing:
+        return DataLoader(
+            dataset=dataset,
+            batch_sampler=LengthBucketBatchSampler(dataset.get_lengths(), batch_size, shuffle=shuffle),
+            collate_fn=collate_fn,
+            pin_memory=True,
+        )
+    return DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        collate_fn=collate_fn,
+        pin_memory=True,
+    )
 
 
 if __name__ == '__main__':
+    from transformers import AutoTokenizer
     from train import get_args
     args = get_args()
     ds = DepressionDataset(
@@ -193,7 +537,7 @@ if __name__ == '__main__':
             cache_dir=args.cache_dir,
         ),
     )
-    dl = DataLoader(ds, batch_size=args.batch_size)
+    dl = build_dataloader(ds, args.batch_size, shuffle=False)
     d = next(iter(dl))
 
     symp_ds = SymptomDataset(
@@ -204,8 +548,8 @@ if __name__ == '__main__':
             cache_dir=args.cache_dir,
         ),
     )
-    symp_dl = DataLoader(symp_ds, batch_size=args.batch_size)
+    symp_dl = build_dataloader(symp_ds, args.batch_size, shuffle=False)
     symp_d = next(iter(dl))
 
     import IPython; IPython.embed(); exit(1)
-    #collections.Counter(ds.features['labels'].cpu().detach().numpy())
+    #collections.Counter(ds.get_labels())
@@ -0,0 +1,134 @@
+import math, zlib
+import numpy as np
+
+
+# ======================================
+#   Near-duplicate detection with MinHash + LSH
+#
+#   MinHasher: text -> one 64-bit key per LSH band.
+#       word shingles (shingle_size words, crc32) are min-hashed with num_bands * rows
+#       universal hashes (a * x + b) mod p, every band of rows values is folded into one key.
+#       Two texts with Jaccard similarity s share a band key with probability 1 - (1 - s^rows)^num_bands
+#       (bands=8, rows=8: ~0.01 at s=0.5, ~0.9 at s=0.9), exact duplicates always do.
+#   LSHBloomIndex: the band keys seen so far in scalable Bloom filters (one bit array per band),
+#       so memory grows with the number of texts, not with their size.
+#       A text is a duplicate when one of its band keys was seen before.
+#       The first filter holds capacity texts; when it is full a filter twice as large with half the
+#       error rate is added, and so on, so the false positive rate stays bounded however many texts come.
+#       A text is falsely dropped if any of its num_bands keys is a false positive, so error_rate is the
+#       bound of that per-text rate: every band of all filters together gets error_rate / num_bands.
+# ======================================
+
+_PRIME = np.uint64(4294967291)  # largest prime < 2^32, (a * x + b) stays below 2^64
+_FOLD = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+class MinHasher(object):
+    def __init__(self, num_bands=8, rows=8, shingle_size=3, seed=1):
+        self.num_bands = num_bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        # the same seed gives the same hashes in every process
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, int(_PRIME), size=(num_bands * rows, 1), dtype=np.uint64)
+        self.b = rng.randint(0, int(_PRIME), size=(num_bands * rows, 1), dtype=np.uint64)
+
+    def shingles(self, text):
+        words = text.lower().split()
+        if len(words) <= self.shingle_size:
+            grams = [' '.join(words)]
+        else:
+            grams = [' '.join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+        return np.unique(np.array([zlib.crc32(gram.encode('utf-8')) for gram in grams], dtype=np.uint64))
+
+    def band_keys(self, text):
+        # (num_bands,) uint64
+        signature = ((self.a * self.shingles(text)[None, :] + self.b) % _PRIME).min(axis=1)
+        bands = signature.reshape(self.num_bands, self.rows)
+        keys = np.zeros(self.num_bands, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for j in range(self.rows):
+                keys = keys * _FOLD + bands[:, j]    # wraps around mod 2^64
+        return keys
+
+
+class BloomFilters(object):
+    # one Bloom filter per band, for capacity texts at error_rate false positives per band
+    def __init__(self, num_bands, capacity, error_rate):
+        self.capacity = capacity
+        self.num_texts = 0
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = np.zeros((num_bands, (self.num_bits + 7) // 8), dtype=np.uint8)
+        self.band_idx = np.arange(num_bands)[:, None]
+        self.offsets = (np.arange(1, self.num_hashes + 1, dtype=np.uint64) * _FOLD)[None, :]
+
+    def positions(self, keys):
+        # ======================================
+        #   every hash is its own splitmix64 mix of the key. Double hashing (h1 + i * h2) mod num_bits
+        #   puts all hashes on one bit when h2 is a multiple of num_bits and gives only num_bits^2
+        #   different patterns, both raise the false positive rate well above error_rate in small filters.
+        # ======================================
+        with np.errstate(over='ignore'):
+            z = keys[:, None] + self.offsets
+            z = (z ^ (z >> np.uint64(30))) * _MIX1
+            z = (z ^ (z >> np.uint64(27))) * _MIX2
+            z = z ^ (z >> np.uint64(31))
+            positions = (z % np.uint64(self.num_bits)).astype(np.int64)  # (num_bands, num_hashes)
+        return positions >> 3, np.left_shift(np.uint8(1), (positions & 7).astype(np.uint8))
+
+    def contains(self, keys):
+        # (num_bands,) bool: band key seen before
+        byte_idx, masks = self.positions(keys)
+        return ((self.bits[self.band_idx, byte_idx] & masks) != 0).all(axis=1)
+
+    def insert(self, keys):
+        byte_idx, masks = self.positions(keys)
+        np.bitwise_or.at(self.bits, (np.broadcast_to(self.band_idx, byte_idx.shape), byte_idx), masks)
+        self.num_texts += 1
+
+
+class LSHBloomIndex(object):
+    GROWTH = 2      # capacity of every new filter relative to the previous one
+    TIGHTENING = 0.5    # error rate of every new filter relative to the previous one
+
+    def __init__(self, num_bands=8, capacity=5000000, error_rate=1e-3):
+        # ======================================
+        #   capacity: texts of the first filter, more are added as needed
+        #   error_rate: bound of the probability that a new text is taken for a duplicate
+        # ======================================
+        self.num_bands = num_bands
+        # the error rates of the filters sum up to error_rate / num_bands per band
+        self.first_error_rate = error_rate / num_bands * (1 - self.TIGHTENING)
+        self.filters = [BloomFilters(num_bands, capacity, self.first_error_rate)]
+
+        self.num_texts = 0
+        self.num_duplicates = 0
+
+    def add(self, keys):
+        # ======================================
+        #   Checks and inserts the band keys of one text.
+        #   returns True if the text is a (near-)duplicate of a text added before
+        # ======================================
+        seen = np.zeros(self.num_bands, dtype=bool)
+        for bloom in self.filters:
+            seen |= bloom.contains(keys)
+        duplicate = bool(seen.any())
+
+        current = self.filters[-1]
+        if current.num_texts >= current.capacity:
+            current = BloomFilters(self.num_bands, current.capacity * self.GROWTH,
+                                   self.first_error_rate * self.TIGHTENING ** len(self.filters))
+            self.filters.append(current)
+            print("*** dedup index: {} texts, added a filter for {} more".format(self.num_texts, current.capacity))
+        current.insert(keys)
+
+        self.num_texts += 1
+        self.num_duplicates += int(duplicate)
+        return duplicate
+
+    def memory(self):
+        # bytes of all filters
+        return sum(bloom.bits.nbytes for bloom in self.filters)
@@ -2,19 +2,12 @@ import torch, sys
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
-from transformers import (
-    AutoTokenizer,
-    AutoModel,
-    get_linear_schedule_with_warmup,
-)
-from tqdm import tqdm
 
 sys.path.insert(0, './')
 sys.path.insert(0, './../')
-from bert_model import BertModelforBaseline, get_batch_bert_embedding
-from dataset import DepressionDataset
 from questionnaire.questionnaire_model import QuestionnaireModel
+from cnn_head import pad_to_min_length, get_min_length, run_convs, run_conv_weights, trim_to_mask, get_min_positions
+from pooling import get_num_valid, mask_stacked, pool_stacked
 
 class DiseaseModel(nn.Module):
     def __init__(self, hidden_dim=5, n_filters=50, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.2, num_symptom=None, pool='k-max', k=5):
@@ -22,6 +15,9 @@ class DiseaseModel(nn.Module):
 
         self.hidden_dim = hidden_dim
         self.n_filters = n_filters
+        self.num_symptom = num_symptom
+        self.k = k
+        self.kernel_sizes = list(filter_sizes)  # as given, self.filter_sizes are cut to num_symptom
         self.filter_sizes = []
         for fs in filter_sizes:
             f = fs if fs <= num_symptom else num_symptom
@@ -68,6 +64,12 @@ class DiseaseModel(nn.Module):
             nn.init.xavier_normal_(m.weight)
             m.bias.data.fill_(0.1)
 
+    def get_config(self):
+        # the arguments to build this head again, for weights-only snapshots (see snapshot.py)
+        return {'hidden_dim': self.hidden_dim, 'n_filters': self.n_filters, 'filter_sizes': self.kernel_sizes,
+                'output_dim': self.output_dim, 'dropout': self.dropout_p, 'num_symptom': self.num_symptom,
+                'pool': self.pool, 'k': self.k}
+
     def forward(self, question_model_output):
         # ====================================
         #   INPUT
@@ -79,24 +81,11 @@ class DiseaseModel(nn.Module):
         #   - concat: hidden layer of symptom model
         #               for max pool, (b, max_k * n_filters * len(filter_sizes))
         # ====================================
-        question_model_output = question_model_output.unsqueeze(1)  # (BATCH_SIZE, 1, NUM_SYMPTOM, HIDDEN_DIM)
-        conved = [F.relu(conv(question_model_output)).squeeze(3) for conv in self.convs]  # [(b, out_channel (n_filters), H) * len(filter_sizes)]
-                                                                                        # H = NUM_SYMPTOM - kernel_size(fs) + 1
-        if self.pool == 'max':
-            pooled = [F.max_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]
-        elif self.pool == 'k-max':
-            batch_size = question_model_output.size(0)
-            pooled = [conv.topk(tk, dim=2)[0].view(batch_size, -1) for conv, tk in zip(conved, self.max_k)] # [(b, tk * out_channels) * len(filter_sizes)]
-        elif self.pool == 'mix':
-            batch_size = question_model_output.size(0)
-            pooled = [torch.cat([conv.topk(tk, dim=2)[0].view(batch_size, -1),
-                                 conv.topk(tk, dim=2, largest=False)[0].view(batch_size, -1)], dim=1) for conv, tk in zip(conved, self.max_k)]
-        elif self.pool == 'avg':
-            pooled = [F.avg_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]
-        else:
-            raise ValueError('This pooling method is not supported.')
-
-        concat = torch.cat(pooled, dim=1)  # (b,  total_k * n_filters)
+        conved = F.relu(run_convs(question_model_output, self.convs))  # (b, len(filter_sizes), out_channel (n_filters), H)
+                                                                        # H = NUM_SYMPTOM - min(kernel_size) + 1
+        # Pooling Layer (all filter sizes at once, see pooling.py)
+        num_valid = get_num_valid(self.filter_sizes, question_model_output.size(1))
+        concat = pool_stacked(conved, num_valid, self.pool, self.max_k)  # (b,  total_k * n_filters)
         concat = self.dropout(concat)
         output = self.fc(concat)  # (b, max_k * n_filters*len(filter_sizes)) -> (b, output_dim)
 
@@ -109,7 +98,10 @@ class DiseaseModel(nn.Module):
 
 
 class DiseaseAfterBertModel(nn.Module):
-    def __init__(self, embedding_dim=768, n_filters=50, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.5, pool='k-max', k=5):
+    # class level default, so models pickled before conv backends existed run as before
+    conv_backend = 'conv'
+
+    def __init__(self, embedding_dim=768, n_filters=50, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.5, pool='k-max', k=5, conv_backend='conv'):
         # =================================================
         # ARGUMENTS
         # - embedding_dim (int): embedding dimension of bert output (default: 768)
@@ -118,6 +110,7 @@ class DiseaseAfterBertModel(nn.Module):
         # - output_dim (int): output dimension after fc layer
         # - pool (str): pooling method
         #               supported methods are {'max', 'k-max', 'mix', 'avg'}
+        # - conv_backend (str): 'conv' or 'matmul' (see cnn_head.py)
         # =================================================
 
         super().__init__()
@@ -129,6 +122,7 @@ class DiseaseAfterBertModel(nn.Module):
         self.dropout_p = dropout
         self.pool = pool
         self.max_k = k
+        self.conv_backend = conv_backend
 
         # CNN Layers
         self.convs = nn.ModuleList(
@@ -157,11 +151,19 @@ class DiseaseAfterBertModel(nn.Module):
             nn.init.xavier_normal_(m.weight)
             m.bias.data.fill_(0.1)
 
-    def forward(self, bert_encoded_output):
+    def get_config(self):
+        # the arguments to build this head again, for weights-only snapshots (see snapshot.py)
+        return {'embedding_dim': self.embedding_dim, 'n_filters': self.n_filters, 'filter_sizes': list(self.filter_sizes),
+                'output_dim': self.output_dim, 'dropout': self.dropout_p, 'pool': self.pool, 'k': self.max_k,
+                'conv_backend': self.conv_backend}
+
+    def forward(self, bert_encoded_output, attention_mask=None):
         # ======================================
         #   INPUT
         #   - bert_encoded_output: 'last_hidden_layer' of bert output
         #                           (batch_size, seq_len = MAX_LEN, hidden_size = embedding_dim)
+        #   - attention_mask: (batch_size, seq_len) or None. If given, the batch is trimmed to its longest sequence
+        #                     and only the positions of real tokens are pooled (see cnn_head.py)
         #
         #   OUTPUT
         #   - output: Probability vector for presence of the symptom
@@ -170,27 +172,21 @@ class DiseaseAfterBertModel(nn.Module):
         #               for max pool, (b, n_filters*len(filter_sizes))
         # ======================================
         # bert_encoded_output (batch_size, seq_len=MAX_LEN, hid_size=embedding_dim)
-        bert_encoded_output = bert_encoded_output.unsqueeze(1)  # (batch_size, 1, seq_len, hidden_size)
-
-        # CNN (kernel size = (2, 3, 4, 5, 6)) and relu)
-        conved = [F.relu(conv(bert_encoded_output)).squeeze(3) for conv in self.convs]  # [(b, n_filters, H) * 5]
-                                                                                        # H = seq_len - kernel_size(fs) + 1
-        # Pooling Layer
-        if self.pool == 'max':
-            pooled = [F.max_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]  # [(b, n_filters) * len(filter_sizes)]
-        elif self.pool == "k-max":
-            batch_size = bert_encoded_output.size(0)
-            pooled = [conv.topk(self.max_k, dim=2)[0].view(batch_size, -1) for conv in conved]
-        elif self.pool == "mix":
-            batch_size = bert_encoded_output.size(0)
-            pooled = [torch.cat([conv.topk(self.max_k, dim=2)[0].view(batch_size, -1),
-                                 conv.topk(self.max_k, dim=2, largest=False)[0].view(batch_size, -1)], dim=1) for conv in conved]
-        elif self.pool == "avg":
-            pooled = [F.avg_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]
+        min_length = get_min_length(self.filter_sizes, self.pool, self.max_k)
+        lengths = None
+        if attention_mask is not None:
+            bert_encoded_output, lengths = trim_to_mask(bert_encoded_output, attention_mask, min_length)
         else:
-            raise ValueError("This kernel is currently not supported.")
+            bert_encoded_output = pad_to_min_length(bert_encoded_output, min_length)
 
-        concat = torch.cat(pooled, dim=1)   # (b, n_filters*len(filter_sizes))
+        # CNN (kernel size = (2, 3, 4, 5, 6)) and relu)
+        conved = F.relu(run_convs(bert_encoded_output, self.convs, self.conv_backend))  # (b, 5, n_filters, H), all filter sizes stacked
+                                                                                        # H = seq_len - min(kernel_size) + 1
+        # Pooling Layer (all filter sizes at once, see pooling.py)
+        num_valid = get_num_valid(self.filter_sizes, bert_encoded_output.size(1), lengths, get_min_positions(self.pool, self.max_k))
+        if lengths is not None:
+            conved = mask_stacked(conved, num_valid)
+        concat = pool_stacked(conved, num_valid, self.pool, self.max_k)   # (b, n_filters*len(filter_sizes))
         concat = self.dropout(concat)
         output = self.fc(concat)   # (b, n_filters*len(filter_sizes)) -> (b, output_dim)
 
@@ -203,12 +199,18 @@ class DiseaseAfterBertModel(nn.Module):
 
 
 class DiseaseModelfor2Inputs(nn.Module):
-    def __init__(self, embedding_dim=768, hidden_dim=5, n_filters=50, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.2, num_symptom=None, pool='k-max', k=5):
+    # class level default, so models pickled before conv backends existed run as before
+    conv_backend = 'conv'
+
+    def __init__(self, embedding_dim=768, hidden_dim=5, n_filters=50, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.2, num_symptom=None, pool='k-max', k=5, conv_backend='conv'):
         super().__init__()
 
         self.embedding_dim = embedding_dim
         self.hidden_dim = hidden_dim
         self.n_filters = n_filters
+        self.num_symptom = num_symptom
+        self.k = k
+        self.kernel_sizes = list(filter_sizes)  # as given, self.filter_sizes are cut to num_symptom
         self.filter_sizes = []
         for fs in filter_sizes:
             f = fs if fs <= num_symptom else num_symptom
@@ -218,6 +220,7 @@ class DiseaseModelfor2Inputs(nn.Module):
         self.pool = pool
         self.output_dim = output_dim
         self.max_k = []
+        self.conv_backend = conv_backend    # 'conv' or 'matmul' (see cnn_head.py)
 
         self.bert_convs = nn.ModuleList(
             [nn.Conv2d(in_channels=1, out_channels=self.n_filters, kernel_size=(fs, self.embedding_dim)) for fs in self.filter_sizes]
@@ -261,10 +264,18 @@ class DiseaseModelfor2Inputs(nn.Module):
             nn.init.xavier_normal_(m.weight)
             m.bias.data.fill_(0.1)
 
-    def forward(self, bert_output, question_output):
+    def get_config(self):
+        # the arguments to build this head again, for weights-only snapshots (see snapshot.py)
+        return {'embedding_dim': self.embedding_dim, 'hidden_dim': self.hidden_dim, 'n_filters': self.n_filters,
+                'filter_sizes': self.kernel_sizes, 'output_dim': self.output_dim, 'dropout': self.dropout_p,
+                'num_symptom': self.num_symptom, 'pool': self.pool, 'k': self.k, 'conv_backend': self.conv_backend}
+
+    def forward(self, bert_output, question_output, attention_mask=None):
         # ====================================
         #   INPUT
         #   - question_model_output: (BATCH_SIZE, NUM_SYMPTOM, HIDDEN_DIM)
+        #   - attention_mask: (BATCH_SIZE, seq_len) of bert_output or None. If given, bert_output is trimmed to the longest
+        #                     sequence and only the positions of real tokens are pooled (see cnn_head.py)
         #
         #   OUTPUT
         #   - output: Probability vector for presence of the symptom
@@ -272,32 +283,24 @@ class DiseaseModelfor2Inputs(nn.Module):
         #   - concat: hidden layer of symptom model
         #               for max pool, (b, max_k * n_filters * len(filter_sizes))
         # ====================================
-        bert_output = bert_output.unsqueeze(1)
-        question_output = question_output.unsqueeze(1)  # (BATCH_SIZE, 1, NUM_SYMPTOM, HIDDEN_DIM)
+        lengths = None
+        if attention_mask is not None:
+            bert_output, lengths = trim_to_mask(bert_output, attention_mask, max(self.filter_sizes))
+        else:
+            bert_output = pad_to_min_length(bert_output, max(self.filter_sizes))   # bert output is always max pooled
 
-        bert_conved = [F.relu(conv(bert_output)).squeeze(3) for conv in self.bert_convs]
-        question_conved = [F.relu(conv(question_output)).squeeze(3) for conv in self.question_convs]  # [(b, out_channel (n_filters), H) * len(filter_sizes)]
+        bert_conved = F.relu(run_convs(bert_output, self.bert_convs, self.conv_backend))
+        question_conved = F.relu(run_convs(question_output, self.question_convs, self.conv_backend))  # (b, len(filter_sizes), out_channel (n_filters), H)
 
-        # polling layer for bert model output
-        b_pooled = [F.max_pool1d(conv, conv.shape[2]).squeeze(2) for conv in bert_conved]    # [(b, n_filters) * 5]
+        # polling layer for bert model output (all filter sizes at once, see pooling.py)
+        b_num_valid = get_num_valid(self.filter_sizes, bert_output.size(1), lengths)
+        if lengths is not None:
+            bert_conved = mask_stacked(bert_conved, b_num_valid)
+        b_concat = pool_stacked(bert_conved, b_num_valid, 'max')   # (b, n_filters*len(filter_sizes)) = (b, 250)
 
         # pooling layer for question model output                                                                                # H = NUM_SYMPTOM - kernel_size(fs) + 1
-        if self.pool == 'max':
-            q_pooled = [F.max_pool1d(conv, conv.shape[2]).squeeze(2) for conv in question_conved]
-        elif self.pool == 'k-max':
-            batch_size = question_output.size(0)
-            q_pooled = [conv.topk(tk, dim=2)[0].view(batch_size, -1) for conv, tk in zip(question_conved, self.max_k)] # [(b, tk * out_channels) * len(filter_sizes)]
-        elif self.pool == 'mix':
-            batch_size = question_output.size(0)
-            q_pooled = [torch.cat([conv.topk(tk, dim=2)[0].view(batch_size, -1),
-                                 conv.topk(tk, dim=2, largest=False)[0].view(batch_size, -1)], dim=1) for conv, tk in zip(question_conved, self.max_k)]
-        elif self.pool == 'avg':
-            q_pooled = [F.avg_pool1d(conv, conv.shape[2]).squeeze(2) for conv in question_conved]
-        else:
-            raise ValueError('This pooling method is not supported.')
-
-        b_concat = torch.cat(b_pooled, dim=1)   # (b, n_filters*len(filter_sizes)) = (b, 250)
-        q_concat = torch.cat(q_pooled, dim=1)  # (b,  total_k * n_filters)
+        q_num_valid = get_num_valid(self.filter_sizes, question_output.size(1))
+        q_concat = pool_stacked(question_conved, q_num_valid, self.pool, self.max_k)  # (b,  total_k * n_filters)
         concat = torch.cat([b_concat, q_concat], dim=-1)    # (b, total_k*n_filters+5)
         concat = self.dropout(concat)
         output = self.fc(concat)  # (b, max_k * n_filters*len(filter_sizes)+5) -> (b, output_dim)
@@ -310,7 +313,87 @@ class DiseaseModelfor2Inputs(nn.Module):
         return output, concat
 
 
+class DiseaseReplicas(nn.Module):
+    def __init__(self, replicas):
+        # =================================================
+        # ARGUMENTS
+        # - replicas (list): DiseaseAfterBertModel or DiseaseModelfor2Inputs heads of the same configuration,
+        #                    e.g. one per seed, trained side by side on the same encoder output
+        #
+        # The replicas keep their own parameters (self.replicas), so each one is saved and loaded as a single head.
+        # forward runs them as one head, as QuestionnaireModel.forward_fused does for the symptoms:
+        # the filters of all replicas go through one conv per filter size, the pooling is one pool_stacked call
+        # and the fc layers one batched matmul.
+        # =================================================
+        super().__init__()
+        self.replicas = nn.ModuleList(replicas)
+        self.num_replicas = len(replicas)
+
+    def run_convs(self, hidden, convs, backend):
+        # convs: the ModuleList of one conv layer per filter size of every replica
+        # returns (b, num_replicas, len(filter_sizes), n_filters, H) after relu
+        weights = [torch.cat([replica_convs[i].weight for replica_convs in convs]) for i in range(len(convs[0]))]
+        biases = [torch.cat([replica_convs[i].bias for replica_convs in convs]) for i in range(len(convs[0]))]
+        conved = F.relu(run_conv_weights(hidden, weights, biases, backend))  # (b, len(fs), num_replicas * n_filters, H)
+        return conved.view(hidden.size(0), len(weights), self.num_replicas, -1, conved.size(-1)).transpose(1, 2)
+
+    def forward(self, bert_output, question_output=None, attention_mask=None):
+        # ====================================
+        #   INPUT
+        #   - bert_output: (BATCH_SIZE, seq_len, EMB_DIM), shared by all replicas
+        #   - question_output: (BATCH_SIZE, NUM_SYMPTOM, HIDDEN_DIM) for DiseaseModelfor2Inputs replicas
+        #   - attention_mask: (BATCH_SIZE, seq_len) of bert_output or None, as for the single heads
+        #
+        #   OUTPUT
+        #   - output: (BATCH_SIZE, num_replicas, output_dim), the output of every replica
+        #   - concat: (BATCH_SIZE, num_replicas, hidden), the hidden layer of every replica
+        # ====================================
+        first = self.replicas[0]
+        two_inputs = isinstance(first, DiseaseModelfor2Inputs)
+        # bert output is always max pooled by DiseaseModelfor2Inputs
+        pool, k = ('max', 1) if two_inputs else (first.pool, first.max_k)
+
+        min_length = get_min_length(first.filter_sizes, pool, k)
+        lengths = None
+        if attention_mask is not None:
+            bert_output, lengths = trim_to_mask(bert_output, attention_mask, min_length)
+        else:
+            bert_output = pad_to_min_length(bert_output, min_length)
+
+        bert_convs = [replica.bert_convs if two_inputs else replica.convs for replica in self.replicas]
+        conved = self.run_convs(bert_output, bert_convs, first.conv_backend)
+        num_valid = get_num_valid(first.filter_sizes, bert_output.size(1), lengths, get_min_positions(pool, k))
+        if lengths is not None:
+            num_valid = num_valid.unsqueeze(1)  # (b, 1, len(fs)), the same for every replica
+            conved = mask_stacked(conved, num_valid)
+        concat = pool_stacked(conved, num_valid, pool, k)  # (b, num_replicas, hidden)
+
+        if two_inputs:
+            question_conved = self.run_convs(question_output, [replica.question_convs for replica in self.replicas], first.conv_backend)
+            q_num_valid = get_num_valid(first.filter_sizes, question_output.size(1))
+            q_concat = pool_stacked(question_conved, q_num_valid, first.pool, first.max_k)
+            concat = torch.cat([concat, q_concat], dim=-1)
+        concat = first.dropout(concat)
+
+        fc_weight = torch.stack([replica.fc.weight for replica in self.replicas])  # (num_replicas, output_dim, hidden)
+        fc_bias = torch.stack([replica.fc.bias for replica in self.replicas])      # (num_replicas, output_dim)
+        output = torch.einsum('brh,roh->bro', concat, fc_weight) + fc_bias
+
+        if first.output_dim == 1:
+            output = torch.sigmoid(output)
+        else:
+            output = torch.softmax(output, dim=2)
+
+        return output, concat
+
+
 if __name__ == '__main__':
+    # only the demo below needs the encoder and the data
+    from torch.utils.data import DataLoader
+    from transformers import AutoTokenizer, AutoModel, get_linear_schedule_with_warmup
+    from tqdm import tqdm
+    from bert_model import BertModelforBaseline, get_batch_bert_embedding
+    from dataset import DepressionDataset
     from train_question_model import get_args
 
     args = get_args()
@@ -0,0 +1,202 @@
+import os, json, time, copy
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from bert_model import get_batch_bert_embedding
+from dataset import DepressionDataset, build_dataloader
+from cache_utils import get_cache_path, cache_lock, publish_dir, record_cache_entry, fingerprint_model
+
+
+def get_embedding_cache_path(args, dataset):
+    # ======================================
+    #   keyed on the token store the embeddings are computed from
+    #   (its key covers the data file and the tokenizer) and on the encoder.
+    #   The encoder is the one load_bert_model loads (--encoder_path if given); a local one is
+    #   keyed on its files as well, so a new or finetuned snapshot in the same directory gets a new cache.
+    #   Fold splits of one corpus share the token store and so the embedding cache.
+    # ======================================
+    params = {
+        'format': 'embedding-v2',
+        'tokens': dataset.cache_params,
+        'model_name_or_path': args.model_name_or_path,
+        'dynamic_padding': args.dynamic_padding,
+        'dtype': 'float16',
+    }
+    encoder = get_encoder_path(args)
+    if encoder != args.model_name_or_path or os.path.isdir(encoder):
+        params['encoder'] = fingerprint_model(encoder)
+    cache_name = "embedding_{}_{}".format(
+        args.model_name_or_path.replace('/', '_'),
+        dataset.cache_name[len('cached_'):],
+    )
+    return get_cache_path(
+        args.cache_dir if args.cache_dir is not None else args.data_dir,
+        cache_name,
+        params,
+    ), params
+
+
+def get_encoder_path(args):
+    return getattr(args, 'encoder_path', '') or args.model_name_or_path
+
+
+def build_embedding_cache(args, dataset, bert_model, device):
+    # ======================================
+    #   Encode every example of the token store behind a DepressionDataset once with the frozen encoder
+    #   and store 'last_hidden_state' on disk in fp16, ragged as the token store:
+    #   with --dynamic_padding only the real tokens of every example are kept,
+    #   otherwise all max_seq_length positions (the heads see the encoder output at the padding too).
+    #
+    #   files in the cache directory
+    #   - hidden.npy: (total rows, hidden_size), float16, example i is hidden[offsets[i]:offsets[i+1]]
+    #   - offsets.npy: (num_data + 1,), int64
+    #   - lengths.npy: (num_data,), int64, real tokens of every example (its attention mask)
+    #   - labels.npy: (num_data,), int64
+    #   examples follow the token store, not the fold split of the dataset
+    # ======================================
+    cache_path, params = get_embedding_cache_path(args, dataset)
+    tmp_path = cache_path + '.tmp-{}'.format(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    # all stored rows in store order, the cache rows must line up with the token store
+    dataset = copy.copy(dataset)
+    dataset.select(np.arange(len(dataset.store)))
+    dl = build_dataloader(dataset, args.batch_size, shuffle=False, bucketing=False)
+
+    hidden_size = bert_model.bert_model.config.hidden_size
+    lengths = np.asarray(dataset.get_lengths(), dtype=np.int64)
+    row_lengths = lengths if args.dynamic_padding else np.full(len(dataset), args.max_seq_length, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int64)
+    hidden = np.lib.format.open_memmap(os.path.join(tmp_path, 'hidden.npy'), mode='w+', dtype=np.float16,
+                                       shape=(int(offsets[-1]), hidden_size))
+    labels = np.zeros(len(dataset), dtype=np.int64)
+
+    print("*** Encoding {} examples into {}".format(len(dataset), cache_path))
+    t0 = time.time()
+    bert_model.eval()
+    start = 0
+    for data in tqdm(dl, desc='encode', mininterval=0.01, leave=True):
+        inputs = {
+            "input_ids": data['input_ids'].to(device),
+            "attention_mask": data['attention_mask'].to(device),
+        }
+        bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=False)
+        end = start + bert_output.size(0)
+        # the rows of the batch back to back (boolean indexing keeps the example order)
+        keep = torch.arange(bert_output.size(1))[None, :] < torch.from_numpy(row_lengths[start:end])[:, None]
+        hidden[offsets[start]:offsets[end]] = bert_output.to(torch.float16).cpu()[keep].numpy()
+        labels[start:end] = data['labels'].numpy()
+        start = end
+    hidden.flush()
+    del hidden
+
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_path, 'lengths.npy'), lengths)
+    np.save(os.path.join(tmp_path, 'labels.npy'), labels)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({
+            'tokens': os.path.basename(dataset.cached_features_file),
+            'model_name_or_path': args.model_name_or_path,
+            'encoder': get_encoder_path(args),
+            'max_seq_length': args.max_seq_length,
+            'num_data': len(dataset),
+            'hidden_size': hidden_size,
+        }, f)
+
+    # publish the finished cache in one step so that readers never see a partial one
+    publish_dir(tmp_path, cache_path)
+    record_cache_entry(cache_path, params, sources=[dataset.data_path])
+    print("*** Encoding took: {:.1f}s".format(time.time() - t0))
+    return cache_path
+
+
+def precompute_embeddings(args, tokenizer, modes, load_encoder, device):
+    # ======================================
+    #   Build the embedding caches of the given splits that do not exist yet.
+    #   load_encoder is only called when at least one split has to be encoded.
+    # ======================================
+    bert_model = None
+    for mode in modes:
+        dataset = DepressionDataset(args=args, mode=mode, tokenizer=tokenizer)
+        cache_path, _ = get_embedding_cache_path(args, dataset)
+        if not args.overwrite_cache and os.path.exists(cache_path):
+            continue
+        with cache_lock(cache_path):
+            # another job may have built it while we were waiting for the lock
+            if args.overwrite_cache or not os.path.exists(cache_path):
+                if bert_model is None:
+                    bert_model = load_encoder()
+                build_embedding_cache(args, dataset, bert_model, device)
+    if bert_model is None:
+        return
+    del bert_model
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class EmbeddingDataset(Dataset):
+    def __init__(self, args, mode='train', tokenizer=None):
+        self.args = args
+        self.mode = mode
+
+        # the token store is opened to look up the key of the embedding cache and the rows of the split
+        dataset = DepressionDataset(args=args, mode=mode, tokenizer=tokenizer)
+        cache_path, _ = get_embedding_cache_path(args, dataset)
+        assert os.path.exists(cache_path), "embedding cache {} doesn't exist, run precompute_embeddings first".format(cache_path)
+        print("*** Loading bert embeddings from cached directory {}".format(cache_path))
+
+        # hidden states stay on disk and are paged in per batch
+        self.hidden = np.load(os.path.join(cache_path, 'hidden.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(cache_path, 'offsets.npy'))
+        self.lengths = np.load(os.path.join(cache_path, 'lengths.npy'))
+        self.labels = torch.from_numpy(np.load(os.path.join(cache_path, 'labels.npy')))
+        self.dynamic_padding = args.dynamic_padding
+        # cache rows of the split
+        self.rows = dataset.get_rows(np.arange(len(dataset)))
+        self.num_data = len(self.rows)
+
+    def __len__(self):
+        return self.num_data
+
+    def __getitem__(self, idx):
+        return {key: value[0] for key, value in self.__getitems__([idx]).items()}
+
+    def __getitems__(self, indices):
+        # ======================================
+        #   the batch padded with zeros to its longest example (--dynamic_padding) or max_seq_length,
+        #   the attention mask covers the real tokens
+        # ======================================
+        indices = self.rows[np.asarray(indices, dtype=np.int64)]
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        width = int((ends - starts).max())
+        bert_output = np.zeros((len(indices), width, self.hidden.shape[1]), dtype=np.float16)
+        for j, (start, end) in enumerate(zip(starts, ends)):
+            bert_output[j, :end - start] = self.hidden[start:end]
+        lengths = torch.from_numpy(self.lengths[indices])
+        return {
+            'bert_output': torch.from_numpy(bert_output),
+            'attention_mask': (torch.arange(width)[None, :] < lengths[:, None]).long(),
+            'labels': self.labels[indices],
+        }
+
+    def get_labels(self):
+        return self.labels[self.rows].tolist()
+
+    def get_lengths(self):
+        # for the length buckets of build_dataloader with --dynamic_padding
+        return self.lengths[self.rows].tolist()
+
+if __name__ == '__main__':
+    from train_disease_model import get_args, load_tokenizer, load_bert_model
+    from utils import get_symptom_num
+
+    args = get_args()
+    args.num_labels = get_symptom_num(args.task_name)
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    tokenizer = load_tokenizer(args)
+    precompute_embeddings(args, tokenizer, ['train', 'test'], lambda: load_bert_model(args).to(device), device)
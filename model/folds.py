@@ -0,0 +1,103 @@
+import os, json, glob, argparse
+from collections import defaultdict
+
+
+# ======================================
+#   One corpus per task + fold index files
+#
+#   ./dataset/{task}/corpus.json: every example of the task once, same format as the fold files
+#       {idx: [text, label], ...}
+#   ./dataset/{task}/five_fold.json: the splits of every fold as indices into the corpus
+#       {fold: {mode: [corpus idx, ...], ...}, ...}
+#
+#   DepressionDataset tokenizes the corpus once and selects the rows of a fold split,
+#   so the five folds share one token store (and one embedding cache).
+#   Another fold scheme is just another index file (--fold_index_path).
+# ======================================
+
+
+def get_corpus_path(args):
+    return args.corpus_path.format(args.task_name)
+
+
+def get_fold_index_path(args):
+    return args.fold_index_path.format(args.task_name)
+
+
+def read_fold_index(path, fold, mode):
+    with open(path, 'r') as f:
+        fold_index = json.load(f)
+    assert str(fold) in fold_index, "fold {} is not in {}".format(fold, path)
+    assert mode in fold_index[str(fold)], "fold {} of {} has no '{}' split".format(fold, path, mode)
+    return fold_index[str(fold)][mode]
+
+
+def build_corpus(split_paths):
+    # ======================================
+    #   split_paths: {fold: {mode: path of the split json}}
+    #   Identical (text, label) examples are stored once. An example that occurs
+    #   k times in one split keeps k copies in the corpus, so every split is
+    #   reproduced exactly, in its original order.
+    #   returns corpus {idx: [text, label]} and fold index {fold: {mode: [idx]}}
+    # ======================================
+    corpus = []
+    copies = defaultdict(list)   # (text, label) -> corpus indices
+    fold_index = {}
+    for fold in sorted(split_paths, key=int):
+        fold_index[str(fold)] = {}
+        for mode, path in sorted(split_paths[fold].items()):
+            with open(path, 'r') as fp:
+                datas = json.load(fp)
+
+            seen = defaultdict(int)
+            indices = []
+            for data in datas:
+                key = (datas[data][0], str(datas[data][1]))
+                if seen[key] == len(copies[key]):
+                    copies[key].append(len(corpus))
+                    corpus.append(list(key))
+                indices.append(copies[key][seen[key]])
+                seen[key] += 1
+            fold_index[str(fold)][mode] = indices
+
+    return {str(idx): example for idx, example in enumerate(corpus)}, fold_index
+
+
+def find_split_paths(data_path, task_name):
+    # ./dataset/{task}/{fold}/{mode}.json
+    split_paths = defaultdict(dict)
+    for path in glob.glob(data_path.format(task_name, '*', '*')):
+        fold = os.path.basename(os.path.dirname(path))
+        mode = os.path.splitext(os.path.basename(path))[0]
+        if fold.isdigit():
+            split_paths[fold][mode] = path
+    return split_paths
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--task_name", type=str, default="depression")
+    parser.add_argument("--data_path", type=str, default="./dataset/{}/{}/{}.json")
+    parser.add_argument("--corpus_path", type=str, default="./dataset/{}/corpus.json")
+    parser.add_argument("--fold_index_path", type=str, default="./dataset/{}/five_fold.json")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    split_paths = find_split_paths(args.data_path, args.task_name)
+    assert len(split_paths) > 0, "no fold files found for {}".format(args.data_path.format(args.task_name, '*', '*'))
+    corpus, fold_index = build_corpus(split_paths)
+
+    num_examples = sum(len(indices) for splits in fold_index.values() for indices in splits.values())
+    print("*** {} folds, {} examples in the fold files, {} in the corpus".format(len(fold_index), num_examples, len(corpus)))
+
+    for path, content in [(get_corpus_path(args), corpus), (get_fold_index_path(args), fold_index)]:
+        tmp_path = path + '.tmp-{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
+        print("*** Saved {}".format(path))
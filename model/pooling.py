@@ -0,0 +1,94 @@
+import torch
+
+
+# ======================================
+#   Pooling of the CNN heads over all filter sizes at once
+#   The conv outputs (after ReLU, so >= 0) of all filter sizes come as one tensor (..., len(filter_sizes), n_filters, H)
+#   that is zero at the positions that are not pooled: past seq_len - fs + 1 (cnn_head.run_convs, stack_conved),
+#   and past the real tokens with an attention mask (mask_stacked, see cnn_head.trim_to_mask).
+#   Since every value is >= 0 and at least k positions are pooled, the zeros never change max, k-max or a sum,
+#   so max, k-max and avg are one reduction / topk over the stacked tensor without masking.
+#   mix adds the k smallest values, which must skip the zeroed positions: a topk per filter size over the pooled
+#   prefix, or one topk with the zeroed positions set to +inf when they differ per sample (attention mask).
+#   (A single sort for both ends of mix was tried, it is several times slower than topk on CPU.)
+#
+#   The output is laid out as the heads concatenated it per filter size:
+#   - max, avg: (..., len(filter_sizes) * n_filters)
+#   - k-max: (..., len(filter_sizes) * n_filters * k)
+#   - mix: (..., len(filter_sizes) * 2 * n_filters * k), per filter size the k largest, then the k smallest
+# ======================================
+
+POOLS = ('max', 'k-max', 'mix', 'avg')
+
+
+def get_num_valid(filter_sizes, seq_len, lengths=None, min_positions=1):
+    # ======================================
+    #   Positions to pool per filter size
+    #   - without lengths: seq_len - fs + 1, every position of the conv output -> (len(filter_sizes))
+    #   - with lengths (batch_size) of real tokens: the windows within the real tokens,
+    #     at least min_positions -> (batch_size, len(filter_sizes))
+    # ======================================
+    device = lengths.device if lengths is not None else None
+    filter_sizes = torch.tensor(list(filter_sizes), device=device)
+    if lengths is None:
+        return seq_len - filter_sizes + 1
+    return (lengths.unsqueeze(-1) - filter_sizes + 1).clamp(min=min_positions)
+
+
+def get_valid_mask(num_valid, num_positions):
+    # (..., len(filter_sizes), 1, num_positions) bool, True for the pooled positions
+    return torch.arange(num_positions, device=num_valid.device) < num_valid.unsqueeze(-1).unsqueeze(-1)
+
+
+def stack_conved(conved):
+    # [(..., n_filters, H_i) * len(filter_sizes)] -> (..., len(filter_sizes), n_filters, max(H_i)), zero-padded
+    num_positions = max(conv.size(-1) for conv in conved)
+    stacked = conved[0].new_zeros(conved[0].shape[:-2] + (len(conved),) + conved[0].shape[-2:-1] + (num_positions,))
+    for i, conv in enumerate(conved):
+        stacked[..., i, :, :conv.size(-1)] = conv
+    return stacked
+
+
+def mask_stacked(stacked, num_valid):
+    # zeroes the positions of stacked (..., len(filter_sizes), n_filters, H) past num_valid (..., len(filter_sizes))
+    return stacked * get_valid_mask(num_valid, stacked.size(-1)).to(stacked.dtype)
+
+
+def pool_stacked(stacked, num_valid, pool, k=1):
+    # ======================================
+    #   INPUT
+    #   - stacked: conv outputs after ReLU (..., len(filter_sizes), n_filters, H), 0 where not pooled
+    #   - num_valid: positions to pool per filter size, broadcastable to (..., len(filter_sizes))
+    #   - pool: one of POOLS
+    #   - k: int, or one k per filter size (list or tuple) for k-max and mix
+    #
+    #   OUTPUT
+    #   - pooled: (..., len(filter_sizes) * n_filters [* k [* 2]]), see above
+    # ======================================
+    if pool not in POOLS:
+        raise ValueError("This kernel is currently not supported.")
+
+    if pool == 'max':
+        return stacked.amax(dim=-1).flatten(-2)
+    if pool == 'avg':
+        return (stacked.sum(dim=-1) / num_valid.unsqueeze(-1).to(stacked.dtype)).flatten(-2)
+
+    ks = list(k) if isinstance(k, (list, tuple)) else [k] * stacked.size(-3)
+    max_k = max(ks)
+    largest = stacked.topk(max_k, dim=-1)[0]     # (..., len(fs), n_filters, max_k)
+    if pool == 'k-max':
+        if all(tk == max_k for tk in ks):
+            return largest.flatten(-3)
+        # different k per filter size (DiseaseModel over few symptoms), the values past a smaller k are cut off
+        return torch.cat([largest[..., i, :, :tk].flatten(-2) for i, tk in enumerate(ks)], dim=-1)
+
+    # mix: the zeroed positions must not count as the smallest values
+    if num_valid.dim() == 1:
+        # the same positions for the whole batch: the pooled prefix of each filter size, without a copy
+        smallest = [stacked[..., i, :, :n].topk(tk, dim=-1, largest=False)[0]
+                    for i, (n, tk) in enumerate(zip(num_valid.tolist(), ks))]
+    else:
+        valid = get_valid_mask(num_valid, stacked.size(-1))
+        smallest = stacked.masked_fill(~valid, float('inf')).topk(max_k, dim=-1, largest=False)[0].unbind(-3)
+    return torch.cat([torch.cat([largest[..., i, :, :tk].flatten(-2), smallest[i][..., :tk].flatten(-2)], dim=-1)
+                      for i, tk in enumerate(ks)], dim=-1)
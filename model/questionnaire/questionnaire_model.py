@@ -2,21 +2,18 @@ import torch, sys
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
-from transformers import (
-    AutoTokenizer,
-    AutoModel,
-    get_linear_schedule_with_warmup,
-)
-from tqdm import tqdm
 
 sys.path.insert(0, './')
 sys.path.insert(0, './../')
-from bert_model import BertModelforBaseline, get_batch_bert_embedding
-from dataset import DepressionDataset
 from questionnaire.symptom_cnn import SymptomCNN
+from cnn_head import pad_to_min_length, get_min_length, conv_matmul, trim_to_mask, get_min_positions
+from pooling import get_num_valid, mask_stacked, pool_stacked
 
 class QuestionnaireModel(nn.Module):
+    # class level default, so models pickled before the fused path existed use it too
+    fused = True
+    conv_backend = 'conv'
+
     def __init__(self,
                  num_symptoms,
                  embedding_dim=768,
@@ -24,16 +21,28 @@ class QuestionnaireModel(nn.Module):
                  filter_sizes=(2, 3, 4, 5, 6),
                  output_dim=1,
                  dropout=0.2,
-                 pool='max'):
+                 pool='max',
+                 fused=True,
+                 conv_backend='conv'):
+        # =================================================
+        # ARGUMENTS
+        # - fused (bool): run all symptom CNNs as one conv and one batched fc (see forward_fused)
+        #                 instead of one SymptomCNN after another.
+        #                 The parameters are the same (self.question_models), so both load the same checkpoints.
+        # - conv_backend (str): 'conv' or 'matmul' (see cnn_head.py), for the fused path and every SymptomCNN
+        # =================================================
         super(QuestionnaireModel, self).__init__()
         self.num_symptoms = num_symptoms
+        self.fused = fused
+        self.conv_backend = conv_backend
         self.question_models = nn.ModuleList(
             [SymptomCNN(embedding_dim,
                         n_filters,
                         filter_sizes,
                         output_dim,
                         dropout,
-                        pool) for _ in range(self.num_symptoms)]
+                        pool,
+                        conv_backend) for _ in range(self.num_symptoms)]
         )
 
     '''
@@ -59,11 +68,19 @@ class QuestionnaireModel(nn.Module):
         return res_sym_prob, res_sym_hidden
     '''
 
-    def forward(self, bert_output, labels):
+    def get_config(self):
+        # the arguments to build this model again, for weights-only snapshots (see snapshot.py)
+        config = self.question_models[0].get_config()
+        config.update(num_symptoms=self.num_symptoms, fused=self.fused, conv_backend=self.conv_backend)
+        return config
+
+    def forward(self, bert_output, labels, attention_mask=None):
         # ====================================
         #   INPUT
         #   - bert_output: (batch_size, MAX_SEQ_LEN, EMB_DIM)
         #   - labels (list of int): list of symptom number (BATCH_SIZE)
+        #   - attention_mask: (batch_size, MAX_SEQ_LEN) or None. If given, bert_output is trimmed to the longest sequence
+        #                     and only the positions of real tokens are pooled (see cnn_head.py)
         #
         #   OUTPUT
         #   - symptom_scores: (BATCH_SIZE, NUM_SYMP, 1)
@@ -79,9 +96,13 @@ class QuestionnaireModel(nn.Module):
             sym_labels[batch_ind, symp_no] = 1
         sym_labels = sym_labels.unsqueeze(-1)   # (b, num_symp, 1)
 
+        if self.fused:
+            symptom_scores, symptom_vectors = self.forward_fused(bert_output, attention_mask)
+            return symptom_scores, sym_labels, symptom_vectors
+
         res_sym_prob, res_sym_hidden = [], []
         for sym_model in self.question_models:
-            symptom_prob, symptom_hidden = sym_model(bert_output)  # (b, 1), (b, n_filters * len(filter_sizes))
+            symptom_prob, symptom_hidden = sym_model(bert_output, attention_mask)  # (b, 1), (b, n_filters * len(filter_sizes))
             res_sym_prob.append(symptom_prob)  # (num_symptoms, b, 1)
             res_sym_hidden.append(symptom_hidden)  # (num_symptoms, b, n_filters * len(filter_sizes))
 
@@ -90,8 +111,78 @@ class QuestionnaireModel(nn.Module):
 
         return symptom_scores, sym_labels, symptom_vectors
 
+    def forward_fused(self, bert_output, attention_mask=None):
+        # ====================================
+        #   Same outputs as running every SymptomCNN, with one read of bert_output:
+        #   - the filters of all symptoms and sizes are stacked into one Conv2d weight of kernel (max fs, EMB_DIM),
+        #     smaller filters are zero-padded at the end and the input gets (max fs - min fs) zero rows,
+        #     so every filter still sees its own window at every position
+        #   - per filter size, only the first (seq_len - fs + 1) positions are pooled, as in SymptomCNN,
+        #     all symptoms and filter sizes in one pool_stacked call (see pooling.py)
+        #   - with conv_backend 'matmul' the stacked filters of each size go through conv_matmul instead,
+        #     which needs no zero-padding
+        #   - the fc layers of all symptoms run as one batched matmul
+        #
+        #   OUTPUT
+        #   - symptom_scores: (BATCH_SIZE, NUM_SYMP, output_dim)
+        #   - symptom_vectors: (BATCH_SIZE, NUM_SYMP, n_filters * len(filter_sizes)) for max pool
+        # ====================================
+        first = self.question_models[0]
+        filter_sizes, n_filters, pool = first.filter_sizes, first.n_filters, first.pool
+        max_fs, min_fs = max(filter_sizes), min(filter_sizes)
+
+        min_length = get_min_length(filter_sizes, pool, 5)
+        lengths = None
+        if attention_mask is not None:
+            bert_output, lengths = trim_to_mask(bert_output, attention_mask, min_length)
+        else:
+            bert_output = pad_to_min_length(bert_output, min_length)
+        batch_size, seq_len = bert_output.size(0), bert_output.size(1)
+
+        if self.conv_backend == 'matmul':
+            # per filter size (num_symp * n_filters, 1, fs, EMB_DIM), ordered by symptom, then filter
+            weights = [torch.cat([sym_model.convs[i].weight for sym_model in self.question_models]) for i in range(len(filter_sizes))]
+            biases = [torch.cat([sym_model.convs[i].bias for sym_model in self.question_models]) for i in range(len(filter_sizes))]
+            conved = F.relu(conv_matmul(bert_output, weights, biases))  # (b, len(fs), num_symp * n_filters, seq_len - min_fs + 1)
+        else:
+            # (len(fs) * num_symp * n_filters, 1, max_fs, EMB_DIM), ordered by filter size, then symptom, then filter
+            weight = torch.cat([F.pad(sym_model.convs[i].weight, (0, 0, 0, max_fs - fs))
+                                for i, fs in enumerate(filter_sizes) for sym_model in self.question_models])
+            bias = torch.cat([sym_model.convs[i].bias for i in range(len(filter_sizes)) for sym_model in self.question_models])
+
+            padded = F.pad(bert_output, (0, 0, 0, max_fs - min_fs)).unsqueeze(1)   # (b, 1, seq_len + max_fs - min_fs, EMB_DIM)
+            conved = F.relu(F.conv2d(padded, weight, bias)).squeeze(3)    # (b, len(fs) * num_symp * n_filters, seq_len - min_fs + 1)
+        # (b, num_symp, len(fs), n_filters, seq_len - min_fs + 1)
+        conved = conved.view(batch_size, len(filter_sizes), self.num_symptoms, n_filters, -1).transpose(1, 2)
+
+        num_valid = get_num_valid(filter_sizes, seq_len, lengths, get_min_positions(pool, 5))
+        if lengths is not None:
+            num_valid = num_valid.unsqueeze(1)  # (b, 1, len(fs)), the same for every symptom
+        if lengths is not None or self.conv_backend != 'matmul':
+            # the padded conv computes every filter at every position, not only the first seq_len - fs + 1
+            conved = mask_stacked(conved, num_valid)
+        concat = pool_stacked(conved, num_valid, pool, 5)  # (b, num_symp, n_filters * len(filter_sizes))
+        concat = first.dropout(concat)
+
+        fc_weight = torch.stack([sym_model.fc.weight for sym_model in self.question_models])  # (num_symp, output_dim, hidden)
+        fc_bias = torch.stack([sym_model.fc.bias for sym_model in self.question_models])      # (num_symp, output_dim)
+        output = torch.einsum('bsh,soh->bso', concat, fc_weight) + fc_bias
+
+        if first.output_dim == 1:
+            output = torch.sigmoid(output)
+        else:
+            output = torch.softmax(output, dim=2)
+
+        return output, concat
+
 
 if __name__ == '__main__':
+    # only the demo below needs the encoder and the data
+    from torch.utils.data import DataLoader
+    from transformers import AutoTokenizer, AutoModel, get_linear_schedule_with_warmup
+    from tqdm import tqdm
+    from bert_model import BertModelforBaseline, get_batch_bert_embedding
+    from dataset import DepressionDataset
     from train_question_model import get_args
 
     args = get_args()
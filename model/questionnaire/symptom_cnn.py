@@ -1,23 +1,19 @@
 import torch, sys
 from torch import nn
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
-from transformers import (
-    AutoTokenizer,
-    AutoModel,
-    get_linear_schedule_with_warmup,
-)
-from tqdm import tqdm
 
 sys.path.insert(0, './')
 sys.path.insert(0, './../')
-from bert_model import BertModelforBaseline, get_batch_bert_embedding
-from dataset import DepressionDataset
+from cnn_head import pad_to_min_length, get_min_length, run_convs, trim_to_mask, get_min_positions
+from pooling import get_num_valid, mask_stacked, pool_stacked
 
 
 
 class SymptomCNN(nn.Module):
-    def __init__(self, embedding_dim=768, n_filters=1, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.2, pool='max'):
+    # class level default, so models pickled before conv backends existed run as before
+    conv_backend = 'conv'
+
+    def __init__(self, embedding_dim=768, n_filters=1, filter_sizes=(2, 3, 4, 5, 6), output_dim=1, dropout=0.2, pool='max', conv_backend='conv'):
         # =================================================
         # ARGUMENTS
         # - embedding_dim (int): embedding dimension of bert output (default: 768)
@@ -26,6 +22,7 @@ class SymptomCNN(nn.Module):
         # - output_dim (int): output dimension after fc layer
         # - pool (str): pooling method
         #               supported methods are {'max', 'k-max', 'mix', 'avg'}
+        # - conv_backend (str): 'conv' or 'matmul' (see cnn_head.py)
         # =================================================
 
         super().__init__()
@@ -36,6 +33,7 @@ class SymptomCNN(nn.Module):
         self.output_dim = output_dim
         self.dropout_p = dropout
         self.pool = pool
+        self.conv_backend = conv_backend
 
         # CNN Layers
         self.convs = nn.ModuleList(
@@ -64,11 +62,18 @@ class SymptomCNN(nn.Module):
             nn.init.xavier_normal_(m.weight)
             m.bias.data.fill_(0.1)
 
-    def forward(self, bert_encoded_output):
+    def get_config(self):
+        # the arguments to build this head again, for weights-only snapshots (see snapshot.py)
+        return {'embedding_dim': self.embedding_dim, 'n_filters': self.n_filters, 'filter_sizes': list(self.filter_sizes),
+                'output_dim': self.output_dim, 'dropout': self.dropout_p, 'pool': self.pool, 'conv_backend': self.conv_backend}
+
+    def forward(self, bert_encoded_output, attention_mask=None):
         # ======================================
         #   INPUT
         #   - bert_encoded_output: 'last_hidden_layer' of bert output
         #                           (batch_size, seq_len = MAX_LEN, hidden_size = embedding_dim)
+        #   - attention_mask: (batch_size, seq_len) or None. If given, the batch is trimmed to its longest sequence
+        #                     and only the positions of real tokens are pooled (see cnn_head.py)
         #
         #   OUTPUT
         #   - output: Probability vector for presence of the symptom
@@ -77,27 +82,21 @@ class SymptomCNN(nn.Module):
         #               for max pool, (b, n_filters*len(filter_sizes))
         # ======================================
         # bert_encoded_output (batch_size, seq_len=MAX_LEN, hid_size=embedding_dim)
-        bert_encoded_output = bert_encoded_output.unsqueeze(1)  # (batch_size, 1, seq_len, hidden_size)
-
-        # CNN (kernel size = (2, 3, 4, 5, 6)) and relu)
-        conved = [F.relu(conv(bert_encoded_output)).squeeze(3) for conv in self.convs]  # [(b, n_filters, H) * 5]
-                                                                                        # H = seq_len - kernel_size(fs) + 1
-        # Pooling Layer
-        if self.pool == 'max':
-            pooled = [F.max_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]  # [(b, n_filters) * len(filter_sizes)]
-        elif self.pool == "k-max":
-            batch_size = bert_encoded_output.size(0)
-            pooled = [conv.topk(5, dim=2)[0].view(batch_size, -1) for conv in conved]
-        elif self.pool == "mix":
-            batch_size = bert_encoded_output.size(0)
-            pooled = [torch.cat([conv.topk(5, dim=2)[0].view(batch_size, -1),
-                                 conv.topk(5, dim=2, largest=False)[0].view(batch_size, -1)], dim=1) for conv in conved]
-        elif self.pool == "avg":
-            pooled = [F.avg_pool1d(conv, conv.shape[2]).squeeze(2) for conv in conved]
+        min_length = get_min_length(self.filter_sizes, self.pool, 5)
+        lengths = None
+        if attention_mask is not None:
+            bert_encoded_output, lengths = trim_to_mask(bert_encoded_output, attention_mask, min_length)
         else:
-            raise ValueError("This kernel is currently not supported.")
+            bert_encoded_output = pad_to_min_length(bert_encoded_output, min_length)
 
-        concat = torch.cat(pooled, dim=1)   # (b, n_filters*len(filter_sizes))
+        # CNN (kernel size = (2, 3, 4, 5, 6)) and relu)
+        conved = F.relu(run_convs(bert_encoded_output, self.convs, self.conv_backend))  # (b, 5, n_filters, H), all filter sizes stacked
+                                                                                        # H = seq_len - min(kernel_size) + 1
+        # Pooling Layer (all filter sizes at once, see pooling.py)
+        num_valid = get_num_valid(self.filter_sizes, bert_encoded_output.size(1), lengths, get_min_positions(self.pool, 5))
+        if lengths is not None:
+            conved = mask_stacked(conved, num_valid)
+        concat = pool_stacked(conved, num_valid, self.pool, 5)   # (b, n_filters*len(filter_sizes))
         concat = self.dropout(concat)
         output = self.fc(concat)   # (b, n_filters*len(filter_sizes)) -> (b, output_dim)
 
@@ -110,6 +109,12 @@ class SymptomCNN(nn.Module):
 
 
 if __name__ == '__main__':
+    # only the demo below needs the encoder and the data
+    from torch.utils.data import DataLoader
+    from transformers import AutoTokenizer, AutoModel, get_linear_schedule_with_warmup
+    from tqdm import tqdm
+    from bert_model import BertModelforBaseline, get_batch_bert_embedding
+    from dataset import DepressionDataset
     from train import get_args
 
     args = get_args()
@@ -6,5 +6,4 @@
 
 #python run_disease_model.py --task_name 'bpd' --gpu_id '1' --model 'bert'
 #python run_disease_model.py --task_name 'depression' --gpu_id '1' --model 'bert'
-python run_disease_model.py --task_name 'bpd' --gpu_id '1' --model 'roberta'
-python run_disease_model.py --task_name 'depression' --gpu_id '1' --model 'roberta'
\ No newline at end of file
+python run_disease_model.py --task_name 'bpd' 'depression' --gpu_id '1' --model 'roberta'
\ No newline at end of file
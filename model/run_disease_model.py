@@ -1,42 +1,196 @@
-import argparse, os
+import argparse, os, sys, json, time, queue, subprocess
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from worker import submit
+
+
+# ======================================
+#   Sweep of train_disease_model.py over tasks x models x seeds x folds
+#
+#   Every run writes its metrics to {results_dir}/{task}/{model}/{eval_set}/seed_{seed}_fold_{fold}.json
+#   (train_disease_model.py --results_path) and its output to a .log file next to it.
+#   eval_set is the data the metrics are computed on (see get_eval_set), so training and test sweeps
+#   neither skip nor overwrite each other's results.
+#   Runs that already have a result are skipped, so an interrupted sweep is resumed by starting it again.
+#   Jobs run in parallel, as many as fit both the CPU cores (--threads_per_job each)
+#   and the memory budget (--job_memory each), unless --workers is given.
+#   A job that exits with an error or without its results is retried --retries times.
+#   With --replicas one job trains all seeds of a fold side by side (train_disease_model.py --seeds).
+#   With --worker_address the jobs are submitted to warm workers (worker.py) instead of new processes,
+#   one job at a time per worker.
+#
+#   Arguments the scheduler doesn't know are passed on to every job, e.g.
+#   python run_disease_model.py --task_name anxiety bipolar --model bert roberta --do_train --embedding_cache
+# ======================================
+
+MODELS = {'bert': 'bert-base-cased', 'roberta': 'roberta-base'}
 
 
 def get_args_for_bash():
     parser = argparse.ArgumentParser()
 
     # initialization
-    parser.add_argument("--model", type=str, default='bert')
-    parser.add_argument('--gpu_id', type=str, default="0")
-    parser.add_argument('--task_name', type=str, default='depression')
+    parser.add_argument("--model", nargs='+', type=str, default=['bert'])
+    parser.add_argument('--gpu_id', nargs='+', type=str, default=["0"])   # jobs are spread over the gpus by worker
+    parser.add_argument('--task_name', nargs='+', type=str, default=['depression'])
     parser.add_argument('--seed', nargs='+', type=int, default=[42, 53, 64, 75, 86, 97])
+    parser.add_argument('--folds', nargs='+', type=int, default=[0, 1, 2, 3, 4])
     parser.add_argument("--do_train", action="store_true")
-    return parser.parse_args()
+    parser.add_argument("--replicas", action="store_true")   # one job per fold for all seeds, the heads of all seeds share each encoder pass
+
+    # scheduling
+    parser.add_argument("--results_dir", type=str, default="./results")
+    parser.add_argument("--workers", type=int, default=0)   # parallel jobs, 0: as many as the cores and the memory budget allow
+    parser.add_argument("--threads_per_job", type=int, default=4)   # torch threads of every job
+    parser.add_argument("--job_memory", type=float, default=4.0)   # GB one job needs
+    parser.add_argument("--memory_budget", type=float, default=0.0)   # GB for all jobs, 0: the physical memory
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument("--dry_run", action="store_true")   # print the jobs without running them
+    parser.add_argument("--worker_address", nargs='+', type=str, default=[])   # host:port of warm workers (worker.py serve) to run the jobs on
+    return parser.parse_known_args()
+
+
+def get_eval_set(args):
+    # ======================================
+    #   the data the jobs are evaluated on, as train_disease_model.run records it:
+    #   --seeds: the test split of the fold; --do_train: the train split of the fold (train_for_measuring_time);
+    #   otherwise the external test set of test_only
+    # ======================================
+    if args.replicas:
+        return 'fold_test'
+    if args.do_train:
+        return 'fold_train'
+    return 'eRisk2018_test'
+
+
+def get_results_path(args, task_name, model):
+    return os.path.join(args.results_dir, task_name, model, get_eval_set(args), 'seed_{seed}_fold_{fold}.json')
+
+
+def build_jobs(args, train_args):
+    # ======================================
+    #   one job per task x model x seed x fold (with --replicas: per task x model x fold, for all its seeds)
+    #   runs with results are left out
+    #   returns [{'name', 'args': [arguments of train_disease_model.py], 'results': [json paths the job writes], 'log'}]
+    # ======================================
+    jobs = []
+    for task_name in args.task_name:
+        for model in args.model:
+            results_path = get_results_path(args, task_name, model)
+            command = ['--task_name', task_name,
+                       '--batch_size=32', '--epochs=3', '--lr', '1e-3',
+                       '--model_name_or_path', MODELS.get(model, model),
+                       '--results_path', results_path]
+            if args.do_train:
+                command.append('--do_train')
+
+            for fold in args.folds:
+                seeds = [seed for seed in args.seed if not os.path.exists(results_path.format(seed=seed, fold=fold))]
+                if args.replicas and seeds:
+                    seed_groups = [seeds]
+                else:
+                    seed_groups = [[seed] for seed in seeds]
+                for group in seed_groups:
+                    if args.replicas:
+                        run_args = ['--seeds'] + [str(seed) for seed in group] + ['--folds', str(fold)]
+                        name = '{}/{}/{}/fold_{}'.format(task_name, model, get_eval_set(args), fold)
+                    else:
+                        run_args = ['--seed', str(group[0]), '--five_fold_num', str(fold)]
+                        name = '{}/{}/{}/seed_{}_fold_{}'.format(task_name, model, get_eval_set(args), group[0], fold)
+                    jobs.append({
+                        'name': name,
+                        'args': command + run_args + train_args,
+                        'results': [results_path.format(seed=seed, fold=fold) for seed in group],
+                        'log': os.path.join(args.results_dir, name + '.log'),
+                    })
+    return jobs
+
+
+def get_num_workers(args, num_jobs):
+    # as many jobs as fit the cores and the memory budget, or one per warm worker
+    if args.worker_address:
+        return len(args.worker_address)
+    if args.workers > 0:
+        return args.workers
+    memory_budget = args.memory_budget
+    if memory_budget <= 0:
+        memory_budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    by_cores = (os.cpu_count() or 1) // args.threads_per_job
+    by_memory = int(memory_budget // args.job_memory)
+    return max(1, min(by_cores, by_memory, num_jobs))
+
+
+def run_job(args, job, slots):
+    # runs job on a free worker slot (its gpu or warm worker), retrying failures; returns True when all its results exist
+    slot = slots.get()
+    try:
+        env = dict(os.environ,
+                   OMP_NUM_THREADS=str(args.threads_per_job),
+                   MKL_NUM_THREADS=str(args.threads_per_job))
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train_disease_model.py')] + \
+                  job['args'] + ['--gpu_id', args.gpu_id[slot % len(args.gpu_id)]]
+        os.makedirs(os.path.dirname(job['log']), exist_ok=True)
+        for attempt in range(args.retries + 1):
+            t0 = time.time()
+            with open(job['log'], 'a') as log:
+                log.write('*** {}\n'.format(' '.join(command)))
+            if args.worker_address:
+                returncode = submit(args.worker_address[slot], job['args'], job['log'])['returncode']
+            else:
+                with open(job['log'], 'a') as log:
+                    returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+            if returncode == 0 and all(os.path.exists(path) for path in job['results']):
+                print('*** {} done in {:.0f}s'.format(job['name'], time.time() - t0))
+                return True
+            print('*** {} failed (exit code {}, attempt {} / {}), see {}'.format(
+                job['name'], returncode, attempt + 1, args.retries + 1, job['log']))
+        return False
+    finally:
+        slots.put(slot)
+
+
+def collect_results(args, names=('acc', 'f1', 'f1_macro', 'AUC')):
+    # mean (std) over the seeds and folds with results on the eval set of this sweep, per task and model
+    print("*** Results on {}".format(get_eval_set(args)))
+    print("{:<40}{:>6}".format('task / model', 'runs') + ''.join('{:>18}'.format(name) for name in names))
+    for task_name in args.task_name:
+        for model in args.model:
+            results_path = get_results_path(args, task_name, model)
+            runs = []
+            for seed in args.seed:
+                for fold in args.folds:
+                    path = results_path.format(seed=seed, fold=fold)
+                    if os.path.exists(path):
+                        with open(path, 'r') as f:
+                            runs.append(json.load(f)['metrics'])
+            if not runs:
+                continue
+            print("{:<40}{:>6}".format('{} / {}'.format(task_name, model), len(runs)) + ''.join(
+                '{:>18}'.format('{:.4f} ({:.2f})'.format(np.mean([run[name] * 100 for run in runs]),
+                                                         np.std([run[name] * 100 for run in runs])))
+                for name in names))
 
 
 if __name__ == '__main__':
     from run_disease_model import get_args_for_bash
-    args = get_args_for_bash()
+    args, train_args = get_args_for_bash()
 
-    model_name = ''
-    if args.model == 'bert':
-        model_name = 'bert-base-cased'
-    elif args.model == 'roberta':
-        model_name = 'roberta-base'
+    jobs = build_jobs(args, train_args)
+    num_workers = get_num_workers(args, len(jobs))
+    print("*** {} jobs to run on {} workers, results in {}".format(len(jobs), num_workers, args.results_dir))
+    if args.dry_run:
+        for job in jobs:
+            print(' '.join(job['args']))
+        exit(0)
 
-    random_seed = args.seed
+    slots = queue.Queue()
+    for slot in range(num_workers):
+        slots.put(slot)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        done = list(pool.map(lambda job: run_job(args, job, slots), jobs))
 
-    if args.do_train:
-        command = "python train_disease_model.py --task_name '{}' --batch_size=32 --epochs=3 --gpu_id '{}' --do_train --lr 1e-3 --model_name_or_path '{}' --seed {} --five_fold_num {}"
-    else:
-        command = "python train_disease_model.py --task_name '{}' --batch_size=32 --epochs=3 --gpu_id '{}' --model_name_or_path '{}' --seed {} --five_fold_num {}"
-
-    for seed in random_seed:
-        for fold in range(5):
-            new_command = command.format(args.task_name,
-                                         args.gpu_id,
-                                         model_name,
-                                         seed,
-                                         fold)
-            # print(new_command)
-            os.system(new_command)
+    failed = [job['name'] for job, ok in zip(jobs, done) if not ok]
+    print("*** {} jobs done, {} failed{}".format(len(jobs) - len(failed), len(failed), ': ' + ', '.join(failed) if failed else ''))
+    collect_results(args)
+    exit(1 if failed else 0)
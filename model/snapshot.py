@@ -0,0 +1,242 @@
+import argparse, atexit, importlib, json, os, queue, threading, time
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file, load_file
+
+
+# ======================================
+#   Weights-only snapshots and checkpoints of the CNN heads
+#
+#   {checkpoint dir}/model.safetensors holds the state_dict of a head and, as metadata, its class and
+#   the arguments to build it (get_config of the head). Loading needs no pickle: the head is built on the
+#   meta device (no init, no memory) and takes over the tensors read from the memory-mapped file.
+#   utils.load_model prefers a snapshot to the pickled model.bin of a checkpoint.
+#
+#   A checkpoint (save_checkpoint, used by utils.save_cp) adds optimizer.safetensors (the tensors of the
+#   optimizer state, the rest as metadata), scheduler.json and, written last, manifest.json with the files
+#   and the run they belong to. Every file is written to a temporary name and renamed, so a checkpoint
+#   directory never holds a partial file, and a checkpoint with a manifest is complete.
+#   The state is copied to the cpu on the training thread and written by a background thread,
+#   wait_checkpoints() blocks until all submitted checkpoints are on disk (also at exit).
+#
+#   python snapshot.py --checkpoints ./checkpoints/disease/depression/bert-base-cased/checkpoint_seed_42_ep_3_fivefold_0/
+#       converts pickled checkpoints (model.bin, optimizer.pt, scheduler.pt) to the files above
+#   python snapshot.py --encoder bert-base-cased --output_dir ./snapshots/bert-base-cased
+#       saves the tokenizer and the encoder as safetensors to a local directory,
+#       for train_disease_model.py --encoder_path ./snapshots/bert-base-cased
+# ======================================
+
+SNAPSHOT_NAME = 'model.safetensors'
+
+
+OPTIMIZER_NAME = 'optimizer.safetensors'
+SCHEDULER_NAME = 'scheduler.json'
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_model_info(model):
+    # class and arguments of model; models without get_config (e.g. transformers models) are saved as a state_dict only
+    return {
+        'class': '{}.{}'.format(type(model).__module__, type(model).__name__),
+        'config': model.get_config() if hasattr(model, 'get_config') else None,
+    }
+
+
+def copy_state_dict(state_dict):
+    # a cpu copy, so the model can go on training while the copy is written
+    return {name: tensor.detach().to('cpu', copy=True).contiguous() for name, tensor in state_dict.items()}
+
+
+def replace_file(path, write):
+    # write(tmp_path) and rename it to path, atomic on the same file system
+    tmp_path = path + '.tmp-{}'.format(os.getpid())
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_snapshot(model, path):
+    # writes the snapshot of model into the checkpoint directory path (with the trailing /, as save_cp)
+    write_snapshot(copy_state_dict(model.state_dict()), get_model_info(model), path)
+
+
+def write_snapshot(state_dict, model_info, path):
+    replace_file(path + SNAPSHOT_NAME,
+                 lambda tmp_path: save_file(state_dict, tmp_path, metadata={'model': json.dumps(model_info)}))
+
+
+def load_snapshot(path, device='cpu'):
+    snapshot_path = path + SNAPSHOT_NAME
+    with safe_open(snapshot_path, framework='pt') as f:
+        model_info = json.loads(f.metadata()['model'])
+    if model_info['config'] is None:
+        raise ValueError("{} has only the state_dict of a {}, load it with load_state_dict".format(snapshot_path, model_info['class']))
+
+    module_name, class_name = model_info['class'].rsplit('.', 1)
+    model_class = getattr(importlib.import_module(module_name), class_name)
+    with torch.device('meta'):
+        model = model_class(**model_info['config'])
+    model.load_state_dict(load_file(snapshot_path, device=str(device)), assign=True)
+    return model
+
+
+def flatten_optimizer_state(state_dict):
+    # ======================================
+    #   optimizer.state_dict() -> (tensors, metadata) for safetensors
+    #   the tensors of the per-parameter state are named state.{param index}.{name} (e.g. state.0.exp_avg),
+    #   other values of the state (e.g. a step kept as a number) and the param_groups go to the metadata as json
+    # ======================================
+    tensors, values = {}, {}
+    for index, param_state in state_dict['state'].items():
+        for name, value in param_state.items():
+            if torch.is_tensor(value):
+                tensors['state.{}.{}'.format(index, name)] = value.detach().to('cpu', copy=True).contiguous()
+            else:
+                values['{}.{}'.format(index, name)] = value
+    metadata = {'param_groups': json.dumps(state_dict['param_groups']), 'values': json.dumps(values)}
+    return tensors, metadata
+
+
+def unflatten_optimizer_state(tensors, metadata):
+    state = {}
+    for key, tensor in tensors.items():
+        _, index, name = key.split('.', 2)
+        state.setdefault(int(index), {})[name] = tensor
+    for key, value in json.loads(metadata['values']).items():
+        index, name = key.split('.', 1)
+        state.setdefault(int(index), {})[name] = value
+    return {'state': state, 'param_groups': json.loads(metadata['param_groups'])}
+
+
+def load_optimizer_state(path, device='cpu'):
+    # the optimizer.state_dict() of the checkpoint at path, for optimizer.load_state_dict
+    with safe_open(path + OPTIMIZER_NAME, framework='pt') as f:
+        metadata = f.metadata()
+    return unflatten_optimizer_state(load_file(path + OPTIMIZER_NAME, device=str(device)), metadata)
+
+
+def load_manifest(path):
+    # the manifest of the checkpoint at path, None if it has none (not a checkpoint or not completely written)
+    if not os.path.exists(path + MANIFEST_NAME):
+        return None
+    with open(path + MANIFEST_NAME, 'r') as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, model_state, model_info, optimizer_state=None, scheduler_state=None, info=None):
+    os.makedirs(path, exist_ok=True)
+    write_snapshot(model_state, model_info, path)
+    if optimizer_state is not None:
+        tensors, metadata = optimizer_state
+        replace_file(path + OPTIMIZER_NAME, lambda tmp_path: save_file(tensors, tmp_path, metadata=metadata))
+    if scheduler_state is not None:
+        def write_scheduler(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(scheduler_state, f)
+        replace_file(path + SCHEDULER_NAME, write_scheduler)
+
+    # last, so a checkpoint with a manifest is complete
+    files = [name for name in (SNAPSHOT_NAME, OPTIMIZER_NAME, SCHEDULER_NAME) if os.path.exists(path + name)]
+    manifest = dict(info or {}, model=model_info, time=time.time(),
+                    files={name: os.path.getsize(path + name) for name in files})
+    def write_manifest(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    replace_file(path + MANIFEST_NAME, write_manifest)
+
+
+class CheckpointWriter:
+    # writes the checkpoints submitted to it one after another on a background thread
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self.work, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            path, kwargs = self.jobs.get()
+            try:
+                write_checkpoint(path, **kwargs)
+            except Exception as e:
+                self.errors.append((path, e))
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, path, **kwargs):
+        self.jobs.put((path, kwargs))
+
+    def wait(self):
+        self.jobs.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise RuntimeError("writing the checkpoints failed: " + ", ".join("{} ({})".format(path, e) for path, e in errors))
+
+
+writer = None
+
+
+def save_checkpoint(path, model, optimizer=None, scheduler=None, info=None, background=True):
+    # ======================================
+    #   saves the state of model, optimizer and scheduler as a checkpoint in the directory path (with the trailing /)
+    #   info: json values for the manifest (e.g. the run the checkpoint belongs to)
+    #   background: the state is copied here and written by the writer thread, see wait_checkpoints
+    # ======================================
+    global writer
+    kwargs = {
+        'model_state': copy_state_dict(model.state_dict()),
+        'model_info': get_model_info(model),
+        'optimizer_state': flatten_optimizer_state(optimizer.state_dict()) if optimizer is not None else None,
+        'scheduler_state': scheduler.state_dict() if scheduler is not None else None,
+        'info': info,
+    }
+    if not background:
+        write_checkpoint(path, **kwargs)
+        return
+    if writer is None:
+        writer = CheckpointWriter()
+        atexit.register(wait_checkpoints)
+    writer.submit(path, **kwargs)
+
+
+def wait_checkpoints():
+    # blocks until the checkpoints submitted so far are written, raises if writing one of them failed
+    if writer is not None:
+        writer.wait()
+
+
+def snapshot_encoder(model_name_or_path, output_dir, cache_dir=None):
+    from transformers import AutoTokenizer, AutoModel
+
+    AutoTokenizer.from_pretrained(model_name_or_path, cache_dir=cache_dir).save_pretrained(output_dir)
+    AutoModel.from_pretrained(model_name_or_path, cache_dir=cache_dir).save_pretrained(output_dir, safe_serialization=True)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", nargs='+', type=str, default=[])   # checkpoint directories with a pickled model.bin to convert
+    parser.add_argument("--encoder", type=str, default="")   # model_name_or_path of the encoder to snapshot
+    parser.add_argument("--output_dir", type=str, default="")   # directory of the encoder snapshot
+    parser.add_argument("--cache_dir", type=str, default="./cache")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    for checkpoint in args.checkpoints:
+        path = os.path.join(checkpoint, '')
+        model = torch.load(path + 'model.bin', map_location='cpu', weights_only=False)
+        optimizer, scheduler_state = None, None
+        if os.path.exists(path + 'optimizer.pt'):
+            optimizer = torch.load(path + 'optimizer.pt', map_location='cpu', weights_only=False)
+        if os.path.exists(path + 'scheduler.pt'):
+            scheduler_state = torch.load(path + 'scheduler.pt', weights_only=False)
+        write_checkpoint(path, copy_state_dict(model.state_dict()), get_model_info(model),
+                         flatten_optimizer_state(optimizer.state_dict()) if optimizer is not None else None,
+                         scheduler_state, info={'converted_from': 'model.bin'})
+        print("*** Checkpoint of {} at {}".format(type(model).__name__, path + MANIFEST_NAME))
+
+    if args.encoder:
+        snapshot_encoder(args.encoder, args.output_dir, args.cache_dir)
+        print("*** Snapshot of {} at {}".format(args.encoder, args.output_dir))
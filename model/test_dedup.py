@@ -0,0 +1,137 @@
+import os, sys, json, random, shutil, tempfile
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dedup import MinHasher, LSHBloomIndex
+
+
+# ======================================
+#   Deterministic checks of the post deduplication (dedup.py, prepare_rsdd.py --dedup):
+#   posts generated from a fixed seed, exact and near-duplicates must be dropped, distinct posts kept,
+#   also after the index added filters for more posts than its first capacity.
+#   python -m pytest model/test_dedup.py   or   python model/test_dedup.py
+# ======================================
+
+SEED = 13
+VOCAB_SIZE = 5000
+POST_LENGTH = 100
+
+
+def make_posts(num_posts, rng):
+    vocab = ['w{}'.format(i) for i in range(VOCAB_SIZE)]
+    return [' '.join(rng.choice(vocab) for _ in range(POST_LENGTH)) for _ in range(num_posts)]
+
+
+def near_duplicate(post, rng):
+    # one word replaced, a different case and spacing
+    words = post.split()
+    words[rng.randrange(len(words))] = 'edited'
+    return '  '.join(words).upper()
+
+
+def run_index(posts, capacity=5000000, error_rate=1e-6):
+    minhasher = MinHasher()
+    index = LSHBloomIndex(num_bands=minhasher.num_bands, capacity=capacity, error_rate=error_rate)
+    return [index.add(minhasher.band_keys(post)) for post in posts], index
+
+
+def test_band_keys_deterministic():
+    posts = make_posts(20, random.Random(SEED))
+    keys = [MinHasher().band_keys(post) for post in posts]
+    assert all(np.array_equal(a, b) for a, b in zip(keys, [MinHasher().band_keys(post) for post in posts]))
+    # another seed gives other hashes
+    assert not np.array_equal(keys[0], MinHasher(seed=2).band_keys(posts[0]))
+
+
+def test_duplicates_dropped_distinct_kept():
+    rng = random.Random(SEED)
+    distinct = make_posts(500, rng)
+    short = ['i feel sad', 'i feel tired', 'sad', 'feel sad i']
+    posts, expected = [], []
+    for i, post in enumerate(distinct + short):
+        posts.append(post)
+        expected.append(False)
+        if i % 5 == 0:
+            posts.append(post)
+            expected.append(True)
+        if i % 7 == 0:
+            posts.append(near_duplicate(post, rng))
+            expected.append(True)
+    # duplicates of early posts, far from their original
+    for post in distinct[:20]:
+        posts.append(post)
+        expected.append(True)
+        posts.append(near_duplicate(post, rng))
+        expected.append(True)
+
+    duplicates, index = run_index(posts)
+    assert duplicates == expected, [(i, posts[i][:40]) for i, (a, b) in enumerate(zip(duplicates, expected)) if a != b]
+    assert index.num_texts == len(posts)
+    assert index.num_duplicates == sum(expected)
+    assert len(index.filters) == 1
+
+
+def test_filter_growth():
+    # capacity 50: the index grows to several filters, distinct posts are still kept
+    # and duplicates of posts in the first filter are still dropped
+    rng = random.Random(SEED)
+    distinct = make_posts(1000, rng)
+    posts = distinct + distinct[:50] + [near_duplicate(post, rng) for post in distinct[:50]]
+    duplicates, index = run_index(posts, capacity=50)
+    assert len(index.filters) == 5     # 50 + 100 + 200 + 400 + 800 texts
+    assert [bloom.capacity for bloom in index.filters] == [50, 100, 200, 400, 800]
+    assert not any(duplicates[:len(distinct)])
+    assert all(duplicates[len(distinct):])
+
+
+def test_prepare_rsdd_dedup():
+    # prepare_rsdd.py --dedup: the same posts are dropped for any number of workers, within and across users
+    from prepare_rsdd import prepare
+    rng = random.Random(SEED)
+    distinct = make_posts(24, rng)
+    users = [
+        [distinct[0], distinct[1], distinct[0], distinct[2]],
+        [near_duplicate(distinct[1], rng), distinct[3], distinct[4]],
+        distinct[5:15],
+        [distinct[15], distinct[2], distinct[16]],
+    ]
+    expected = [
+        [distinct[0], distinct[1], distinct[2]],
+        [distinct[3], distinct[4]],
+        distinct[5:15],
+        [distinct[15], distinct[16]],
+    ]
+
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        # modes are file names in --rsdd_path, like in prepare_rsdd.py
+        os.chdir(tmp_dir)
+        mode = 'training'
+        with open(mode, 'w') as f:
+            for posts in users:
+                # depression users: the '10' strategy keeps their first 10 posts in order
+                f.write(json.dumps([{'label': 'depression', 'posts': [[i, post] for i, post in enumerate(posts)]}]) + '\n')
+        dedup = {'num_bands': 8, 'rows': 8, 'shingle_size': 3, 'capacity': 5, 'error_rate': 1e-6}
+
+        for workers in [1, 2]:
+            output_dir = os.path.join(tmp_dir, 'workers_{}'.format(workers))
+            os.makedirs(output_dir)
+            entries = prepare(mode, ['10'], output_dir, workers, chunk_size=2, seed=SEED, dedup=dedup)
+            with open(os.path.join(output_dir, 'train_10.jsonl'), 'r') as f:
+                texts = [json.loads(line)[0] for line in f]
+            assert texts == [post for posts in expected for post in posts]
+            entry = entries['train_10.jsonl']
+            assert entry['dedup']['posts'] == sum(len(posts) for posts in users)
+            assert entry['dedup']['removed'] == 3
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_') and callable(fn):
+            fn()
+            print("*** {} passed".format(name))
@@ -0,0 +1,203 @@
+import os, sys, json, time, shutil, tempfile, threading, fcntl, argparse
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from dataset import DepressionDataset, build_dataloader
+from columnar import ColumnarWriter
+from cache_utils import cache_lock, read_manifest, remove_cache_entry
+
+
+# ======================================
+#   Checks the token store path (token_store.py, columnar.py, cache_utils.py) against the
+#   original InputFeatures path: batch_encode_plus of the whole split, padded to max_seq_length
+#   with truncation='longest_first'. Runs offline with a tiny word-piece vocab.
+#   python -m pytest model/test_token_store.py   or   python model/test_token_store.py
+# ======================================
+
+MAX_SEQ_LENGTH = 16
+WORDS = ['i', 'feel', 'tired', 'sad', 'every', 'day', 'and', 'can', 'not', 'sleep', 'good', 'music', 'today', 'alone', '##s', '##ing']
+TEXTS = [
+    'i feel tired every day',
+    'good music today',
+    # longer than max_seq_length: truncated
+    ' '.join(['i can not sleep and i feel sad'] * 5),
+    '',
+    'feelings unknown words ü',
+    'i feel alone',
+    ' '.join(['sad'] * (MAX_SEQ_LENGTH - 2)),   # exactly max_seq_length with [CLS] and [SEP]
+    ' '.join(['sad'] * (MAX_SEQ_LENGTH - 1)),   # one token too long
+]
+LABELS = [1, 0, 1, 0, 0, 1, 1, 0]
+
+
+def get_tokenizer(tmp_dir):
+    from transformers import BertTokenizerFast
+    vocab_path = os.path.join(tmp_dir, 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS) + '\n')
+    return BertTokenizerFast(vocab_file=vocab_path)
+
+
+def get_args(tmp_dir, **kwargs):
+    args = argparse.Namespace(
+        data_path=os.path.join(tmp_dir, 'dataset', '{}', '{}', '{}.json'),
+        corpus_path=os.path.join(tmp_dir, 'dataset', '{}', 'corpus.json'),
+        fold_index_path=os.path.join(tmp_dir, 'dataset', '{}', 'five_fold.json'),
+        task_name='depression',
+        five_fold_num=0,
+        num_labels=2,
+        max_seq_length=MAX_SEQ_LENGTH,
+        data_dir=tmp_dir,
+        cache_dir=os.path.join(tmp_dir, 'cache'),
+        overwrite_cache=False,
+        dynamic_padding=False,
+        tokenize_workers=1,
+        shard_size=10000,
+    )
+    os.makedirs(args.cache_dir, exist_ok=True)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def write_split(tmp_dir, mode, fmt):
+    split_dir = os.path.join(tmp_dir, 'dataset', 'depression', '0')
+    os.makedirs(split_dir, exist_ok=True)
+    if fmt == 'jsonl':
+        with open(os.path.join(split_dir, mode + '.jsonl'), 'w') as f:
+            for text, label in zip(TEXTS, LABELS):
+                f.write(json.dumps([text, label]) + '\n')
+    else:
+        writer = ColumnarWriter(os.path.join(split_dir, mode + '.cols'), shard_size=3)
+        for i, (text, label) in enumerate(zip(TEXTS, LABELS)):
+            writer.append({'text': text, 'label': label, 'user': i, 'post': 0})
+        writer.close()
+
+
+def baseline_features(tokenizer, max_seq_length):
+    # the original DepressionDataset encoding (InputFeatures path)
+    features = tokenizer.batch_encode_plus(
+        TEXTS,
+        max_length=max_seq_length,
+        padding='max_length',
+        truncation='longest_first',
+        return_tensors="pt",
+    )
+    features['labels'] = torch.tensor(LABELS)
+    return features
+
+
+def assert_same_features(batch, expected):
+    for key in ['input_ids', 'attention_mask', 'labels']:
+        assert batch[key].dtype == torch.int64, key
+        assert torch.equal(batch[key], expected[key]), "{} differs from the baseline:\n{}\n{}".format(key, batch[key], expected[key])
+
+
+def check_split(fmt, dynamic_padding, tokenize_workers=1, shard_size=10000):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tokenizer = get_tokenizer(tmp_dir)
+        write_split(tmp_dir, 'train', fmt)
+        args = get_args(tmp_dir, dynamic_padding=dynamic_padding, tokenize_workers=tokenize_workers, shard_size=shard_size)
+        ds = DepressionDataset(args, mode='train', tokenizer=tokenizer)
+        expected = baseline_features(tokenizer, MAX_SEQ_LENGTH)
+        assert expected['input_ids'].shape == (len(TEXTS), MAX_SEQ_LENGTH)
+        assert len(ds) == len(TEXTS)
+        assert ds.get_labels() == LABELS
+
+        # the whole split as one batch (__getitems__) and example by example (__getitem__ + PaddingCollator)
+        seq_len = max(ds.get_lengths()) if dynamic_padding else MAX_SEQ_LENGTH
+        expected = {key: val[:, :seq_len] for key, val in expected.items() if key != 'labels'}
+        expected['labels'] = torch.tensor(LABELS)
+        assert_same_features(ds.__getitems__(list(range(len(ds)))), expected)
+        collate_fn = build_dataloader(ds, batch_size=len(ds), shuffle=False, bucketing=False).collate_fn
+        assert_same_features(collate_fn([ds[i] for i in range(len(ds))]), expected)
+
+        # a second dataset loads the cached store and the manifest records it with its source
+        ds2 = DepressionDataset(args, mode='train', tokenizer=tokenizer)
+        assert ds2.cached_features_file == ds.cached_features_file
+        manifest = read_manifest(args.cache_dir)
+        entry = manifest[os.path.basename(ds.cached_features_file)]
+        assert entry['params'] == ds.cache_params
+        assert list(entry['sources']) == [os.path.abspath(ds.data_path)]
+
+        # another max_seq_length is another cache entry, truncated like the baseline
+        args.max_seq_length = 8
+        ds3 = DepressionDataset(args, mode='train', tokenizer=tokenizer)
+        assert ds3.cached_features_file != ds.cached_features_file
+        expected = baseline_features(tokenizer, 8)
+        batch = ds3.__getitems__(list(range(len(ds3))))
+        seq_len = batch['input_ids'].size(1)
+        assert seq_len == (max(ds3.get_lengths()) if dynamic_padding else 8)
+        assert_same_features(batch, {key: val[:, :seq_len] if key != 'labels' else val for key, val in expected.items()})
+
+        remove_cache_entry(ds3.cached_features_file)
+        assert not os.path.exists(ds3.cached_features_file)
+        assert not os.path.exists(ds3.cached_features_file + '.lock')
+        assert os.path.basename(ds3.cached_features_file) not in read_manifest(args.cache_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_jsonl_padded():
+    check_split('jsonl', dynamic_padding=False)
+
+
+def test_jsonl_dynamic_padding():
+    check_split('jsonl', dynamic_padding=True)
+
+
+def test_columnar():
+    check_split('cols', dynamic_padding=False)
+
+
+def test_sharded_pool():
+    # several shards tokenized in a process pool are appended in order
+    check_split('jsonl', dynamic_padding=False, tokenize_workers=2, shard_size=3)
+
+
+def test_cache_lock_relocks_replaced_lock_file():
+    # ======================================
+    #   A process waiting on a lock file that is removed (remove_cache_entry) must not end up
+    #   holding the removed file: while it is inside cache_lock, the current lock file is locked.
+    # ======================================
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'cached_entry')
+        lock_path = path + '.lock'
+        acquired = threading.Event()
+        release = threading.Event()
+        relocked = []
+
+        def waiter():
+            with cache_lock(path):
+                acquired.set()
+                with open(lock_path, 'a') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        relocked.append(False)
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                    except BlockingIOError:
+                        relocked.append(True)
+                release.wait(10)
+
+        with cache_lock(path):
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            time.sleep(0.2)
+            assert not acquired.is_set()
+            os.remove(lock_path)
+        assert acquired.wait(10)
+        release.set()
+        thread.join(10)
+        assert relocked == [True]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    for name, fn in list(globals().items()):
+        if name.startswith('test_') and callable(fn):
+            fn()
+            print("*** {} passed".format(name))
@@ -0,0 +1,137 @@
+import os, json
+import numpy as np
+
+from cache_utils import publish_dir
+
+
+# ======================================
+#   On-disk layout of a token store directory
+#   - {key}.bin: all sequences of a per-token key (only 'input_ids' by default) back to back,
+#                stored in the smallest dtype that holds the vocabulary (see get_token_dtype)
+#   - offsets.bin: (num_data + 1,) int64, sequence i is [offsets[i], offsets[i+1])
+#   - labels.bin: (num_data,) int64
+#   - meta.json: num_data, num_tokens, keys, dtype, pad_token_id
+#
+#   The attention mask is not stored, every stored position is a real token.
+#   Ids are widened to int64 only when a batch is collated.
+#   All arrays are opened with np.memmap, so processes reading the same store
+#   share one page-cached copy and nothing is loaded up front.
+# ======================================
+
+
+class TokenStoreWriter(object):
+    def __init__(self, path, keys=('input_ids',), pad_token_id=0, dtype=np.int64):
+        self.path = path
+        self.tmp_path = path + '.tmp-{}'.format(os.getpid())
+        self.keys = list(keys)
+        self.pad_token_id = pad_token_id
+        self.dtype = np.dtype(dtype)
+
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.files = {key: open(os.path.join(self.tmp_path, key + '.bin'), 'wb') for key in self.keys}
+        self.lengths = []
+        self.labels = []
+        self.num_tokens = 0
+
+    def append(self, encodings, labels):
+        # encodings: {key: list of token id lists}, labels: list of int
+        lengths = np.array([len(seq) for seq in encodings[self.keys[0]]], dtype=np.int64)
+        arrays = {key: np.fromiter((token for seq in encodings[key] for token in seq), dtype=self.dtype, count=int(lengths.sum()))
+                  for key in self.keys}
+        self.append_arrays(arrays, lengths, labels)
+
+    def append_arrays(self, arrays, lengths, labels):
+        # arrays: {key: flat token array of all sequences}, lengths: length of every sequence
+        for key in self.keys:
+            np.asarray(arrays[key], dtype=self.dtype).tofile(self.files[key])
+        self.lengths.append(np.asarray(lengths, dtype=np.int64))
+        self.labels.append(np.asarray(labels, dtype=np.int64))
+        self.num_tokens += int(np.sum(lengths))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        lengths = np.concatenate(self.lengths) if len(self.lengths) > 0 else np.zeros(0, dtype=np.int64)
+        labels = np.concatenate(self.labels) if len(self.labels) > 0 else np.zeros(0, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        offsets.tofile(os.path.join(self.tmp_path, 'offsets.bin'))
+        labels.tofile(os.path.join(self.tmp_path, 'labels.bin'))
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'num_data': len(labels),
+                'num_tokens': self.num_tokens,
+                'keys': self.keys,
+                'dtype': self.dtype.name,
+                'pad_token_id': self.pad_token_id,
+            }, f)
+
+        # publish the finished store in one step so that readers never see a partial one
+        publish_dir(self.tmp_path, self.path)
+
+
+def get_token_dtype(vocab_size):
+    # bert-base-cased (28,996) and roberta-base (50,265) ids fit in 2 bytes
+    if vocab_size <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.int32
+
+
+def write_token_store(path, encodings, labels, keys=('input_ids',), pad_token_id=0, dtype=np.int64):
+    writer = TokenStoreWriter(path, keys=keys, pad_token_id=pad_token_id, dtype=dtype)
+    writer.append(encodings, labels)
+    writer.close()
+
+
+def _open_array(path, dtype, size):
+    # np.memmap can't map an empty file
+    if size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(size,))
+
+
+class TokenStore(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        self.num_data = self.meta['num_data']
+        self.keys = self.meta['keys']
+        self.pad_token_id = self.meta['pad_token_id']
+        self.offsets = _open_array(os.path.join(path, 'offsets.bin'), np.int64, self.num_data + 1)
+        self.labels = _open_array(os.path.join(path, 'labels.bin'), np.int64, self.num_data)
+        self.arrays = {key: _open_array(os.path.join(path, key + '.bin'), self.meta['dtype'], self.meta['num_tokens'])
+                       for key in self.keys}
+
+    def __len__(self):
+        return self.num_data
+
+    def get_lengths(self):
+        return np.diff(self.offsets)
+
+    def get(self, idx):
+        # views into the mapped files, nothing is copied
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return {key: arr[start:end] for key, arr in self.arrays.items()}
+
+    def get_batch(self, indices, max_length=None):
+        # ======================================
+        #   Gathers a whole batch with one fancy-indexing op per key.
+        #   Returns int64 arrays (batch_size, seq_len) padded with pad_token_id,
+        #   seq_len = max_length or the longest sequence of the batch,
+        #   and the lengths of the sequences.
+        # ======================================
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        seq_len = max_length if max_length is not None else int(lengths.max(initial=0))
+
+        steps = np.arange(seq_len)
+        mask = steps[None, :] < lengths[:, None]
+        positions = np.where(mask, starts[:, None] + steps[None, :], 0)  # padded positions read token 0 and are overwritten
+
+        batch = {}
+        for key, arr in self.arrays.items():
+            padding_value = self.pad_token_id if key == 'input_ids' else 0
+            batch[key] = np.where(mask, arr[positions], padding_value).astype(np.int64)
+        return batch, lengths
@@ -3,27 +3,12 @@ import argparse, time
 import os
 
 import torch
-from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
-
-from transformers import get_linear_schedule_with_warmup
-from transformers import (
-    TrainingArguments,
-    Trainer,
-    AutoTokenizer,
-    BertModel,
-    AutoModelForSequenceClassification,
-    AutoModel,
-    AutoConfig,
-    set_seed,
-)
 
-from tqdm import tqdm
+# transformers and SummaryWriter are imported in main, only runs need them
 
-from sklearn.metrics import (classification_report, f1_score, precision_score,
-                             recall_score, accuracy_score, confusion_matrix)
+from tqdm import tqdm
 
-from dataset import DepressionDataset
+from dataset import DepressionDataset, build_dataloader
 
 
 from utils import save_cp_epochs, format_time, compute_metrics, print_result
@@ -44,6 +29,8 @@ def get_args():
     parser.add_argument('--log_dir', type=str, default='./logs')
     parser.add_argument("--cache_dir", type=str, default="./cache")
     parser.add_argument("--data_path", type=str, default="./dataset/{}/{}/{}.json")
+    parser.add_argument("--corpus_path", type=str, default="./dataset/{}/corpus.json")    # with fold_index_path, used instead of the per-fold files (see folds.py)
+    parser.add_argument("--fold_index_path", type=str, default="./dataset/{}/five_fold.json")
     parser.add_argument("--five_fold_num", type=int, default=0)
         
     # dataset related
@@ -73,6 +60,9 @@ def get_args():
     
     
     parser.add_argument("--overwrite_cache", action="store_true")
+    parser.add_argument("--dynamic_padding", action="store_true")   # pad each batch to its longest example instead of max_seq_length
+    parser.add_argument("--tokenize_workers", type=int, default=0)   # processes for building token caches, 0: all cores
+    parser.add_argument("--shard_size", type=int, default=10000)
     parser.add_argument('--fast_dev_run', action='store_true', default=True)
     parser.add_argument("--do_train", action="store_true", default=True)
     parser.add_argument("--do_eval", action="store_true", default=True)
@@ -85,6 +75,8 @@ def get_args():
 
 
 def main(args):
+    from torch.utils.tensorboard import SummaryWriter
+    from transformers import AutoTokenizer, AutoModel, set_seed, get_linear_schedule_with_warmup
 
     print(args)
     set_seed(args.seed)
@@ -110,12 +102,7 @@ def main(args):
 
 
     # Load Data
-    train_dl = DataLoader(
-        dataset=train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        pin_memory=True,
-    )
+    train_dl = build_dataloader(train_dataset, args.batch_size, shuffle=True)
 
 
 
@@ -1,36 +1,28 @@
 import numpy as np
-import os, sys, argparse, time
+import os, sys, argparse, time, json
+PROCESS_START = time.time()     # start of the time to the first batch, before the imports below
 
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
-
-from transformers import (
-    TrainingArguments,
-    Trainer,
-    AutoTokenizer,
-    BertModel,
-    AutoModelForSequenceClassification,
-    AutoModel,
-    AutoConfig,
-    set_seed,
-    get_linear_schedule_with_warmup,
-)
 
-from tqdm import tqdm
+# transformers and SummaryWriter are imported where they are used,
+# so importing this script (e.g. in a warm worker or a sweep) doesn't pay for importing them
 
-from sklearn.metrics import (classification_report, f1_score, precision_score,
-                             recall_score, accuracy_score, confusion_matrix)
+from tqdm import tqdm
 
-from dataset import DepressionDataset, SymptomDataset
-from utils import save_cp, format_time, load_model, compute_metrics, print_result, get_symptom_num
-from bert_model import BertModelforBaseline, get_batch_bert_embedding
+from dataset import DepressionDataset, SymptomDataset, StreamingDepressionDataset, build_dataloader
+from utils import save_cp, format_time, load_model, compute_metrics, print_result, get_symptom_num, save_results
+from snapshot import wait_checkpoints
+from bert_model import BertModelforBaseline, get_batch_bert_embedding, get_bert_output, get_head_mask
+from embedding_cache import EmbeddingDataset, precompute_embeddings
+from cache_utils import fingerprint_model
 from questionnaire.questionnaire_model import QuestionnaireModel
-from disease.disease_model import DiseaseModel, DiseaseAfterBertModel, DiseaseModelfor2Inputs
+from disease.disease_model import DiseaseModel, DiseaseAfterBertModel, DiseaseModelfor2Inputs, DiseaseReplicas
+from cnn_head import set_conv_backend
 
 
-def get_args():
+def get_args(argv=None):
+    # argv: the arguments of a run submitted to a warm worker (see worker.py), default: sys.argv
     parser = argparse.ArgumentParser()
 
     # initialization
@@ -40,6 +32,8 @@ def get_args():
     parser.add_argument('--log_dir', type=str, default='./logs')
     parser.add_argument("--cache_dir", type=str, default="./cache")
     parser.add_argument("--data_path", type=str, default="./dataset/{}/{}/{}.json")
+    parser.add_argument("--corpus_path", type=str, default="./dataset/{}/corpus.json")    # with fold_index_path, used instead of the per-fold files (see folds.py)
+    parser.add_argument("--fold_index_path", type=str, default="./dataset/{}/five_fold.json")
     parser.add_argument("--five_fold_num", type=int, default=0)
 
     # dataset related
@@ -52,6 +46,7 @@ def get_args():
 
     parser.add_argument("--model_name", type=str, default="bert")
     parser.add_argument("--model_name_or_path", type=str, default="bert-base-cased")
+    parser.add_argument("--encoder_path", type=str, default="")   # local safetensors snapshot of the encoder and tokenizer to load instead (see snapshot.py)
     # parser.add_argument("--model_name_or_path", type=str, default="roberta-base")
     # parser.add_argument("--model_name_or_path", type=str, default="xlnet-base-cased")
 
@@ -71,55 +66,144 @@ def get_args():
     parser.add_argument('--debug', action='store_true')
 
     parser.add_argument("--overwrite_cache", action="store_true")
+    parser.add_argument("--dynamic_padding", action="store_true")   # pad each batch to its longest example instead of max_seq_length
+    parser.add_argument("--tokenize_workers", type=int, default=0)   # processes for building token caches, 0: all cores
+    parser.add_argument("--shard_size", type=int, default=10000)
+    parser.add_argument("--masked_pooling", action="store_true")   # CNN heads pool only over real tokens of batches trimmed to their longest text
+    parser.add_argument("--conv_backend", type=str, default="conv")   # conv of the CNN heads: conv (nn.Conv2d) or matmul (see cnn_head.py)
+    parser.add_argument("--embedding_cache", action="store_true")   # train/test the heads from precomputed encoder outputs
+    parser.add_argument("--stream_test", action="store_true")   # test_only: read and tokenize the test file on the fly instead of caching it
+    parser.add_argument("--stream_workers", type=int, default=1)
+    parser.add_argument("--seeds", nargs='+', type=int, default=None)   # train one head per seed side by side in one process (see train_replicas)
+    parser.add_argument("--folds", nargs='+', type=int, default=None)   # with --seeds: the folds to train one after another, default: --five_fold_num
+    parser.add_argument("--results_path", type=str, default="")   # json file for the metrics of the run, may contain {seed}, {fold} and {eval_set} (see run_disease_model.py)
+    parser.add_argument("--replica_head", type=str, default="bert")   # with --seeds: bert (DiseaseAfterBertModel) or 2inputs (DiseaseModelfor2Inputs on the questionnaire model)
     parser.add_argument('--fast_dev_run', action='store_true', default=True)
     parser.add_argument("--do_train", action="store_true")  # only True when entered in an argument line
     #parser.add_argument("--do_eval", action="store_true", default=True)
     parser.add_argument("--do_test", action="store_true", default=True)
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+
+# tokenizers and encoders kept loaded between the runs of one process,
+# a dict only in a warm worker (see worker.py), None otherwise
+resident_models = None
+
+
+def get_resident(key, load):
+    # load(), or in a warm worker the model loaded under key by an earlier run
+    if resident_models is None:
+        return load()
+    if key not in resident_models:
+        resident_models[key] = load()
+    return resident_models[key]
+
+
+def get_encoder_key(args):
+    # the encoder and tokenizer that are loaded, including the files of a local one (e.g. rewritten by finetuning)
+    return json.dumps(fingerprint_model(args.encoder_path or args.model_name_or_path), sort_keys=True), args.cache_dir
+
+
+def select_gpu(gpu_id):
+    # ======================================
+    #   CUDA_VISIBLE_DEVICES only takes effect before cuda is initialised.
+    #   A warm worker initialises cuda on its own --gpu_id (see worker.py), a job must not change it afterwards.
+    # ======================================
+    if not torch.cuda.is_initialized():
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+
+
+def load_tokenizer(args):
+    from transformers import AutoTokenizer
+    return get_resident(('tokenizer',) + get_encoder_key(args), lambda: AutoTokenizer.from_pretrained(
+        args.encoder_path or args.model_name_or_path,
+        cache_dir=args.cache_dir,
+    ))
+
+
+def load_bert_model(args, tokenizer=None):
+    # the encoder is frozen in every run of this script, so a warm worker shares it between runs
+    # (num_labels only sets the config of the encoder without a classification head, it's not part of the key)
+    from transformers import AutoModel
+    return get_resident(('encoder',) + get_encoder_key(args), lambda: BertModelforBaseline(
+        args=args,
+        tokenizer=tokenizer,
+        bert_model=AutoModel.from_pretrained(
+            args.encoder_path or args.model_name_or_path,
+            cache_dir=args.cache_dir,
+            num_labels=args.num_labels,
+        ),
+    ))
+
+
+def save_run_results(args, seed, fold, phase, metrics, eval_set=None):
+    # ======================================
+    #   metrics of one seed and fold to --results_path, if given
+    #   eval_set: the data the metrics are computed on, by default the split of the fold of phase
+    #             (fold_train, fold_test), or an external test set (e.g. eRisk2018_test)
+    # ======================================
+    if not args.results_path:
+        return
+    eval_set = eval_set or 'fold_{}'.format(phase)
+    save_results(args.results_path.format(seed=seed, fold=fold, eval_set=eval_set), {
+        'task_name': args.task_name,
+        'model_name_or_path': args.model_name_or_path,
+        'seed': seed,
+        'fold': fold,
+        'epochs': args.epochs,
+        'phase': phase,
+        'eval_set': eval_set,
+        'metrics': {name: float(value) for name, value in metrics.items()},
+        'time_to_first_batch': args.first_batch_time,
+    })
+
+
+def report_first_batch(args):
+    # ======================================
+    #   prints, once per run, the time from the start of the run to the end of its first batch:
+    #   the imports, loading the tokenizer, the data and the models and the first step
+    # ======================================
+    if args.first_batch_time is None:
+        args.first_batch_time = time.time() - args.start_time
+        print("*** Time to first batch: {:.2f}s".format(args.first_batch_time))
+
+
+def load_datasets(args, modes, tokenizer, device):
+    # ======================================
+    #   returns {mode: dataset}
+    #   with --embedding_cache, missing embedding caches are built first (the only time the encoder runs)
+    # ======================================
+    if args.embedding_cache:
+        precompute_embeddings(args, tokenizer, modes, lambda: load_bert_model(args).to(device), device)
+        return {mode: EmbeddingDataset(args=args, mode=mode, tokenizer=tokenizer) for mode in modes}
+
+    return {mode: DepressionDataset(args=args, mode=mode, tokenizer=tokenizer) for mode in modes}
 
 
 def train(args):
+    from torch.utils.tensorboard import SummaryWriter
+    from transformers import set_seed, get_linear_schedule_with_warmup
+
     #print(args)
     set_seed(args.seed)
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    select_gpu(args.gpu_id)
     writer = SummaryWriter(args.log_dir)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     print('  *** Device: ', device)
     print('  *** Current cuda device:', args.gpu_id)
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model_name_or_path,
-        cache_dir=args.cache_dir,
-    )
+    tokenizer = load_tokenizer(args)
 
     # Prepare data
-    train_dataset = DepressionDataset(
-        args=args,
-        mode='train',
-        tokenizer=tokenizer,
-    )
-
-    test_dataset = DepressionDataset(
-        args=args,
-        mode='test',
-        tokenizer=tokenizer,
-    )
+    datasets = load_datasets(args, ['train', 'test'], tokenizer, device)
+    train_dataset = datasets['train']
+    test_dataset = datasets['test']
 
     # Load Data
-    train_dl = DataLoader(
-        dataset=train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        pin_memory=True,
-    )
-    test_dl = DataLoader(
-        dataset=test_dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        pin_memory=True,
-    )
+    train_dl = build_dataloader(train_dataset, args.batch_size, shuffle=True)
+    test_dl = build_dataloader(test_dataset, args.batch_size, shuffle=False)
     dataloaders = {
         'train': train_dl,
         'test': test_dl
@@ -128,15 +212,7 @@ def train(args):
     # Prepare models
     num_training_steps = args.epochs * (train_dataset.num_data / args.batch_size)
     # BERT Encoder
-    bert_model = BertModelforBaseline(
-        args=args,
-        tokenizer=tokenizer,
-        bert_model=AutoModel.from_pretrained(
-            args.model_name_or_path,
-            cache_dir=args.cache_dir,
-            num_labels=args.num_labels,
-        ),
-    )
+    bert_model = None if args.embedding_cache else load_bert_model(args, tokenizer)
     # questionnaire model
     '''
     question_model_path = os.path.join(args.output_dir,  # './checkpoints'
@@ -150,15 +226,17 @@ def train(args):
     question_model = load_model(question_model_path)
     '''
     # disease model (depression model in code)
-    disease_model = DiseaseAfterBertModel()
+    disease_model = DiseaseAfterBertModel(conv_backend=args.conv_backend)
 
-    bert_model.cuda()
+    if bert_model is not None:
+        bert_model.cuda()
     #question_model.cuda()
     disease_model.cuda()
 
     def count_parameter(model):
         return sum(p.numel() for p in model.parameters())
-    print("BERT MODEL PARAMS: {}".format(count_parameter(bert_model)))
+    if bert_model is not None:
+        print("BERT MODEL PARAMS: {}".format(count_parameter(bert_model)))
     #print("QUESTION MODEL PARAMS: {}".format(count_parameter(question_model)))
     print("DISEASE MODEL PARAMS: {}".format(count_parameter(disease_model)))
 
@@ -208,24 +286,20 @@ def train(args):
             all_preds = []
             all_labels = []
             for step, data in enumerate(tqdm(dataloaders[phase], desc=phase, mininterval=0.01, leave=True), 0):
-                inputs = {
-                    "input_ids": data['input_ids'].to(device),
-                    "attention_mask": data['attention_mask'].to(device),
-                    # "token_type_ids":data['token_type_ids'].to(device),
-                }
                 labels = data['labels'].to(device)
 
                 optimizer.zero_grad()
 
                 # foward
                 with torch.no_grad():
-                    bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=False)
+                    bert_output = get_bert_output(bert_model, data, device, trainable=False)
                     #symptom_scores, symptom_labels, symptom_hidden = question_model.forward(bert_output,
                     #                                                                        labels)  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
                 with torch.set_grad_enabled(phase == 'train'):
                     #disease_output, disease_hidden = disease_model(symptom_hidden)  # (b, 1), (b, hidden_dim)
-                    disease_output, disease_hidden = disease_model(bert_output) # (b, 1), (b, hidden_dim)
+                    disease_output, disease_hidden = disease_model(bert_output, get_head_mask(args, data, device)) # (b, 1), (b, hidden_dim)
                 preds = [1 if prob.item() >= 0.5 else 0 for prob in disease_output]
+                report_first_batch(args)
 
                 loss = loss_fn(disease_output.to(torch.float32), labels.unsqueeze(1).to(torch.float32))
                 total_loss += loss.item()
@@ -270,6 +344,7 @@ def train(args):
                                                                                                    args.five_fold_num))
                 train_result, conf_matrix = compute_metrics(labels=all_labels, preds=all_preds)
                 print_result(train_result)
+                save_run_results(args, args.seed, args.five_fold_num, phase, train_result)
                 #print("Confusion Matrix:\n", conf_matrix)
             print("  {} epoch took: {:}".format(phase, format_time(time.time() - t0)))
             # save checkpoint
@@ -304,37 +379,29 @@ def train(args):
 
 
 def test_only(args):
+    from transformers import set_seed
     #print(args)
     set_seed(args.seed)
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
-    writer = SummaryWriter(args.log_dir)
+    select_gpu(args.gpu_id)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     print('  *** Device: ', device)
     print('  *** Current cuda device:', args.gpu_id)
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model_name_or_path,
-        cache_dir=args.cache_dir,
-    )
+    tokenizer = load_tokenizer(args)
 
     # Prepare data
 
-    test_dataset = DepressionDataset(
-        args=args,
-        #mode = 'test',
-        #mode='rsdd_test',
-        mode='eRisk2018_test',
-        tokenizer=tokenizer,
-    )
+    #test_mode = 'test'
+    #test_mode = 'rsdd_test'
+    test_mode = 'eRisk2018_test'
+    if args.stream_test and not args.embedding_cache:
+        test_dataset = StreamingDepressionDataset(args=args, mode=test_mode, tokenizer=tokenizer)
+    else:
+        test_dataset = load_datasets(args, [test_mode], tokenizer, device)[test_mode]
 
     # Load Data
-    test_dl = DataLoader(
-        dataset=test_dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        pin_memory=True,
-    )
+    test_dl = build_dataloader(test_dataset, args.batch_size, shuffle=False)
     dataloaders = {
         'test': test_dl
     }
@@ -342,15 +409,7 @@ def test_only(args):
     # Prepare models
     #num_training_steps = args.epochs * (train_dataset.num_data / args.batch_size)
     # BERT Encoder
-    bert_model = BertModelforBaseline(
-        args=args,
-        tokenizer=tokenizer,
-        bert_model=AutoModel.from_pretrained(
-            args.model_name_or_path,
-            cache_dir=args.cache_dir,
-            num_labels=args.num_labels,
-        ),
-    )
+    bert_model = None if args.embedding_cache else load_bert_model(args, tokenizer)
     # questionnaire model
     '''
     question_model_path = os.path.join(args.output_dir,  # './checkpoints'
@@ -373,15 +432,17 @@ def test_only(args):
                                          args.epochs,
                                          args.five_fold_num)
                                      )
-    disease_model = load_model(disease_model_path)
+    disease_model = set_conv_backend(load_model(disease_model_path), args.conv_backend)
 
-    bert_model.cuda()
+    if bert_model is not None:
+        bert_model.cuda()
     #question_model.cuda()
     disease_model.cuda()
 
     def count_parameter(model):
         return sum(p.numel() for p in model.parameters())
-    print("BERT MODEL PARAMS: {}".format(count_parameter(bert_model)))
+    if bert_model is not None:
+        print("BERT MODEL PARAMS: {}".format(count_parameter(bert_model)))
     #print("QUESTION MODEL PARAMS: {}".format(count_parameter(question_model)))
     print("DISEASE MODEL PARAMS: {}".format(count_parameter(disease_model)))
 
@@ -407,24 +468,20 @@ def test_only(args):
             all_preds = []
             all_labels = []
             for step, data in enumerate(tqdm(dataloaders[phase], desc=phase, mininterval=0.01, leave=True), 0):
-                inputs = {
-                    "input_ids": data['input_ids'].to(device),
-                    "attention_mask": data['attention_mask'].to(device),
-                    # "token_type_ids":data['token_type_ids'].to(device),
-                }
                 labels = data['labels'].to(device)
 
                 #optimizer.zero_grad()
 
                 # foward
                 with torch.no_grad():
-                    bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=False)
+                    bert_output = get_bert_output(bert_model, data, device, trainable=False)
                     #symptom_scores, symptom_labels, symptom_hidden = question_model.forward(bert_output,
                     #                                                                        labels)  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
                 with torch.set_grad_enabled(phase == 'train'):
                     #disease_output, disease_hidden = disease_model(symptom_hidden)  # (b, 1), (b, hidden_dim)
-                    disease_output, disease_hidden = disease_model(bert_output) # (b, 1), (b, hidden_dim)
+                    disease_output, disease_hidden = disease_model(bert_output, get_head_mask(args, data, device)) # (b, 1), (b, hidden_dim)
                 preds = [1 if prob.item() >= 0.5 else 0 for prob in disease_output]
+                report_first_batch(args)
 
                 loss = loss_fn(disease_output.to(torch.float32), labels.unsqueeze(1).to(torch.float32))
                 total_loss += loss.item()
@@ -444,7 +501,8 @@ def test_only(args):
 
             # epoch ends
             # print results
-            print("total {} loss: {}".format(phase, total_loss / len(dataloaders[phase])))
+            # a streamed test set has no length, count the steps
+            print("total {} loss: {}".format(phase, total_loss / (step + 1)))
 
             print("Test Result\nTASK {} / MODEL {} / SEED {} / FIVE FOLD {}".format(args.task_name,
                                                                                             args.model_name_or_path,
@@ -452,6 +510,7 @@ def test_only(args):
                                                                                             args.five_fold_num))
             train_result, conf_matrix = compute_metrics(labels=all_labels, preds=all_preds)
             print_result(train_result)
+            save_run_results(args, args.seed, args.five_fold_num, phase, train_result, eval_set=test_mode)
             print("")
             #print("Confusion Matrix:\n", conf_matrix)
             #print("  {} epoch took: {:}".format(phase, format_time(time.time() - t0)))
@@ -461,46 +520,25 @@ def test_only(args):
 
 
 def train_for_measuring_time(args):
+    from transformers import set_seed, get_linear_schedule_with_warmup
     #print(args)
     set_seed(args.seed)
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
-    writer = SummaryWriter(args.log_dir)
+    select_gpu(args.gpu_id)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     print('  *** Device: ', device)
     print('  *** Current cuda device:', args.gpu_id)
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model_name_or_path,
-        cache_dir=args.cache_dir,
-    )
+    tokenizer = load_tokenizer(args)
 
     # Prepare data
-    train_dataset = DepressionDataset(
-        args=args,
-        mode='train',
-        tokenizer=tokenizer,
-    )
-
-    test_dataset = DepressionDataset(
-        args=args,
-        mode='test',
-        tokenizer=tokenizer,
-    )
+    datasets = load_datasets(args, ['train', 'test'], tokenizer, device)
+    train_dataset = datasets['train']
+    test_dataset = datasets['test']
 
     # Load Data
-    train_dl = DataLoader(
-        dataset=train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        pin_memory=True,
-    )
-    test_dl = DataLoader(
-        dataset=test_dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        pin_memory=True,
-    )
+    train_dl = build_dataloader(train_dataset, args.batch_size, shuffle=True)
+    test_dl = build_dataloader(test_dataset, args.batch_size, shuffle=False)
     dataloaders = {
         'train': train_dl,
         'test': test_dl
@@ -509,15 +547,7 @@ def train_for_measuring_time(args):
     # Prepare models
     num_training_steps = args.epochs * (train_dataset.num_data / args.batch_size)
     # BERT Encoder
-    bert_model = BertModelforBaseline(
-        args=args,
-        tokenizer=tokenizer,
-        bert_model=AutoModel.from_pretrained(
-            args.model_name_or_path,
-            cache_dir=args.cache_dir,
-            num_labels=args.num_labels,
-        ),
-    )
+    bert_model = None if args.embedding_cache else load_bert_model(args, tokenizer)
     # question model
     question_model_path = os.path.join(args.output_dir,  # './checkpoints'
                                        '{}/{}/{}/checkpoint_batch_{}_ep_{}/'.format(
@@ -527,18 +557,20 @@ def train_for_measuring_time(args):
                                            args.batch_size,
                                            '10')
                                        )
-    question_model = load_model(question_model_path)
+    question_model = set_conv_backend(load_model(question_model_path), args.conv_backend)
     # disease model (depression model in original paper)
-    disease_model = DiseaseModelfor2Inputs(num_symptom=args.num_labels)
+    disease_model = DiseaseModelfor2Inputs(num_symptom=args.num_labels, conv_backend=args.conv_backend)
 
-    bert_model.cuda()
+    if bert_model is not None:
+        bert_model.cuda()
     question_model.cuda()
     disease_model.cuda()
 
     def count_parameter(model):
         return sum(p.numel() for p in model.parameters())
     m_name = 'BERT' if args.model_name_or_path=='bert-base-cased' else 'ROBERTA'
-    print("{} MODEL PARAMS: {}".format(m_name, count_parameter(bert_model)))
+    if bert_model is not None:
+        print("{} MODEL PARAMS: {}".format(m_name, count_parameter(bert_model)))
     print("QUESTION MODEL PARAMS: {}".format(count_parameter(question_model)))
     print("DISEASE MODEL PARAMS: {}".format(count_parameter(disease_model)))
 
@@ -589,22 +621,19 @@ def train_for_measuring_time(args):
             all_preds = []
             all_labels = []
             for step, data in enumerate(tqdm(dataloaders[phase], desc=phase, mininterval=0.01, leave=True), 0):
-                inputs = {
-                    "input_ids": data['input_ids'].to(device),
-                    "attention_mask": data['attention_mask'].to(device),
-                    # "token_type_ids":data['token_type_ids'].to(device),
-                }
                 labels = data['labels'].to(device)
 
                 # foward
                 with torch.no_grad():
-                    bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=False)
+                    bert_output = get_bert_output(bert_model, data, device, trainable=False)
                     symptom_scores, symptom_labels, symptom_hidden = question_model.forward(bert_output,
-                                                                                            labels)  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
+                                                                                            labels,
+                                                                                            get_head_mask(args, data, device))  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
                 with torch.set_grad_enabled(phase == 'train'):
-                    disease_output, disease_hidden = disease_model(bert_output, symptom_hidden)  # (b, 1), (b, hidden_dim)
+                    disease_output, disease_hidden = disease_model(bert_output, symptom_hidden, get_head_mask(args, data, device))  # (b, 1), (b, hidden_dim)
                     # disease_output, disease_hidden = disease_model(bert_output) # (b, 1), (b, hidden_dim)
                 preds = [1 if prob.item() >= 0.5 else 0 for prob in disease_output]
+                report_first_batch(args)
 
                 loss = loss_fn(disease_output.to(torch.float32), labels.unsqueeze(1).to(torch.float32))
                 total_loss += loss.item()
@@ -653,6 +682,8 @@ def train_for_measuring_time(args):
 
     # Print the time per step
     print(f'Time per step: {time_per_step:.4f} seconds')
+    # metrics of the last epoch, written once the run is complete
+    save_run_results(args, args.seed, args.five_fold_num, phases[-1], train_result)
 
     # Calculate and print average memory usage per iteration
     average_memory_usage = sum(memory_usage) / len(memory_usage)
@@ -661,14 +692,224 @@ def train_for_measuring_time(args):
 
 
 
-if __name__ == '__main__':
-    from train_disease_model import get_args
+def build_replicas(args, seeds):
+    # ======================================
+    #   one head per seed, initialised from the seed as in a single-seed run,
+    #   or without --do_train loaded from its checkpoint of --five_fold_num (as test_only does)
+    # ======================================
+    from transformers import set_seed
+    replicas = []
+    for seed in seeds:
+        set_seed(seed)
+        if not args.do_train:
+            disease_model_path = os.path.join(args.output_dir,
+                                              '{}/{}/{}/checkpoint_seed_{}_ep_{}_fivefold_{}/'.format(
+                                                 'disease',
+                                                 args.task_name,
+                                                 args.model_name_or_path,
+                                                 seed,
+                                                 args.epochs,
+                                                 args.five_fold_num)
+                                             )
+            replicas.append(set_conv_backend(load_model(disease_model_path), args.conv_backend))
+        elif args.replica_head == '2inputs':
+            replicas.append(DiseaseModelfor2Inputs(num_symptom=args.num_labels, conv_backend=args.conv_backend))
+        else:
+            replicas.append(DiseaseAfterBertModel(conv_backend=args.conv_backend))
+    return DiseaseReplicas(replicas)
+
+
+def train_replicas(args):
+    # ======================================
+    #   Trains the disease head for every seed of --seeds and every fold of --folds in one process.
+    #   The encoder (and the questionnaire model for --replica_head 2inputs) is loaded once,
+    #   every batch is encoded once per fold and shared by the heads of all seeds, which run as one DiseaseReplicas.
+    #   Every head has its own optimizer, scheduler and gradient clipping, and the loss of a head is its own batch mean,
+    #   so it gets the updates of a single-seed run on the same batches.
+    #   The seed sets the initialisation and the checkpoint of its head; the batch order of a fold is shared
+    #   and comes from --seed.
+    # ======================================
+    from transformers import set_seed, get_linear_schedule_with_warmup
+    select_gpu(args.gpu_id)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    seeds = args.seeds
+    folds = args.folds if args.folds is not None else [args.five_fold_num]
 
-    args = get_args()
+    print('  *** Device: ', device)
+    print('  *** Current cuda device:', args.gpu_id)
+    print('  *** Seeds: {} / Folds: {}'.format(seeds, folds))
+
+    tokenizer = load_tokenizer(args)
+
+    # models shared by all folds
+    bert_model = None if args.embedding_cache else load_bert_model(args, tokenizer).to(device)
+    question_model = None
+    if args.replica_head == '2inputs':
+        question_model_path = os.path.join(args.output_dir,  # './checkpoints'
+                                           '{}/{}/{}/checkpoint_batch_{}_ep_{}/'.format(
+                                               'symptoms',
+                                               args.task_name,
+                                               args.model_name_or_path,
+                                               args.batch_size,
+                                               '10')
+                                           )
+        question_model = set_conv_backend(load_model(question_model_path), args.conv_backend).to(device)
+        question_model.eval()
+
+    loss_fn = nn.BCELoss(reduction='none')
+    results = {}    # (seed, fold) -> test metrics
+    start_time = time.time()
+
+    for fold in folds:
+        args.five_fold_num = fold
+
+        # Prepare data
+        datasets = load_datasets(args, ['train', 'test'], tokenizer, device)
+        train_dataset = datasets['train']
+        dataloaders = {
+            'train': build_dataloader(train_dataset, args.batch_size, shuffle=True),
+            'test': build_dataloader(datasets['test'], args.batch_size, shuffle=False)
+        }
+
+        # Prepare models
+        num_training_steps = args.epochs * (train_dataset.num_data / args.batch_size)
+        disease_models = build_replicas(args, seeds).to(device)
+        set_seed(args.seed)     # batch order and dropout of the fold
+        optimizers, schedulers = [], []
+        for disease_model in disease_models.replicas:
+            optimizer = torch.optim.AdamW(
+                disease_model.parameters(),
+                lr=args.lr,
+                betas=args.betas,
+                eps=args.eps,
+                weight_decay=args.weight_decay,
+            )
+            optimizers.append(optimizer)
+            schedulers.append(get_linear_schedule_with_warmup(
+                optimizer,
+                num_warmup_steps=args.warmup_steps,
+                num_training_steps=num_training_steps,
+            ))
+        print("DISEASE MODEL PARAMS: {} x {} seeds".format(sum(p.numel() for p in disease_models.replicas[0].parameters()), len(seeds)))
+
+        for epoch_i in range(0, args.epochs):
+            print("")
+            print('======== Fold {} / Epoch {:} / {:} ========'.format(fold, epoch_i + 1, args.epochs))
+
+            phases = ['train', 'test'] if args.do_train else ['test']
+
+            for phase in phases:
+                if (phase == 'test') and (epoch_i != args.epochs-1):
+                    continue
+                t0 = time.time()
+                disease_models.train(phase == 'train')
+
+                print('{}ing...'.format(phase))
+                total_loss = torch.zeros(len(seeds))
+                all_preds = [[] for _ in seeds]
+                all_labels = []
+                for step, data in enumerate(tqdm(dataloaders[phase], desc=phase, mininterval=0.01, leave=True), 0):
+                    labels = data['labels'].to(device)
+                    head_mask = get_head_mask(args, data, device)
+
+                    # foward, the encoder output is shared by all seeds
+                    with torch.no_grad():
+                        bert_output = get_bert_output(bert_model, data, device, trainable=False)
+                        symptom_hidden = None
+                        if question_model is not None:
+                            symptom_scores, symptom_labels, symptom_hidden = question_model(bert_output, labels, head_mask)
+                    with torch.set_grad_enabled(phase == 'train'):
+                        disease_output, disease_hidden = disease_models(bert_output, symptom_hidden, head_mask)  # (b, num_seeds, 1), (b, num_seeds, hidden_dim)
+                        targets = labels.view(-1, 1, 1).expand_as(disease_output).to(torch.float32)
+                        losses = loss_fn(disease_output.to(torch.float32), targets).mean(dim=(0, 2))   # (num_seeds), batch mean per seed
+                    total_loss += losses.detach().cpu()
+
+                    if phase == 'train':
+                        losses.sum().backward()
+                        for disease_model, optimizer, scheduler in zip(disease_models.replicas, optimizers, schedulers):
+                            torch.nn.utils.clip_grad_norm_(disease_model.parameters(), 1.0)
+                            optimizer.step()
+                            scheduler.step()
+                            optimizer.zero_grad()
+
+                    preds = (disease_output[:, :, 0] >= 0.5).long().t().tolist()  # (num_seeds, b)
+                    report_first_batch(args)
+                    for seed_preds, batch_preds in zip(all_preds, preds):
+                        seed_preds += batch_preds
+                    all_labels += labels.tolist()
+
+                # epoch ends
+                for seed, seed_loss in zip(seeds, total_loss.tolist()):
+                    print("SEED {}: total {} loss: {}".format(seed, phase, seed_loss / len(dataloaders[phase])))
+
+                if (epoch_i == args.epochs-1) and (phase == 'test'):
+                    for seed, seed_preds in zip(seeds, all_preds):
+                        print("Test Result for\nTASK {} / MODEL {} / SEED {} / EP {} / FIVE FOLD {}".format(args.task_name,
+                                                                                                           args.model_name_or_path,
+                                                                                                           seed,
+                                                                                                           args.epochs,
+                                                                                                           fold))
+                        results[(seed, fold)], conf_matrix = compute_metrics(labels=all_labels, preds=seed_preds)
+                        print_result(results[(seed, fold)])
+                        save_run_results(args, seed, fold, phase, results[(seed, fold)])
+                print("  {} epoch took: {:}".format(phase, format_time(time.time() - t0)))
+                # save checkpoints, one per seed as single-seed runs do
+                if (epoch_i == args.epochs-1) and (phase == 'train'):
+                    for seed, disease_model, optimizer, scheduler in zip(seeds, disease_models.replicas, optimizers, schedulers):
+                        save_cp(args=args,
+                                model_name='disease_model',
+                                seed=seed,
+                                epochs=epoch_i,
+                                fold=fold,
+                                model=disease_model,
+                                optimizer=optimizer,
+                                scheduler=scheduler,
+                                tokenizer=tokenizer
+                                )
+
+    print("")
+    print("Training complete in {}".format(format_time(time.time() - start_time)))
+    print_replica_results(results, seeds, folds)
+
+
+def print_replica_results(results, seeds, folds, names=('acc', 'f1', 'f1_macro', 'AUC')):
+    # test metrics of every seed and fold, the mean over the folds per seed and the mean (std) over all runs
+    if not results:
+        return
+    print("")
+    print("{:<8}{:<8}".format('seed', 'fold') + ''.join('{:>18}'.format(name) for name in names))
+    for seed in seeds:
+        for fold in folds:
+            print("{:<8}{:<8}".format(seed, fold) + ''.join('{:>18.4f}'.format(results[(seed, fold)][name] * 100) for name in names))
+        print("{:<8}{:<8}".format(seed, 'mean') + ''.join('{:>18.4f}'.format(np.mean([results[(seed, fold)][name] for fold in folds]) * 100)
+                                                          for name in names))
+    values = {name: [result[name] * 100 for result in results.values()] for name in names}
+    print("{:<16}".format('all') + ''.join('{:>18}'.format('{:.4f} ({:.2f})'.format(np.mean(values[name]), np.std(values[name])))
+                                           for name in names))
+
+
+def run(args, start_time=PROCESS_START):
+    # ======================================
+    #   one run of this script, also what a warm worker runs for every submitted job (see worker.py)
+    #   start_time: start of the time to the first batch, the start of the process or the submission of the job
+    # ======================================
     args.num_labels = get_symptom_num(args.task_name)
+    args.start_time = start_time
+    args.first_batch_time = None
 
-    if args.do_train:
+    if args.seeds:
+        train_replicas(args)
+    elif args.do_train:
         #train(args)
         train_for_measuring_time(args)
     else:
-        test_only(args)
\ No newline at end of file
+        test_only(args)
+    # the checkpoints are written in the background while testing, a finished run has them all on disk
+    wait_checkpoints()
+
+
+if __name__ == '__main__':
+    from train_disease_model import get_args
+
+    args = get_args()
+    run(args)
\ No newline at end of file
@@ -3,30 +3,18 @@ import os, sys, argparse, time
 
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
-from torch.utils.tensorboard import SummaryWriter
-
-from transformers import (
-    TrainingArguments,
-    Trainer,
-    AutoTokenizer,
-    BertModel,
-    AutoModelForSequenceClassification,
-    AutoModel,
-    AutoConfig,
-    set_seed,
-    get_linear_schedule_with_warmup,
-)
 
-from tqdm import tqdm
+# transformers and SummaryWriter are imported where they are used,
+# so importing this script doesn't pay for importing them
 
-from sklearn.metrics import (classification_report, f1_score, precision_score,
-                             recall_score, accuracy_score, confusion_matrix)
+from tqdm import tqdm
 
-from dataset import DepressionDataset, SymptomDataset
+from dataset import DepressionDataset, SymptomDataset, build_dataloader
 from utils import save_cp, format_time, compute_metrics, print_result, get_symptom_num, load_model
-from bert_model import BertModelforBaseline, get_batch_bert_embedding
+from snapshot import wait_checkpoints
+from bert_model import BertModelforBaseline, get_batch_bert_embedding, get_head_mask, is_optimized
 from questionnaire.questionnaire_model import QuestionnaireModel
+from cnn_head import set_conv_backend
 
 
 def get_args():
@@ -39,6 +27,8 @@ def get_args():
     parser.add_argument('--log_dir', type=str, default='./logs')
     parser.add_argument("--cache_dir", type=str, default="./cache")
     parser.add_argument("--data_path", type=str, default="./dataset/{}/{}/{}.json")
+    parser.add_argument("--corpus_path", type=str, default="./dataset/{}/corpus.json")    # with fold_index_path, used instead of the per-fold files (see folds.py)
+    parser.add_argument("--fold_index_path", type=str, default="./dataset/{}/five_fold.json")
     parser.add_argument("--five_fold_num", type=int, default=0)
 
     # dataset related
@@ -70,6 +60,12 @@ def get_args():
     parser.add_argument('--debug', action='store_true')
 
     parser.add_argument("--overwrite_cache", action="store_true")
+    parser.add_argument("--dynamic_padding", action="store_true")   # pad each batch to its longest example instead of max_seq_length
+    parser.add_argument("--tokenize_workers", type=int, default=0)   # processes for building token caches, 0: all cores
+    parser.add_argument("--shard_size", type=int, default=10000)
+    parser.add_argument("--finetune_encoder", action="store_true")   # also optimize the encoder, else it is frozen and runs without autograd
+    parser.add_argument("--masked_pooling", action="store_true")   # CNN heads pool only over real tokens of batches trimmed to their longest text
+    parser.add_argument("--conv_backend", type=str, default="conv")   # conv of the CNN heads: conv (nn.Conv2d) or matmul (see cnn_head.py)
     parser.add_argument('--fast_dev_run', action='store_true', default=True)
     parser.add_argument("--do_train", action="store_true", default=True)
     parser.add_argument("--do_eval", action="store_true", default=True)
@@ -79,6 +75,8 @@ def get_args():
 
 
 def main(args):
+    from torch.utils.tensorboard import SummaryWriter
+    from transformers import AutoTokenizer, AutoModel, set_seed, get_linear_schedule_with_warmup
     print(args)
     set_seed(args.seed)
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
@@ -101,12 +99,7 @@ def main(args):
     )
 
     # Load Data
-    train_dl = DataLoader(
-        dataset=train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        pin_memory=True,
-    )
+    train_dl = build_dataloader(train_dataset, args.batch_size, shuffle=True)
 
     # Prepare models
     num_training_steps = args.epochs * (train_dataset.num_data / args.batch_size)
@@ -124,6 +117,7 @@ def main(args):
     question_model = QuestionnaireModel(
         num_symptoms=get_symptom_num(args.task_name),
         filter_sizes=args.kernel_size,
+        conv_backend=args.conv_backend,
     )
 
     def count_parameter(model):
@@ -134,8 +128,11 @@ def main(args):
     bert_model.cuda()
     question_model.cuda()
 
+    params = list(question_model.parameters())
+    if args.finetune_encoder:
+        params += list(bert_model.parameters())
     optimizer = torch.optim.AdamW(
-        question_model.parameters(),
+        params,
         lr=args.lr,
         betas=args.betas,
         eps=args.eps,
@@ -148,6 +145,12 @@ def main(args):
         num_training_steps=num_training_steps,
     )
 
+    # the encoder builds an autograd graph only if the optimizer updates it
+    train_encoder = is_optimized(bert_model, optimizer)
+    if not train_encoder:
+        bert_model.requires_grad_(False)
+    print("*** Encoder: {}".format('fine-tuned' if train_encoder else 'frozen, no autograd'))
+
     loss_fn = nn.BCELoss()
 
     # Training starts
@@ -176,9 +179,10 @@ def main(args):
             optimizer.zero_grad()
 
             # foward
-            bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=True)
+            bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=train_encoder)
             symptom_scores, symptom_labels, symptom_hidden = question_model.forward(bert_output,
-                                                                                    labels)  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
+                                                                                    labels,
+                                                                                    get_head_mask(args, data, device))  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
 
             loss = loss_fn(symptom_scores.to(torch.float32), symptom_labels.to(torch.float32).to(device))
             total_loss += loss.item()
@@ -186,7 +190,7 @@ def main(args):
 
             loss.backward()
             # torch.nn.utils.clip_grad_norm_(bert_model.parameters(), 1.0)
-            torch.nn.utils.clip_grad_norm_(question_model.parameters(), 1.0)
+            torch.nn.utils.clip_grad_norm_(params, 1.0)
             optimizer.step()
             scheduler.step()
 
@@ -223,21 +227,28 @@ def main(args):
 
         # save checkpoint
         if (epoch_i+1) % 5 == 0:
-            save_cp(args=args,
-                    model_name='question_model',
-                    epochs=epoch_i,
-                    fold=0,
-                    model=question_model,
-                    optimizer=optimizer,
-                    scheduler=scheduler,
-                    tokenizer=tokenizer,
-                    batch_size=args.batch_size,)
-
+            save_dir_path = save_cp(args=args,
+                                    model_name='question_model',
+                                    epochs=epoch_i,
+                                    fold=0,
+                                    model=question_model,
+                                    optimizer=optimizer,
+                                    scheduler=scheduler,
+                                    tokenizer=tokenizer,
+                                    batch_size=args.batch_size,)
+            if train_encoder:
+                # safetensors, loadable with train_disease_model.py --encoder_path (see snapshot.py)
+                bert_model.bert_model.save_pretrained(save_dir_path + 'encoder', safe_serialization=True)
+                tokenizer.save_pretrained(save_dir_path + 'encoder')
+
+    wait_checkpoints()
     print("")
     print("Training complete")
 
 
 def test_only(args):
+    from torch.utils.tensorboard import SummaryWriter
+    from transformers import AutoTokenizer, AutoModel, set_seed
     print(args)
     set_seed(args.seed)
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
@@ -261,12 +272,7 @@ def test_only(args):
     )
 
     # Load Data
-    test_dl = DataLoader(
-        dataset=test_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        pin_memory=True,
-    )
+    test_dl = build_dataloader(test_dataset, args.batch_size, shuffle=True)
 
     # Prepare models
     num_training_steps = args.epochs * (test_dataset.num_data / args.batch_size)
@@ -289,7 +295,7 @@ def test_only(args):
                                            args.batch_size,
                                             args.epochs)
                                        )
-    question_model = load_model(question_model_path)
+    question_model = set_conv_backend(load_model(question_model_path), args.conv_backend)
 
     def count_parameter(model):
         return sum(p.numel() for p in model.parameters())
@@ -323,10 +329,12 @@ def test_only(args):
         }
         labels = data['labels'].to(device)
 
-        # foward
-        bert_output = get_batch_bert_embedding(bert_model, inputs, trainable=True)
-        symptom_scores, symptom_labels, symptom_hidden = question_model.forward(bert_output,
-                                                                                labels)  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
+        # foward (nothing is trained here, no autograd at all)
+        with torch.inference_mode():
+            bert_output = get_batch_bert_embedding(bert_model, inputs)
+            symptom_scores, symptom_labels, symptom_hidden = question_model.forward(bert_output,
+                                                                                    labels,
+                                                                                    get_head_mask(args, data, device))  # (b, num_symptom, 1), (b, num_symptom, 1), (b, 5)
 
         label_shape = symptom_labels.size()
         print("Symptom_Labels\n", symptom_scores.view(label_shape[:-1]))
@@ -1,11 +1,10 @@
-import time, datetime, random, os
+import time, datetime, random, os, json
 import numpy as np
 
-from sklearn.metrics import (classification_report, f1_score, precision_score,
-                             recall_score, auc, roc_curve, confusion_matrix)
-from transformers import get_linear_schedule_with_warmup
 import torch
 
+from snapshot import SNAPSHOT_NAME, OPTIMIZER_NAME, SCHEDULER_NAME, load_snapshot, load_optimizer_state, load_manifest, save_checkpoint
+
 
 class InputExample(object):
     """
@@ -52,6 +51,9 @@ def generate_examples(mode, texta=[], textb=None, labels=[]):
 
 
 def f1_pre_rec_scalar(labels, preds, main_label=1):
+    # sklearn is only imported once metrics are computed (at the end of a run)
+    from sklearn.metrics import f1_score, precision_score, recall_score, auc, roc_curve, confusion_matrix
+
     fpr, tpr, thresholds = roc_curve(labels, preds, pos_label=main_label)
                             #roc_curve(np.sort(labels), np.sort(preds), pos_label=main_label)
     return {
@@ -91,6 +93,20 @@ def print_result(test_result):
 		print('  Average {}:\t{}'.format(name, round(value*100, 4)))
 
 
+def save_results(path, results):
+    # ======================================
+    #   Writes the results (json) of one run to path.
+    #   The file is written under a temporary name and renamed,
+    #   so an interrupted run never leaves a partial result behind (see run_disease_model.py)
+    # ======================================
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp-{}'.format(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
 def save_cp(args, model_name, epochs, fold, model, optimizer, scheduler, tokenizer, batch_size=None, seed=None):
     m_name = ''
     if model_name == 'question_model':
@@ -131,14 +147,10 @@ def save_cp(args, model_name, epochs, fold, model, optimizer, scheduler, tokeniz
                                          fold, )
                                      )
 
-    if not os.path.exists(save_dir_path):
-        os.makedirs(save_dir_path)
-
     print('*** Save checkpoints at {}'.format(save_dir_path))
-    torch.save(model, save_dir_path + 'model.bin')
-    torch.save(optimizer, save_dir_path + 'optimizer.pt')
-    torch.save(scheduler.state_dict(), save_dir_path + 'scheduler.pt')
-    torch.save(tokenizer, save_dir_path + 'tokenizer.json')
+    save_checkpoint(save_dir_path, model, optimizer, scheduler, info=get_checkpoint_info(
+        args, tokenizer, epochs=epochs + 1, fold=fold, batch_size=batch_size, seed=seed))
+    return save_dir_path
 
 
 def save_cp_epochs(args, batch_size, epochs, model, optimizer, scheduler, tokenizer):
@@ -158,14 +170,9 @@ def save_cp_epochs(args, batch_size, epochs, model, optimizer, scheduler, tokeni
                                                                             args.model_name_or_path,
                                                                             args.train_portion, batch_size, epochs))
 
-    if not os.path.exists(save_dir_path):
-        os.makedirs(save_dir_path)
-
     print('*** Saving checkpoints at {}'.format(save_dir_path))
-    torch.save(model, save_dir_path+'model.bin')
-    torch.save(optimizer, save_dir_path+'optimizer.pt')
-    torch.save(scheduler.state_dict(), save_dir_path+'scheduler.pt')
-    torch.save(tokenizer, save_dir_path+'tokenizer.json')
+    save_checkpoint(save_dir_path, model, optimizer, scheduler,
+                    info=get_checkpoint_info(args, tokenizer, epochs=epochs, batch_size=batch_size))
 
 
 def save_cp_steps(args, batch_size, steps, model, optimizer, scheduler, tokenizer):
@@ -185,35 +192,58 @@ def save_cp_steps(args, batch_size, steps, model, optimizer, scheduler, tokenize
                                                                             args.model_name_or_path,
                                                                             args.train_portion, batch_size, steps))
 
-    if not os.path.exists(save_dir_path):
-        os.makedirs(save_dir_path)
-
     print('*** Saving checkpoints at {}'.format(save_dir_path))
-    torch.save(model, save_dir_path+'model.bin')
-    torch.save(optimizer, save_dir_path+'optimizer.pt')
-    torch.save(scheduler.state_dict(), save_dir_path+'scheduler.pt')
-    torch.save(tokenizer, save_dir_path+'tokenizer.json')
+    save_checkpoint(save_dir_path, model, optimizer, scheduler,
+                    info=get_checkpoint_info(args, tokenizer, steps=steps, batch_size=batch_size))
+
 
+def get_checkpoint_info(args, tokenizer, **kwargs):
+    # the manifest entries of a checkpoint: the run it belongs to and the tokenizer to load with it
+    info = {name: getattr(args, name) for name in ('task_name', 'task_type', 'data_type', 'model_name_or_path', 'train_portion')
+            if hasattr(args, name)}
+    info['tokenizer'] = getattr(tokenizer, 'name_or_path', None) or getattr(args, 'model_name_or_path', None)
+    info.update(kwargs)
+    return info
 
-def load_tokenizer(path):
-    return torch.load(path+'tokenizer.json')
+
+def load_tokenizer(path, cache_dir=None):
+    # checkpoints record the tokenizer in their manifest, older ones pickled it
+    manifest = load_manifest(path)
+    if manifest is None:
+        return torch.load(path+'tokenizer.json')
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(manifest['tokenizer'], cache_dir=cache_dir)
 
 
 def load_model(path):
+    # the weights-only snapshot (see snapshot.py) if the checkpoint has one, else the pickled model
+    if os.path.exists(path + SNAPSHOT_NAME):
+        return load_snapshot(path)
     return torch.load(path+'model.bin')
 
 
-def load_optimizer(path):
-    return torch.load(path+'optimizer.pt')
+def load_optimizer(path, optimizer):
+    # loads the optimizer state of the checkpoint at path into optimizer (built over the parameters of the loaded model)
+    if os.path.exists(path + OPTIMIZER_NAME):
+        optimizer.load_state_dict(load_optimizer_state(path))
+    else:
+        optimizer.load_state_dict(torch.load(path+'optimizer.pt').state_dict())
+    return optimizer
 
 
 def load_scheduler(path, optimizer, warmup_steps, num_training_steps):
+    from transformers import get_linear_schedule_with_warmup
+
     scheduler = get_linear_schedule_with_warmup(
         optimizer,
         num_warmup_steps=warmup_steps,
         num_training_steps=num_training_steps,
     )
-    scheduler.load_state_dict(torch.load(path+'scheduler.pt'))
+    if os.path.exists(path + SCHEDULER_NAME):
+        with open(path + SCHEDULER_NAME, 'r') as f:
+            scheduler.load_state_dict(json.load(f))
+    else:
+        scheduler.load_state_dict(torch.load(path+'scheduler.pt'))
     
     return scheduler
 
@@ -0,0 +1,168 @@
+import argparse, os, sys, time, traceback, secrets, socket, ipaddress
+from contextlib import redirect_stdout, redirect_stderr
+from multiprocessing.connection import Listener, Client
+
+
+# ======================================
+#   Warm worker for train_disease_model.py
+#
+#   A run of train_disease_model.py spends seconds to minutes importing transformers and loading
+#   the tokenizer and the encoder before the first batch. A worker does that once:
+#   it imports train_disease_model, keeps every tokenizer and encoder it loads resident
+#   (train_disease_model.resident_models) and runs the jobs submitted to it one after another in the same process.
+#   Jobs are the command line arguments of train_disease_model.py, sent over a local socket.
+#
+#   python worker.py serve --address localhost:6100 --gpu_id 0 --preload bert-base-cased
+#   python worker.py submit --address localhost:6100 --log run.log -- --task_name depression --do_train --seed 42
+#
+#   The gpu of a worker is fixed by its --gpu_id, the --gpu_id of a job is ignored.
+#   run_disease_model.py --worker_address spreads a sweep over several workers.
+#
+#   Messages are pickled, so whoever can connect can run code in the worker: connections are authenticated
+#   with $WORKER_AUTHKEY or, if it is not set, with a random key the first worker writes to --authkey_file
+#   (readable only by its user) and submit reads. Workers only listen on loopback addresses
+#   unless --allow_remote is given; remote clients then need the same $WORKER_AUTHKEY.
+# ======================================
+
+AUTHKEY_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'phq9-worker', 'authkey')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, choices=['serve', 'submit'])
+    parser.add_argument("--address", type=str, default="localhost:6100")
+    parser.add_argument('--gpu_id', type=str, default="0")  # serve: the gpu of the worker
+    parser.add_argument("--preload", nargs='+', type=str, default=[])   # serve: model_name_or_path to load before the first job
+    parser.add_argument("--cache_dir", type=str, default="./cache")     # serve: cache_dir of the preloaded models
+    parser.add_argument("--log", type=str, default="")   # submit: file for the output of the job, default: the output of the worker
+    parser.add_argument("--authkey_file", type=str, default=AUTHKEY_FILE)   # key of the connections if $WORKER_AUTHKEY is not set
+    parser.add_argument("--allow_remote", action="store_true")   # serve: listen on an address other hosts can reach
+    # submit: the arguments of train_disease_model.py follow --
+    argv = sys.argv[1:]
+    job_args = []
+    if '--' in argv:
+        argv, job_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.job_args = job_args
+    return args
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def is_loopback(host):
+    try:
+        return all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (socket.gaierror, ValueError):
+        return False
+
+
+def get_authkey(authkey_file=AUTHKEY_FILE, create=False):
+    # ======================================
+    #   $WORKER_AUTHKEY, or the key in authkey_file
+    #   create: a random key is written to authkey_file (mode 0600) if it doesn't exist yet
+    # ======================================
+    if os.environ.get('WORKER_AUTHKEY'):
+        return os.environ['WORKER_AUTHKEY'].encode('utf-8')
+    if create and not os.path.exists(authkey_file):
+        os.makedirs(os.path.dirname(os.path.abspath(authkey_file)), mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass    # written by another worker in the meantime
+    if not os.path.exists(authkey_file):
+        raise RuntimeError("no worker key: set $WORKER_AUTHKEY or start a worker first (it writes {})".format(authkey_file))
+    if os.stat(authkey_file).st_mode & 0o077:
+        raise RuntimeError("{} is accessible by other users, it must have mode 0600".format(authkey_file))
+    with open(authkey_file, 'r') as f:
+        return f.read().strip().encode('utf-8')
+
+
+def run_job(job_args, log_path, cwd, gpu_id):
+    # ======================================
+    #   runs one job in this process from the directory cwd (of the client, for the relative paths of the job),
+    #   on the gpu of the worker (gpu_id replaces the --gpu_id of the job),
+    #   its output goes to log_path (appended) if given
+    #   returns {'returncode', 'time', 'error'}: 0 when the run finished, 2 for bad arguments, 1 for any other error
+    # ======================================
+    import torch
+    import train_disease_model
+
+    t0 = time.time()
+    returncode, error = 0, ''
+    log = open(log_path, 'a') if log_path else None
+    worker_cwd = os.getcwd()
+    os.chdir(cwd)
+    try:
+        with redirect_stdout(log or sys.stdout), redirect_stderr(log or sys.stderr):
+            try:
+                train_disease_model.run(train_disease_model.get_args(list(job_args) + ['--gpu_id', gpu_id]), start_time=t0)
+            except SystemExit as e:     # argparse
+                returncode, error = e.code if isinstance(e.code, int) else 2, 'exit {}'.format(e.code)
+            except Exception:
+                returncode, error = 1, traceback.format_exc()
+                print(error)
+    finally:
+        os.chdir(worker_cwd)
+        if log is not None:
+            log.close()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return {'returncode': returncode, 'time': time.time() - t0, 'error': error}
+
+
+def serve(args):
+    host, port = parse_address(args.address)
+    if not args.allow_remote and not is_loopback(host):
+        raise SystemExit("{} is not a loopback address, use --allow_remote to accept jobs from other hosts".format(args.address))
+    if args.allow_remote and not os.environ.get('WORKER_AUTHKEY'):
+        raise SystemExit("--allow_remote needs $WORKER_AUTHKEY, shared with the clients")
+    authkey = get_authkey(args.authkey_file, create=True)
+
+    # the gpu must be chosen before torch initialises cuda, initialising it here fixes it for all jobs
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.init()
+    import train_disease_model
+    train_disease_model.resident_models = {}
+
+    for model_name_or_path in args.preload:
+        preload_args = train_disease_model.get_args(['--model_name_or_path', model_name_or_path, '--cache_dir', args.cache_dir])
+        preload_args.num_labels = 2
+        tokenizer = train_disease_model.load_tokenizer(preload_args)
+        train_disease_model.load_bert_model(preload_args, tokenizer)
+        print("*** Preloaded {}".format(model_name_or_path))
+
+    with Listener((host, port), authkey=authkey) as listener:
+        print("*** Worker listening on {} (gpu {})".format(args.address, args.gpu_id))
+        while True:
+            with listener.accept() as conn:
+                job = conn.recv()   # {'args': [...], 'log': path or '', 'cwd': path}
+                print("*** Job: {}".format(' '.join(job['args'])))
+                result = run_job(job['args'], job['log'], job['cwd'], args.gpu_id)
+                print("*** Job finished with {} in {:.1f}s".format(result['returncode'], result['time']))
+                conn.send(result)
+
+
+def submit(address, job_args, log_path='', authkey_file=AUTHKEY_FILE):
+    # sends one job to the worker at address and waits for it, returns the result of run_job
+    with Client(parse_address(address), authkey=get_authkey(authkey_file)) as conn:
+        conn.send({'args': list(job_args), 'log': os.path.abspath(log_path) if log_path else '', 'cwd': os.getcwd()})
+        return conn.recv()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.command == 'serve':
+        serve(args)
+    else:
+        result = submit(args.address, args.job_args, args.log, args.authkey_file)
+        if result['error']:
+            print(result['error'])
+        print("*** Job finished with {} in {:.1f}s".format(result['returncode'], result['time']))
+        exit(result['returncode'])
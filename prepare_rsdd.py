@@ -1,102 +1,348 @@
-import os, re, json
+import os, sys, json, random, argparse, time, hashlib
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model'))
+from columnar import ColumnarWriter, SUFFIX
+from dedup import MinHasher, LSHBloomIndex
 
-def select_10_sen(mode):
-    with open(mode, 'r') as file:
-        lines = file.readlines()
-
-    new_data = dict()
-    data_idx = 0
-    for line in lines:
-        line = line.strip()[1:-1]
-        new_line = json.loads(line)  # {'posts': [#, string, ]
-        assert len(new_line.keys()) == 2
-
-        label = new_line['label']
-        label_num = 0 if label == 'control' else 1
-
-        posts = new_line['posts']
-        # depression user
-        if label_num == 1:
-            posts = sorted(posts, key=len, reverse=True)
-
-        # post indices
-        end = 10 if len(posts) > 10 else len(posts)
-        if label_num == 0:
-            import random
-            idx = random.sample(range(0, len(posts)), end)
+
+# ======================================
+#   RSDD preparation
+#   {mode} (one user per line: [{"label": ..., "posts": [[timestamp, text], ...]}])
+#   -> one {output}.jsonl per strategy (one [text, label] per line)
+#      or, with --format columnar, one {output}.cols (text, label, user, post columns, see model/columnar.py)
+#
+#   Users are read line by line in chunks of --chunk_size, parsed once and passed to
+#   every selected strategy in a process pool; each strategy appends to its own file
+#   in input order, so only one chunk of users is in memory at a time.
+#   {output_dir}/rsdd_manifest.json records the files, their counts and the seed.
+#
+#   Random selections use a generator seeded from (--seed, strategy, user number),
+#   so the output is identical for any number of workers and chunk size.
+#
+#   --dedup drops exact and near-duplicate posts (within and across the users of a split) before selection:
+#   the workers compute MinHash band keys of every post, the main process checks them in input order
+#   against an LSH index of scalable Bloom filters (see model/dedup.py).
+# ======================================
+
+
+def parse_user(line):
+    line = line.strip()[1:-1]
+    new_line = json.loads(line)  # {'posts': [#, string, ]
+    assert len(new_line.keys()) == 2
+
+    label = new_line['label']
+    label_num = 0 if label == 'control' else 1
+    return new_line['posts'], label_num
+
+
+def get_user_seed(seed, strategy, user_idx):
+    # independent of the process and of PYTHONHASHSEED
+    digest = hashlib.sha1('{}-{}-{}'.format(seed, strategy, user_idx).encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def reservoir_sample(items, k, rng):
+    # ======================================
+    #   k uniformly sampled items of an iterable in one pass (algorithm R),
+    #   only the k kept items are held in memory
+    # ======================================
+    reservoir = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append(item)
         else:
-            idx = range(0, end)
-        selected_posts = [posts[i] for i in idx]
+            j = rng.randint(0, i)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+
+def select_10_sen(posts, label_num, rng):
+    posts = enumerate(posts)
+    # depression user: the first 10 posts
+    # (the original script sorted the [timestamp, text] pairs by len, always 2, so the stable sort kept the order)
+    if label_num == 1:
+        selected_posts = list(islice(posts, 10))
+    else:
+        selected_posts = reservoir_sample(posts, 10, rng)
+
+    # select less than 10 posts
+    return [[post[1], label_num, post_idx] for post_idx, post in selected_posts]
+
+
+def iter_words(posts):
+    for post in posts:
+        yield from post[1].split()
+
+
+def iter_word_windows(posts, sen_len=400):
+    # windows of sen_len whitespace words over the concatenated posts
+    window = []
+    for word in iter_words(posts):
+        window.append(word)
+        if len(window) == sen_len:
+            yield ' '.join(window)
+            window = []
+    if len(window) > 0:
+        yield ' '.join(window)
+
+
+def get_window_budget(tokenizer, max_seq_length, stride):
+    # tokens of words per window; the overlap must leave room for new words, or windows would stop advancing
+    budget = max_seq_length - tokenizer.num_special_tokens_to_add()
+    if not 0 <= stride < budget:
+        raise ValueError("stride must be in [0, {}) for max_seq_length {} (without special tokens), got {}".format(
+            budget, max_seq_length, stride))
+    return budget
+
+
+def iter_token_windows(posts, tokenizer, max_seq_length, stride=0):
+    # ======================================
+    #   Packs whole words into windows of at most max_seq_length tokens of the target tokenizer
+    #   (special tokens included), so windows are neither truncated nor underfilled by the encoder.
+    #   Consecutive windows share up to stride tokens of trailing words.
+    #   Words are counted post by post, only the current window is held in memory.
+    # ======================================
+    budget = get_window_budget(tokenizer, max_seq_length, stride)
+    window = deque()    # (word, number of tokens)
+    num_tokens = 0
+    for post in posts:
+        words = post[1].split()
+        if len(words) == 0:
+            continue
+        # a leading space makes BPE tokenizers count the word as it appears inside a text
+        counts = [len(ids) for ids in tokenizer([' ' + word for word in words], add_special_tokens=False)['input_ids']]
+        for word, count in zip(words, counts):
+            if num_tokens + count > budget and len(window) > 0:
+                yield ' '.join(w for w, _ in window)
+                # keep the trailing words that fit into stride
+                overlap = 0
+                kept = deque()
+                while len(window) > 0 and overlap + window[-1][1] <= stride:
+                    overlap += window[-1][1]
+                    kept.appendleft(window.pop())
+                # and leave room for the next word
+                while len(kept) > 0 and overlap + count > budget:
+                    overlap -= kept.popleft()[1]
+                window, num_tokens = kept, overlap
+            window.append((word, count))
+            num_tokens += count
+    if len(window) > 0:
+        yield ' '.join(w for w, _ in window)
+
+
+def select_windows(windows, label_num, rng):
+    # depression users: the first 10 windows, control users: one random window
+    windows = enumerate(windows)
+    if label_num == 0:
+        selected_posts = reservoir_sample(windows, 1, rng)
+    else:
+        selected_posts = list(islice(windows, 10))
+
+    # select less than 10 posts
+    return [[post, label_num, post_idx] for post_idx, post in selected_posts]
+
+
+def select_concat_sen(posts, label_num, rng):
+    return select_windows(iter_word_windows(posts, sen_len=400), label_num, rng)
 
-        # select less than 10 posts
-        for post in selected_posts:
-            txt = post[1]
-            new_data[data_idx] = [txt, label_num]
-            data_idx += 1
 
-    print(len(new_data))
+def select_token_windows(posts, label_num, rng):
+    tokenizer, max_seq_length, stride = _window_tokenizer
+    return select_windows(iter_token_windows(posts, tokenizer, max_seq_length, stride), label_num, rng)
 
-    with open('test_10.json', 'w') as new_file:
-        json.dump(new_data, new_file)
 
+# a strategy: (posts, label_num, rng) -> [[text, label_num, post index], ...] and its output name
+STRATEGIES = {
+    '10': (select_10_sen, '{}_10'),
+    'concat': (select_concat_sen, '{}_concat_long_balanced'),
+    'tokens': (select_token_windows, '{}_token_windows'),
+}
+SPLITS = {'training': 'train', 'validation': 'valid', 'testing': 'test'}
+FORMATS = {'jsonl': '.jsonl', 'columnar': SUFFIX}
+MANIFEST = 'rsdd_manifest.json'
 
-def select_concat_sen(mode):
+
+class JsonlWriter(object):
+    # same interface as ColumnarWriter, one [text, label] per line
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp-{}'.format(os.getpid())
+        self.file = open(self.tmp_path, 'w')
+
+    def append(self, row):
+        self.file.write(json.dumps([row['text'], row['label']]) + '\n')
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+_strategies = None
+_seed = None
+_window_tokenizer = None
+_minhasher = None
+
+
+def _init_worker(strategies, seed, window_tokenizer=None, dedup=None):
+    global _strategies, _seed, _window_tokenizer, _minhasher
+    _strategies = strategies
+    _seed = seed
+    _window_tokenizer = window_tokenizer
+    if dedup is not None:
+        _minhasher = MinHasher(num_bands=dedup['num_bands'], rows=dedup['rows'], shingle_size=dedup['shingle_size'])
+
+
+def select_posts(user):
+    user_idx, posts, label_num = user
+    return [STRATEGIES[strategy][0](posts, label_num, random.Random(get_user_seed(_seed, strategy, user_idx)))
+            for strategy in _strategies]
+
+
+def select_user(user):
+    # parses the user once for all strategies
+    user_idx, line = user
+    posts, label_num = parse_user(line)
+    return select_posts((user_idx, posts, label_num))
+
+
+def sign_user(user):
+    # parses the user and computes the band keys of every post
+    user_idx, line = user
+    posts, label_num = parse_user(line)
+    return user_idx, posts, label_num, [_minhasher.band_keys(post[1]) for post in posts]
+
+
+def prepare(mode, strategies, output_dir, workers, chunk_size, seed, window_tokenizer=None, output_format='jsonl', dedup=None):
+    output_paths = [os.path.join(output_dir, STRATEGIES[strategy][1].format(SPLITS.get(mode, mode)) + FORMATS[output_format])
+                    for strategy in strategies]
+    sinks = [JsonlWriter(path) if output_format == 'jsonl' else ColumnarWriter(path) for path in output_paths]
+    counts = [{'examples': 0, 'labels': {'0': 0, '1': 0}} for _ in strategies]
+
+    t0 = time.time()
+    num_users = 0
+    pool = None
+    if workers > 1:
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+        pool = Pool(workers, initializer=_init_worker, initargs=(strategies, seed, window_tokenizer, dedup))
+    else:
+        _init_worker(strategies, seed, window_tokenizer, dedup)
+    pool_map = (lambda fn, items: pool.imap(fn, items, chunksize=max(1, len(items) // (workers * 4)))) if pool is not None else map
+
+    index = None
+    if dedup is not None:
+        # one index per split
+        index = LSHBloomIndex(num_bands=dedup['num_bands'], capacity=dedup['capacity'], error_rate=dedup['error_rate'])
     with open(mode, 'r') as file:
-        lines = file.readlines()
-
-    new_data = dict()
-    data_idx = 0
-    for line in lines:
-        line = line.strip()[1:-1]
-        new_line = json.loads(line)  # {'posts': [#, string, ]
-        assert len(new_line.keys()) == 2
-
-        label = new_line['label']
-        label_num = 0 if label == 'control' else 1
-
-        full_sen = []
-        for post in new_line['posts']:
-            full_sen += post[1].split()
-        n_tokens = len(full_sen)
-
-        sen_len = 400
-        posts = []
-        for i in range(0, n_tokens, sen_len):
-            start = i
-            end = start + sen_len if start+sen_len < n_tokens else n_tokens
-
-            post = ' '.join(full_sen[start:end])
-            posts.append(post)
-
-        # post indices
-        num_post = 10 if len(posts) > 10 else len(posts)
-        if label_num == 0:
-            import random
-            #idx = random.sample(range(0, len(posts)), num_post)
-            idx = random.sample(range(0, len(posts)), 1)
-        else:
-            idx = range(0, num_post)
-        selected_posts = [posts[i] for i in idx]
+        while True:
+            lines = list(islice(file, chunk_size))
+            if len(lines) == 0:
+                break
+            users = list(enumerate(lines, num_users))
+            if index is not None:
+                # checked in input order, so the kept posts don't depend on the workers
+                kept = []
+                for user_idx, posts, label_num, keys in pool_map(sign_user, users):
+                    kept.append((user_idx, [post for post, post_keys in zip(posts, keys) if not index.add(post_keys)], label_num))
+                results = pool_map(select_posts, kept)
+            else:
+                results = pool_map(select_user, users)
+
+            for user_idx, outputs in enumerate(results, num_users):
+                for sink, count, examples in zip(sinks, counts, outputs):
+                    for text, label, post_idx in examples:
+                        sink.append({'text': text, 'label': label, 'user': user_idx, 'post': post_idx})
+                        count['labels'][str(label)] += 1
+                    count['examples'] += len(examples)
+            num_users += len(lines)
+            print("*** {}: {} users, {:.0f}s".format(mode, num_users, time.time() - t0))
+
+    if index is not None:
+        print("*** {}: removed {} duplicate posts of {} ({:.1f}%)".format(
+            mode, index.num_duplicates, index.num_texts, 100.0 * index.num_duplicates / max(index.num_texts, 1)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    entries = {}
+    for strategy, sink, output_path, count in zip(strategies, sinks, output_paths, counts):
+        sink.close()
+        print("*** Saved {} examples of {} users into {}".format(count['examples'], num_users, output_path))
+        entries[os.path.basename(output_path)] = dict(count, mode=mode, strategy=strategy, users=num_users, seed=seed,
+                                                      format=output_format, created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        if index is not None:
+            entries[os.path.basename(output_path)]['dedup'] = dict(dedup, posts=index.num_texts, removed=index.num_duplicates,
+                                                                   filters=len(index.filters), index_bytes=index.memory())
+        if strategy == 'tokens':
+            tokenizer, max_seq_length, stride = window_tokenizer
+            entries[os.path.basename(output_path)].update(tokenizer=tokenizer.name_or_path, max_seq_length=max_seq_length, stride=stride)
+    return entries
+
+
+def update_manifest(output_dir, entries):
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    manifest.update(entries)
+    tmp_path = manifest_path + '.tmp-{}'.format(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
 
-        # select less than 10 posts
-        for post in selected_posts:
-            txt = post
-            new_data[data_idx] = [txt, label_num]
-            data_idx += 1
+def get_args():
+    parser = argparse.ArgumentParser()
 
-    print(len(new_data))
+    parser.add_argument('--rsdd_path', type=str, default='/home/hysong/Research/dep_detection/rsdd/rsdd_posts')
+    parser.add_argument('--modes', nargs='+', type=str, default=['training', 'validation', 'testing'])
+    parser.add_argument('--strategies', nargs='+', type=str, default=['10', 'concat'], choices=list(STRATEGIES.keys()))
+    parser.add_argument('--output_dir', type=str, default='.')
+    parser.add_argument('--format', type=str, default='jsonl', choices=list(FORMATS.keys()))
+    parser.add_argument('--workers', type=int, default=0)   # 0: all cores
+    parser.add_argument('--chunk_size', type=int, default=10000)    # users in memory at a time
+    parser.add_argument('--seed', type=int, default=42)
+    # 'tokens' strategy: windows packed to max_seq_length tokens of this tokenizer
+    parser.add_argument('--model_name_or_path', type=str, default='bert-base-cased')
+    parser.add_argument('--max_seq_length', type=int, default=512)
+    parser.add_argument('--stride', type=int, default=0)
+    # near-duplicate post removal
+    parser.add_argument('--dedup', action='store_true')
+    parser.add_argument('--dedup_bands', type=int, default=8)
+    parser.add_argument('--dedup_rows', type=int, default=8)
+    parser.add_argument('--dedup_shingle_size', type=int, default=3)
+    parser.add_argument('--dedup_capacity', type=int, default=5000000)   # posts of the first filter of the index, it grows past that
+    parser.add_argument('--dedup_error_rate', type=float, default=1e-3)   # bound of the rate of unique posts dropped as duplicates
 
-    with open('test_concat_long_balanced.json', 'w') as new_file:
-        json.dump(new_data, new_file)
+    args = parser.parse_args()
+    if not 0 <= args.stride < args.max_seq_length:
+        parser.error("--stride must be in [0, --max_seq_length)")
+    return args
 
 
 if __name__ == '__main__':
-    path = '/home/hysong/Research/dep_detection/rsdd/rsdd_posts'
-    os.chdir(path)
+    args = get_args()
+    output_dir = os.path.abspath(args.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
 
-    # mode = ['training', 'validation', 'testing']
-    modes = ['testing']
+    window_tokenizer = None
+    if 'tokens' in args.strategies:
+        # only the 'tokens' strategy needs transformers
+        from transformers import AutoTokenizer
+        window_tokenizer = (AutoTokenizer.from_pretrained(args.model_name_or_path), args.max_seq_length, args.stride)
+        # fails before any split is read
+        get_window_budget(*window_tokenizer)
+    dedup = None
+    if args.dedup:
+        dedup = {'num_bands': args.dedup_bands, 'rows': args.dedup_rows, 'shingle_size': args.dedup_shingle_size,
+                 'capacity': args.dedup_capacity, 'error_rate': args.dedup_error_rate}
+    os.chdir(args.rsdd_path)
 
-    for mode in modes:
-        select_concat_sen(mode)
\ No newline at end of file
+    for mode in args.modes:
+        entries = prepare(mode, args.strategies, output_dir, args.workers if args.workers > 0 else os.cpu_count(), args.chunk_size, args.seed,
+                          window_tokenizer, args.format, dedup)
+        update_manifest(output_dir, entries)
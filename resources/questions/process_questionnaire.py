@@ -1,4 +1,6 @@
-import os, argparse, json
+import os, sys, argparse, json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../model'))
 
 
 def read_json(args):
@@ -51,6 +53,16 @@ def process_dataset(args):
         json_dict[idx] = [txt, num_label]
 
     data_path = args.data_path.format(args.task_name)
+
+    if args.format == 'columnar':
+        # train.cols, see model/columnar.py
+        from columnar import ColumnarWriter, SUFFIX
+        writer = ColumnarWriter(os.path.join(data_path, 'train' + SUFFIX), columns={'text': 'str', 'label': 'int64'})
+        for idx in json_dict:
+            writer.append({'text': json_dict[idx][0], 'label': int(json_dict[idx][1])})
+        writer.close()
+        return
+
     save_path = os.path.join(data_path, 'train.json')
 
     with open(save_path, 'w') as outf:
@@ -63,6 +75,7 @@ def get_args():
     parser.add_argument('--data_path', type=str, default='./{}')
 
     parser.add_argument('--task_name', type=str, default='depression')
+    parser.add_argument('--format', type=str, default='json', choices=['json', 'columnar'])
 
     return parser.parse_args()
 